@@ -0,0 +1,227 @@
+"""
+SSH and SFTP server standing in for the VMs of the local platform during benchmarks.
+
+Every connection gets its own home directory, commands run in it with bash and the fakes of
+benchmarks/fakes/remote first in the PATH so nothing is installed or started on this machine.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+REMOTE_BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakes", "remote")
+
+
+class Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class SFTPServer(paramiko.SFTPServerInterface):
+    """
+    SFTP server storing the files in the home directory of the connection.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.home = server.home
+
+    def _path(self, path: str) -> str:
+        # absolute paths (windows style ones too) are kept in the home directory
+        return os.path.join(self.home, path.lstrip("/").replace(":", ""))
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def mkdir(self, path, attr):
+        try:
+            os.makedirs(self._path(path), exist_ok=True)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "wb"
+        elif flags & os.O_RDWR:
+            mode = "r+b"
+        else:
+            mode = "rb"
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+
+class Server(paramiko.ServerInterface):
+    """
+    Accept any user, key and password, and run the commands in the home directory of the connection.
+    """
+
+    def __init__(self, home: str, latency: float) -> None:
+        self.home = home
+        self.latency = latency
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self.run_command, args=(channel, command.decode()), daemon=True
+        ).start()
+        return True
+
+    def run_command(self, channel: paramiko.Channel, command: str) -> None:
+        """
+        Run a command and send its output and exit status on the channel.
+
+        Args:
+            channel: Channel of the exec request.
+            command: Command to run.
+        """
+        time.sleep(self.latency)
+        env = dict(
+            os.environ, HOME=self.home, PATH=f"{REMOTE_BIN}:{os.environ['PATH']}"
+        )
+        proc = subprocess.Popen(
+            ["bash", "-c", command],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.home,
+            env=env,
+        )
+
+        def pump(source, send):
+            for chunk in iter(lambda: source.read1(65536), b""):
+                send(chunk)
+
+        stderr = threading.Thread(target=pump, args=(proc.stderr, channel.sendall_stderr))
+        stderr.start()
+        try:
+            pump(proc.stdout, channel.sendall)
+            stderr.join()
+            channel.send_exit_status(proc.wait())
+            # paramiko replies to the exec request after this thread is started, closing the channel
+            # before the reply makes the client fail with "Channel closed" so the client closes it
+            channel.shutdown_write()
+        except OSError:
+            # the client closed the connection, for example when a deployment is cancelled
+            proc.kill()
+            channel.close()
+
+
+def serve(listener: socket.socket, root: str, latency: float) -> None:
+    """
+    Accept connections until the process is stopped.
+
+    Args:
+        listener: Listening socket.
+        root: Directory the home directories of the connections are created in.
+        latency: Seconds each command waits before running.
+    """
+    host_key = paramiko.Ed25519Key.from_private_key_file(_host_key(root))
+
+    def start(connection: socket.socket) -> None:
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, SFTPServer)
+        try:
+            transport.start_server(server=Server(tempfile.mkdtemp(dir=root), latency))
+        except (paramiko.SSHException, EOFError, OSError):
+            # a client giving up during the handshake must not stop the other vms
+            transport.close()
+
+    while True:
+        connection, _ = listener.accept()
+        # the handshake blocks, done in a thread so many vms can connect at the same time
+        threading.Thread(target=start, args=(connection,), daemon=True).start()
+
+
+def _host_key(root: str) -> str:
+    """
+    Create the host key of the server.
+
+    Args:
+        root: Directory to write the key in.
+
+    Returns:
+        Path of the key.
+    """
+    # paramiko can only generate rsa keys, ed25519 is much faster to use so it is made with the same code as the client key
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+
+    path = os.path.join(root, "host_key")
+    key = ed25519.Ed25519PrivateKey.generate()
+    with open(path, "wb") as file:
+        file.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.OpenSSH,
+                serialization.NoEncryption(),
+            )
+        )
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake VMs for the AIC benchmarks.")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on, 0 for any free port")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds each command waits before running"
+    )
+    args = parser.parse_args()
+
+    # the benchmark stops the server with SIGTERM, exiting normally removes the home directories
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    root = tempfile.mkdtemp(prefix="aic-bench-vms-")
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", args.port))
+    listener.listen(512)
+    # the benchmark reads the port from the first line
+    print(listener.getsockname()[1], flush=True)
+    try:
+        serve(listener, root, args.latency)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Measure the overhead of AIC itself by running main.py against fake terraform, ansible and VMs.
+
+The fakes only wait for the configured latencies, everything else (process pool, ssh, sftp,
+logging...) is the real code. Run from the root of the repository:
+
+    python benchmarks/run.py --sizes 1 10 50 200
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKES = os.path.join(ROOT, "benchmarks", "fakes")
+sys.path.insert(0, ROOT)
+
+from modules import config, plan  # noqa: E402
+
+# windows vms need powershell, the fake vms only have bash
+LINUX_OS = [
+    "LinuxDebian12",
+    "LinuxDebian12-ARM",
+    "LinuxUbuntuServer_24_04-LTS",
+    "LinuxUbuntuServer_24_04-LTS-ARM",
+    "LinuxRhel9",
+    "LinuxRhel9-ARM",
+    "LinuxFedora41",
+    "LinuxFedora41-ARM",
+    "LinuxRocky9",
+    "LinuxRocky8-ARM",
+    "LinuxAlma9",
+    "LinuxAlma9-ARM",
+    "LinuxOracle9",
+    "LinuxOracle9-ARM",
+    "LinuxSuse15",
+    "LinuxSuse15-ARM",
+]
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def matrix(size: int) -> tuple[list[str], dict]:
+    """
+    Split a number of deployments over the OS list, using shards once every OS is used.
+
+    Args:
+        size: Number of deployments.
+
+    Returns:
+        OS list and shards of the configuration.
+    """
+    os_names = LINUX_OS[: min(size, len(LINUX_OS))]
+    shards = {}
+    for index, os_name in enumerate(os_names):
+        count = size // len(os_names) + (1 if index < size % len(os_names) else 0)
+        if count > 1:
+            shards[os_name] = count
+    return os_names, shards
+
+
+def write_config(path: str, work_dir: str, size: int, port: int, args: argparse.Namespace) -> dict:
+    """
+    Write the configuration of a benchmark run, based on aic.yml.example.
+
+    Args:
+        path: Path of the configuration to write.
+        work_dir: Directory for the logs and cache of the run.
+        size: Number of deployments.
+        port: Port of the fake VMs.
+        args: Command line arguments.
+
+    Returns:
+        Configuration written.
+    """
+    with open(os.path.join(ROOT, "aic.yml.example")) as file:
+        cfg = yaml.safe_load(file)
+    os_names, shards = matrix(size)
+    cfg.update(
+        {
+            "platform": "local",
+            "os": os_names,
+            "shards": shards,
+            "local_hosts": {os_name: f"127.0.0.1:{port}" for os_name in os_names},
+            "max_threads": args.max_threads or len(os_names),
+            "project_root": os.path.join(ROOT, "example"),
+            "log_dir": os.path.join(work_dir, "logs"),
+            "log_level": args.log_level,
+            "cache_dir": os.path.join(work_dir, "cache"),
+            "ansible_batch_window": args.ansible_batch_window,
+            # a new key each run, the fake vms accept any key
+            "ssh_key_max_age": 0,
+        }
+    )
+    with open(path, "w") as file:
+        yaml.safe_dump(cfg, file)
+    return cfg
+
+
+def process_tree(pid: int) -> list[int]:
+    """
+    Get a process and all its descendants.
+
+    Args:
+        pid: Process id of the root.
+
+    Returns:
+        Process ids.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                # the name can contain spaces, the fields after it can not
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def sample(pid: int, cpu: dict) -> dict:
+    """
+    Sample the resources used by AIC, the fakes are not counted.
+
+    Args:
+        pid: Process id of main.py.
+        cpu: Dictionary updated with the last CPU time seen per process.
+
+    Returns:
+        RSS in bytes, number of threads and number of processes.
+    """
+    rss = threads = processes = 0
+    for child in process_tree(pid):
+        try:
+            with open(f"/proc/{child}/cmdline", "rb") as file:
+                if FAKES.encode() in file.read():
+                    continue
+            with open(f"/proc/{child}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{child}/statm") as file:
+                rss += int(file.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            # the process ended between the listing and the read
+            continue
+        # utime and stime, the fields are shifted by the pid and name
+        cpu[child] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        threads += int(fields[17])
+        processes += 1
+    return {"rss": rss, "threads": threads, "processes": processes}
+
+
+def log_volume(log_dir: str) -> tuple[int, int]:
+    """
+    Count what was written in the log files of a run.
+
+    Args:
+        log_dir: Log directory of the run.
+
+    Returns:
+        Number of bytes and lines.
+    """
+    size = lines = 0
+    for root, _, files in os.walk(log_dir):
+        for name in files:
+            # the logs are compressed at the end of the run, what was written is the content
+            with (gzip.open if name.endswith(".gz") else open)(os.path.join(root, name), "rb") as file:
+                content = file.read()
+            size += len(content)
+            lines += content.count(b"\n")
+    return size, lines
+
+
+def ideal_duration(cfg: dict, args: argparse.Namespace) -> float:
+    """
+    Duration of a run if AIC itself took no time, only the synthetic latencies.
+
+    Args:
+        cfg: Configuration of the run.
+        args: Command line arguments.
+
+    Returns:
+        Duration in seconds.
+    """
+    # the stages on the critical path of a deployment, the shards of an os run at the same time
+    deployment = args.terraform + args.ansible + args.build
+    durations = [(os_name, deployment) for os_name in cfg["os"]]
+    starts = plan.simulate_schedule(durations, cfg["max_threads"])
+    return max(starts[os_name] + duration for os_name, duration in durations)
+
+
+def run(size: int, port: int, args: argparse.Namespace) -> dict:
+    """
+    Run main.py once and measure it.
+
+    Args:
+        size: Number of deployments.
+        port: Port of the fake VMs.
+        args: Command line arguments.
+
+    Returns:
+        Measurements of the run.
+    """
+    work_dir = tempfile.mkdtemp(prefix="aic-bench-")
+    config_path = os.path.join(work_dir, "aic.yml")
+    cfg = write_config(config_path, work_dir, size, port, args)
+    # same validation as main.py, a broken matrix would only show up as failed deployments
+    config.load_config(config_path)
+
+    env = dict(
+        os.environ,
+        PATH=f"{FAKES}:{os.environ['PATH']}",
+        AIC_BENCH_TERRAFORM=str(args.terraform),
+        AIC_BENCH_ANSIBLE=str(args.ansible),
+    )
+    cpu = {}
+    peak = {"rss": 0, "threads": 0, "processes": 0}
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, "main.py", "--config", config_path, "--no-cache"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    while proc.poll() is None:
+        usage = sample(proc.pid, cpu)
+        peak = {key: max(peak[key], value) for key, value in usage.items()}
+        time.sleep(args.interval)
+    wall = time.monotonic() - start
+
+    log_dir = os.path.join(work_dir, "logs")
+    log_bytes, log_lines = log_volume(log_dir)
+    results = {}
+    for run_dir in os.listdir(log_dir):
+        for os_name in cfg["os"]:
+            timings_path = os.path.join(log_dir, run_dir, os_name, "timings.json")
+            if os.path.exists(timings_path):
+                with open(timings_path) as file:
+                    results[os_name] = json.load(file).get("total")
+    # the logs of a failed run are kept to find out why
+    if proc.returncode == 0:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        print(f"Run of {size} deployments failed, logs in {log_dir}", file=sys.stderr)
+
+    ideal = ideal_duration(cfg, args)
+    deployment = args.terraform + args.ansible + args.build
+    return {
+        "size": size,
+        "os": len(cfg["os"]),
+        "exit_code": proc.returncode,
+        "wall": round(wall, 2),
+        "ideal": round(ideal, 2),
+        "overhead": round(wall - ideal, 2),
+        # time each os took on top of its synthetic latencies, without the queueing
+        "deployment_overhead": round(
+            sum(total - deployment for total in results.values() if total) / max(len(results), 1), 2
+        ),
+        "cpu": round(sum(cpu.values()), 2),
+        "peak_rss_mb": round(peak["rss"] / 2**20, 1),
+        "peak_threads": peak["threads"],
+        "peak_processes": peak["processes"],
+        "log_mb_per_s": round(log_bytes / 2**20 / wall, 3),
+        "log_lines_per_s": round(log_lines / wall, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of AIC.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 50, 200], help="number of deployments of each run")
+    parser.add_argument("--terraform", type=float, default=2, help="seconds terraform apply takes")
+    parser.add_argument("--ansible", type=float, default=2, help="seconds ansible-playbook takes")
+    parser.add_argument("--build", type=float, default=5, help="seconds the jenkins build takes")
+    parser.add_argument("--command-latency", type=float, default=0, help="seconds every ssh command waits before running")
+    parser.add_argument("--max-threads", type=int, default=None, help="max_threads of the runs, defaults to the number of OS")
+    parser.add_argument("--ansible-batch-window", type=int, default=0, help="ansible_batch_window of the runs")
+    parser.add_argument("--log-level", default="INFO", help="log_level of the runs")
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds between two resource samples")
+    parser.add_argument("--output", help="file to write the results to as json")
+    args = parser.parse_args()
+
+    if not sys.platform.startswith("linux"):
+        sys.exit("The benchmarks read /proc and only run on Linux.")
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "fake_ssh.py"), "--latency", str(args.command_latency)],
+        stdout=subprocess.PIPE,
+        text=True,
+        # the fake jenkins runs on the fake vms
+        env=dict(os.environ, AIC_BENCH_BUILD=str(args.build)),
+    )
+    try:
+        port = int(server.stdout.readline())
+        results = []
+        columns = ["size", "os", "exit_code", "wall", "ideal", "overhead", "deployment_overhead", "cpu", "peak_rss_mb", "peak_threads", "peak_processes", "log_mb_per_s", "log_lines_per_s"]
+        print(" ".join(f"{column:>12}" for column in columns))
+        for size in args.sizes:
+            result = run(size, port, args)
+            results.append(result)
+            print(" ".join(f"{result[column]:>12}" for column in columns))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    if any(result["exit_code"] for result in results):
+        sys.exit("Some runs failed, check the logs by running main.py with the same configuration.")
+
+
+if __name__ == "__main__":
+    main()
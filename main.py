@@ -1,11 +1,14 @@
+import argparse
 import concurrent.futures
+import json
+import logging
 import multiprocessing
 import os
-import signal
 import sys
 from logging import Logger
 
-from modules import cli, config, custom_logging, metrics, ssh, vm
+# the other modules import heavy dependencies (paramiko, plotext) and are only imported once needed
+from modules import cli, config, custom_logging
 from modules.custom_logging import log
 
 
@@ -27,11 +30,160 @@ def handler(interrupt: multiprocessing.Value, results: dict, cfg: dict, logger:
         return
 
 
+@log
+def stop_deployments(futures: dict, interrupt: multiprocessing.Value, reason: str, logger: Logger) -> None:  # type: ignore
+    """
+    Cancel the deployments not started yet and make the running ones tear down their resources.
+
+    Args:
+        futures: Dictionary with the futures of the deployments as key.
+        interrupt: Shared value across processes to handle interrupts.
+        reason: Why the deployments are stopped.
+        logger: Logger instance for logging.
+    """
+    logger.error(f"{reason}, cancelling the other deployments.")
+    # the running deployments poll the interrupt flag and tear down on their own
+    interrupt.value = True
+    for future in futures:
+        future.cancel()
+
+
+@log
+def record_duration(cfg: dict, log_dir: str, os_name: str, logger: Logger) -> None:
+    """
+    Add the stage timings of a finished deployment to the history used to schedule the next runs.
+
+    Args:
+        cfg: Configuration dictionary.
+        log_dir: Directory for the log files of the run.
+        os_name: Name of the operating system.
+        logger: Logger instance for logging.
+    """
+    from modules import plan
+
+    try:
+        with open(f"{log_dir}/{os_name}/timings.json") as file:
+            timings = json.load(file)
+        plan.record_history(cfg["cache_dir"], {os_name: timings})
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not record the duration of {os_name}: {e}")
+
+
+def get_terraform_dir(platform: str) -> str | None:
+    """
+    Get the Terraform directory of a platform.
+
+    Args:
+        platform: Platform name.
+
+    Returns:
+        Terraform directory, None if the platform is not supported.
+    """
+    # other providers can be added by creating new terraform directories
+    # this is for futureproofness, currently only azure is supported
+    # we could also do this trough terraform variables, this will be chosen when we add more providers
+    match platform:
+        case "azure":
+            return "./terraform/azure"
+        case "local":
+            return "./terraform/local"
+        case _:
+            return None
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+
+    Returns:
+        Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Test the compatibility of your software across platforms."
+    )
+    parser.add_argument(
+        "--config",
+        default="aic.yml",
+        help="path of the configuration file (default: aic.yml)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="deploy every OS even if it already succeeded with the same project, pipeline, playbooks and templates",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="show what would be deployed with the estimated time and cost, then exit without deploying anything",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="deploy each OS on every size of sweep_sizes and sweep_arm_sizes and recommend the cheapest one meeting the targets",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="build the Jenkins job benchmark_iterations times on each VM and compare the build durations across the OS",
+    )
+    commands = parser.add_subparsers(dest="command")
+    logs = commands.add_parser(
+        "logs",
+        help="search the logs of past runs",
+        description="Search the logs of past runs, the records of the different log files of a run are merged by time.",
+    )
+    logs.add_argument("pattern", nargs="?", help="regular expression the records must contain")
+    logs.add_argument("--log-dir", help="log directory to search (default: log_dir of the configuration)")
+    logs.add_argument("--run", action="append", help="name of a run to search, can be repeated")
+    logs.add_argument("--last", type=int, help="number of most recent runs to search")
+    logs.add_argument("--os", help="OS the records must come from")
+    logs.add_argument("--stage", help="log file the records must come from (main, terraform, ansible, jenkins, metrics)")
+    logs.add_argument(
+        "--level",
+        type=str.upper,
+        choices=custom_logging.LEVELS,
+        help="minimum level of the records",
+    )
+    logs.add_argument("-i", "--ignore-case", action="store_true", help="case insensitive pattern")
+    return parser.parse_args()
+
+
 def main() -> None:
+    args = parse_args()
+    if args.command == "logs":
+        log_dir = args.log_dir or config.load_config(args.config)["log_dir"]
+        matches = custom_logging.search_logs(
+            log_dir,
+            args.pattern,
+            runs=args.run,
+            last=args.last,
+            os_name=args.os,
+            stage=args.stage,
+            level=args.level,
+            ignore_case=args.ignore_case,
+        )
+        for run, location, text in matches:
+            print(f"{run} {location} {text}")
+        # like grep
+        sys.exit(0 if matches else 1)
+
+    if args.plan:
+        cfg = config.load_config(args.config)
+        cfg["sweep"] = args.sweep
+        cfg["benchmark"] = args.benchmark
+        from modules import plan
+
+        plan.print_plan(cfg, get_terraform_dir(cfg["platform"]))
+        sys.exit(0)
+
+    from modules import ansible, artifacts, cache, metrics, plan, ssh, vm
+
     try:
         cli.check_dependencies()
 
-        cfg = config.load_config()
+        cfg = config.load_config(args.config)
+        cfg["sweep"] = args.sweep
+        cfg["benchmark"] = args.benchmark
         print("Configuration loaded.")
 
         log_dir = custom_logging.create_log_folder(cfg["log_dir"])
@@ -44,27 +196,51 @@ def main() -> None:
         config.setup_terraform_vars(cfg, logger=logger)
         logger.debug("Terraform variables set up.")
 
+        terraform_dir = get_terraform_dir(cfg["platform"])
+        if terraform_dir is None:
+            logger.error(f"Error: Unsupported platform '{cfg['platform']}' specified.")
+            sys.exit(1)
+        logger.debug(
+            f"Platform set to {cfg['platform']}. Using terraform directory: {terraform_dir}"
+        )
+
+        if cfg["sweep"] and not (cfg["sweep_sizes"] or cfg["sweep_arm_sizes"]):
+            logger.error("Error: --sweep needs sweep_sizes or sweep_arm_sizes in the configuration.")
+            sys.exit(1)
+        if cfg["sweep"] and cfg["benchmark"]:
+            # the sweep targets are checked against a single build
+            logger.error("Error: --sweep and --benchmark can not be used together.")
+            sys.exit(1)
+
+        results = {}
+        # deployments that already succeeded with the same inputs are not deployed again
+        result_keys, cached = cache.find_cached_results(
+            cfg["os"], cfg, terraform_dir, logger=logger
+        )
+        # a sweep compares sizes and a benchmark measures, a cached result is not worth anything to them
+        if not args.no_cache and not cfg["sweep"] and not cfg["benchmark"]:
+            for os_name in cached:
+                results[os_name] = "succeeded (cached)"
+                logger.info(f"{os_name} already succeeded with the same inputs, skipping it.")
+        os_names = [os_name for os_name in cfg["os"] if os_name not in results]
+
         os.makedirs("temp", exist_ok=True)
         logger.debug("Ensured 'temp' directory exists.")
-        ssh.create_ssh_key(logger=logger)
+        ssh.create_ssh_key(
+            logger=logger,
+            key_type=cfg["ssh_key_type"],
+            # 0 disables the reuse of the key
+            cache_dir=f"{cfg['cache_dir']}/keys" if cfg["ssh_key_max_age"] else None,
+            max_age=cfg["ssh_key_max_age"],
+        )
         logger.info("SSH key created.")
 
-        # other providers can be added by creating new terraform directories
-        # this is for futureproofness, currently only azure is supported
-        # we could also do this trough terraform variables, this will be chosen when we add more providers
-        match cfg["platform"]:
-            case "azure":
-                terraform_dir = "./terraform/azure"
-                logger.debug(
-                    "Platform set to Azure. Using terraform directory: ./terraform/azure"
-                )
-            case _:
-                logger.error(
-                    f"Error: Unsupported platform '{cfg['platform']}' specified."
-                )
-                sys.exit(1)
+        if cfg["artifact_cache"] and os_names:
+            artifacts.populate_artifact_cache(
+                f"{cfg['cache_dir']}/artifacts", os_names, logger=logger
+            )
+            logger.info("Artifact cache populated.")
 
-        results = {}
         # set them as cancelled until they are done
         for os_name in cfg["os"]:
             if os_name not in results:
@@ -77,46 +253,129 @@ def main() -> None:
         with multiprocessing.Manager() as manager:
             interrupt = manager.Value("b", False)
             # ignore interupts in the main thread
-            signal.signal(
-                signal.SIGINT,
-                lambda signum, frame: handler(interrupt, results, cfg, logger=logger),
+            cli.install_interrupt_handler(
+                lambda: handler(interrupt, results, cfg, logger=logger)
             )
+            provisioner = None
+            if cfg["ansible_batch_window"]:
+                # one process provisions all the vms that are ready at the same time
+                provisioner = (manager.Queue(), manager.dict())
+                stop_provisioning = manager.Event()
+                provisioning_process = multiprocessing.Process(
+                    target=ansible.run_provisioning_batches,
+                    args=(
+                        *provisioner,
+                        stop_provisioning,
+                        f"{log_dir}/ansible-batch.log",
+                        cfg["log_level"],
+                        cfg["ansible_batch_window"],
+                        cfg["ansible_forks"],
+                    ),
+                )
+                provisioning_process.start()
+                logger.debug("Batch provisioning process started.")
+
             # separate processes else the keyboard interrupt will not be passed to the threads
+            # the fork server imports the heavy modules once, every worker is forked from it instead of importing them again
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["paramiko", "yaml", "modules.vm"])
             logger.debug("Starting ProcessPoolExecutor.")
-            with concurrent.futures.ProcessPoolExecutor(cfg["max_threads"]) as executor:
-                # Submit tasks for each OS deployment
-                future_to_os = {
-                    executor.submit(
-                        vm.deploy_and_test,
-                        os_name,
-                        cfg,
-                        terraform_dir,
-                        f"{log_dir}/{os_name}",
-                        logger=logger,
-                        interrupt=interrupt,
-                    ): os_name
-                    for os_name in cfg["os"]
-                }
-                logger.debug(f"Submitted {len(future_to_os)} deployment tasks.")
-                for future in concurrent.futures.as_completed(future_to_os):
-                    # prevent to store errors on cancelled deployments
-                    if not interrupt.value:
-                        os_name, result, metrics_result = future.result()
-                        results[os_name] = result
-                        metrics_results[os_name] = metrics_result
-                    else:
-                        logger.warning(
-                            "Skipping result processing due to interrupt flag."
+            # longest expected deployments first so they do not stretch the end of the run
+            history = plan.load_history(cfg["cache_dir"])
+            os_order = plan.order_by_duration(os_names, history)
+            logger.info(f"Deployment order: {', '.join(os_order)}")
+            makespan = plan.predict_makespan(
+                os_order, history, cfg["max_threads"] or os.cpu_count()
+            )
+            logger.info(f"Predicted duration: {makespan / 60:.0f} minutes")
+
+            # the canary is deployed alone first, the others only if it succeeds
+            waves = [os_order]
+            if cfg["canary"]:
+                canary = plan.pick_canary(os_order, cfg, history)
+                if canary:
+                    logger.info(f"Deploying {canary} first as canary.")
+                    waves = [[canary], [name for name in os_order if name != canary]]
+                else:
+                    logger.warning("No Linux OS to use as canary, deploying everything at once.")
+
+            failures = 0
+            with concurrent.futures.ProcessPoolExecutor(
+                cfg["max_threads"],
+                mp_context=context,
+                # the config and shared objects are sent once per worker instead of once per task
+                initializer=vm.init_worker,
+                initargs=(cfg, terraform_dir, log_dir, interrupt, provisioner),
+            ) as executor:
+                for wave in waves:
+                    if interrupt.value:
+                        break
+                    # Submit tasks for each OS deployment
+                    future_to_os = {
+                        executor.submit(vm.run_deployment, os_name): os_name
+                        for os_name in wave
+                    }
+                    logger.debug(f"Submitted {len(future_to_os)} deployment tasks.")
+                    for future in concurrent.futures.as_completed(future_to_os):
+                        # prevent to store errors on cancelled deployments
+                        if not interrupt.value:
+                            os_name, result, metrics_result = future.result()
+                            results[os_name] = result
+                            metrics_results[os_name] = metrics_result
+                            if result == "succeeded" and (cfg["sweep"] or cfg["benchmark"]):
+                                # the timings are not the ones of a normal run on the configured size
+                                logger.debug(f"{os_name} not recorded in the history or cache.")
+                            elif result == "succeeded":
+                                record_duration(cfg, log_dir, os_name, logger=logger)
+                                cache.store_result(
+                                    cfg["cache_dir"],
+                                    os_name,
+                                    result_keys[os_name],
+                                    logger=logger,
+                                )
+                            else:
+                                failures += 1
+                                if cfg["max_failures"] and failures >= cfg["max_failures"]:
+                                    stop_deployments(
+                                        future_to_os,
+                                        interrupt,
+                                        f"{failures} deployment(s) failed",
+                                        logger=logger,
+                                    )
+                        else:
+                            logger.warning(
+                                "Skipping result processing due to interrupt flag."
+                            )
+                    if wave is not waves[-1] and results[wave[0]] != "succeeded":
+                        logger.error(
+                            f"Canary {wave[0]} did not succeed, the other deployments are not started."
                         )
+                        break
+
+            if provisioner:
+                stop_provisioning.set()
+                provisioning_process.join()
+                logger.debug("Batch provisioning process stopped.")
 
         logger.info("Metrics:")
         metrics.display_and_save_metrics(
             results, metrics_results, log_dir, logger=logger
         )
 
+        sweeps = {
+            os_name: os_metrics["sweep"]
+            for os_name, os_metrics in metrics_results.items()
+            if os_metrics and "sweep" in os_metrics
+        }
+        if sweeps:
+            logger.info("VM Size Sweep:")
+            plan.print_sweep(sweeps, cfg)
+            with open(f"{log_dir}/sweep.json", "w") as file:
+                json.dump(sweeps, file, indent=4)
+
         logger.info("Test Results:")
         for os_name, result in results.items():
-            if result == "succeeded":
+            if result.startswith("succeeded"):
                 # color coting the output done w help of chatgpt
                 logger.info(f"\033[92m{os_name}: {result}\033[0m")
             elif result == "cancelled":
@@ -124,7 +383,7 @@ def main() -> None:
             else:
                 logger.error(f"\033[91m{os_name}: {result}\033[0m")
 
-        if all(result == "succeeded" for result in results.values()):
+        if all(result.startswith("succeeded") for result in results.values()):
             logger.info("All deployments succeeded. Exiting with status 0.")
             sys.exit(0)
         else:
@@ -136,6 +395,10 @@ def main() -> None:
         logger.info("Cleaning up resources.")
         vm.cleanup(logger=logger)
         logger.info("Cleanup complete.")
+        if cfg["compress_logs"]:
+            # nothing is logged after this, a closed file handler would open the log file again
+            logging.shutdown()
+            custom_logging.archive_run(log_dir)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,56 @@
+import os
+import queue
+import re
+import time
 from logging import Logger
 
 from modules import cli
 
+from . import artifacts, custom_logging, ssh
 from .custom_logging import log
 
+PLAYBOOKS = {
+    "linux": "ansible/linux/dependency.yml",
+    # switches the default shell to powershell and then installs the dependencies in a single run
+    "windows": "ansible/windows/provision.yml",
+}
+
+
+def inventory_host(
+    name: str,
+    ip: str,
+    password: str | None = None,
+    powershell: bool = False,
+    windows: bool = False,
+    port: int = 22,
+) -> str:
+    """
+    Create the inventory line of a single host.
+
+    Args:
+        name: Name of the host in the inventory.
+        ip: IP address of the target machine.
+        password: Password for the target machine (if applicable).
+        powershell: Whether to use PowerShell for Windows.
+        windows: Whether the target machine is Windows.
+        port: SSH port of the target machine.
+
+    Returns:
+        Inventory line.
+
+    Raises:
+        ValueError: If the combination of arguments is not supported.
+    """
+    if password and windows:
+        shell_type = "powershell" if powershell else "cmd"
+        return f"{name} ansible_host={ip} ansible_port={port} ansible_user=aic ansible_password={password} ansible_ssh_common_args='-o StrictHostKeyChecking=no' ansible_remote_tmp='C:\\Windows\\Temp' ansible_shell_type={shell_type} ansible_python_interpreter=none"
+    elif not windows:
+        return f"{name} ansible_host={ip} ansible_port={port} ansible_user=aic ansible_ssh_private_key_file={ssh.KEY_PATH} ansible_ssh_common_args='-o StrictHostKeyChecking=no'"
+    else:
+        raise ValueError(
+            "Create Inventory: This combination of arguments is not supported"
+        )
+
 
 @log
 def create_ansible_inventory(
@@ -13,6 +60,7 @@ def create_ansible_inventory(
     password: str | None = None,
     powershell: bool = False,
     windows: bool = False,
+    port: int = 22,
 ) -> None:
     """
     Create an Ansible inventory file.
@@ -24,22 +72,60 @@ def create_ansible_inventory(
         password: Password for the target machine (if applicable).
         powershell: Whether to use PowerShell for Windows.
         windows: Whether the target machine is Windows.
+        port: SSH port of the target machine.
     """
-    if password and windows:
-        if powershell:
-            inventory = f"{ip} ansible_user=aic ansible_password={password} ansible_ssh_common_args='-o StrictHostKeyChecking=no' ansible_remote_tmp='C:\\Windows\\Temp' ansible_shell_type=powershell ansible_python_interpreter=none"
-        else:
-            inventory = f"{ip} ansible_user=aic ansible_password={password} ansible_ssh_common_args='-o StrictHostKeyChecking=no' ansible_remote_tmp='C:\\Windows\\Temp' ansible_shell_type=cmd ansible_python_interpreter=none"
-    elif not windows:
-        inventory = f"{ip} ansible_user=aic ansible_ssh_private_key_file=./temp/id_rsa ansible_ssh_common_args='-o StrictHostKeyChecking=no'"
-    else:
-        raise ValueError(
-            "Create Inventory: This combination of arguments is not supported"
-        )
+    inventory = inventory_host(
+        os_name,
+        ip,
+        password=password,
+        powershell=powershell,
+        windows=windows,
+        port=port,
+    )
     with open(f"./temp/{os_name}.ini", "w") as ini:
         ini.write(inventory)
 
 
+def ansible_env(forks: int = 5) -> dict:
+    """
+    Get the environment variables used to tune ansible-playbook.
+
+    Args:
+        forks: Number of hosts ansible works on in parallel.
+
+    Returns:
+        Environment variables.
+    """
+    env = os.environ.copy()
+    env.update(
+        {
+            # one ssh operation per task instead of copying the module first
+            "ANSIBLE_PIPELINING": "True",
+            "ANSIBLE_FORKS": str(forks),
+            # only gather facts once per host and reuse them across playbook runs
+            "ANSIBLE_GATHERING": "smart",
+            "ANSIBLE_CACHE_PLUGIN": "jsonfile",
+            "ANSIBLE_CACHE_PLUGIN_CONNECTION": "./temp/ansible_facts",
+            "ANSIBLE_CACHE_PLUGIN_TIMEOUT": "86400",
+            "ANSIBLE_HOST_KEY_CHECKING": "False",
+        }
+    )
+    return env
+
+
+def extra_vars() -> str:
+    """
+    Get the extra vars arguments to pass to ansible-playbook.
+
+    Returns:
+        Arguments to append to the command.
+    """
+    # only exists when the artifact cache is enabled
+    if os.path.exists(artifacts.ARTIFACTS_VARS_FILE):
+        return f" -e @{artifacts.ARTIFACTS_VARS_FILE}"
+    return ""
+
+
 @log
 def download_remote_dependency(
     os_name: str,
@@ -47,6 +133,7 @@ def download_remote_dependency(
     ip: str,
     password: str | None = None,
     windows: bool = False,
+    port: int = 22,
 ) -> None:
     """
     Download remote dependencies using Ansible.
@@ -57,44 +144,198 @@ def download_remote_dependency(
         password: Password for the target machine (if applicable).
         windows: Whether the target machine is Windows.
         ip: IP address of the target machine.
+        port: SSH port of the target machine.
     """
     logger.info("Creating Ansible inventory...")
     create_ansible_inventory(
-        ip, os_name, logger=logger, password=password, windows=windows
+        ip, os_name, logger=logger, password=password, windows=windows, port=port
     )
-    if password and windows:
+    if windows:
+        # the playbook sets PowerShell as the default remote shell before installing the dependencies
         logger.info("Setting PowerShell as the default remote shell...")
-        cli.run(
-            f"ansible-playbook -i ./temp/{os_name}.ini ansible/windows/shell.yml",
-            logger=logger,
-            shell=True,
-            check=True,
-        )
-        create_ansible_inventory(
-            ip,
-            os_name,
-            logger=logger,
-            password=password,
-            powershell=True,
-            windows=windows,
-        )
-        logger.info("Downloading remote dependencies...")
-        cli.run(
-            f"ansible-playbook -i ./temp/{os_name}.ini ansible/windows/dependency.yml",
-            logger=logger,
-            shell=True,
-            check=True,
-        )
-    elif not windows:
-        # rsa path is in the ini file
-        logger.info("Downloading remote dependencies...")
-        cli.run(
-            f"ansible-playbook -i ./temp/{os_name}.ini ansible/linux/dependency.yml",
-            logger=logger,
-            shell=True,
-            check=True,
-        )
-    else:
-        raise ValueError(
-            "Download Dependency: This combination of arguments is not supported"
+    logger.info("Downloading remote dependencies...")
+    # key path is in the ini file
+    cli.run(
+        f"ansible-playbook -i ./temp/{os_name}.ini {PLAYBOOKS['windows' if windows else 'linux']}{extra_vars()}",
+        logger=logger,
+        shell=True,
+        check=True,
+        env=ansible_env(),
+    )
+
+
+def parse_recap(output: str) -> dict:
+    """
+    Parse the PLAY RECAP of an ansible-playbook run.
+
+    Args:
+        output: Stdout of ansible-playbook.
+
+    Returns:
+        Dictionary with the host name as key and whether it succeeded as value.
+    """
+    results = {}
+    # w help of chatgpt, a recap line looks like "host : ok=5 changed=3 unreachable=0 failed=0 ..."
+    pattern = r"^(\S+)\s+:\s+ok=\d+\s+changed=\d+\s+unreachable=(\d+)\s+failed=(\d+)"
+    for host, unreachable, failed in re.findall(pattern, output, re.MULTILINE):
+        # a host can appear in multiple recaps when a playbook contains multiple plays
+        results[host] = (
+            results.get(host, True) and unreachable == "0" and failed == "0"
         )
+    return results
+
+
+@log
+def provision_batch(hosts: list[dict], logger: Logger, forks: int = 20) -> dict:
+    """
+    Provision multiple VMs with one ansible-playbook run per OS family.
+
+    Args:
+        hosts: Hosts to provision, each with a name, ip, port, password and windows key.
+        logger: Logger instance for logging.
+        forks: Number of hosts ansible works on in parallel.
+
+    Returns:
+        Dictionary with the host name as key and None or the error as value.
+    """
+    results = {}
+    for family, playbook in PLAYBOOKS.items():
+        group = [host for host in hosts if host["windows"] == (family == "windows")]
+        if not group:
+            continue
+
+        inventory_path = f"./temp/batch-{family}-{time.monotonic_ns()}.ini"
+        with open(inventory_path, "w") as ini:
+            ini.write(
+                "\n".join(
+                    inventory_host(
+                        host["name"],
+                        host["ip"],
+                        password=host["password"],
+                        windows=host["windows"],
+                        port=host["port"],
+                    )
+                    for host in group
+                )
+            )
+
+        names = ", ".join(host["name"] for host in group)
+        logger.info(f"Provisioning {names} in one batch...")
+        try:
+            stdout, stderr = cli.run(
+                f"ansible-playbook -i {inventory_path} {playbook}{extra_vars()}",
+                logger=logger,
+                shell=True,
+                check=False,
+                capture_output=True,
+                env=ansible_env(forks),
+            )
+            recap = parse_recap(stdout)
+        except Exception as e:
+            logger.error(f"Batch provisioning failed: {e}")
+            recap = {}
+
+        for host in group:
+            if recap.get(host["name"]):
+                results[host["name"]] = None
+            else:
+                results[host["name"]] = (
+                    f"Ansible provisioning failed, check ansible-batch.log for {host['name']}"
+                )
+    return results
+
+
+def run_provisioning_batches(
+    requests: queue.Queue,
+    results: dict,
+    stop,
+    log_file: str,
+    log_level: str,
+    window: int,
+    forks: int,
+) -> None:
+    """
+    Provision the VMs as they become ready, grouping the requests arriving within a time window.
+
+    This runs in its own process so the playbooks are started from a main thread.
+
+    Args:
+        requests: Queue the workers put their host in.
+        results: Shared dictionary the results are reported in.
+        stop: Event set when no more requests will come.
+        log_file: Path to the log file.
+        log_level: Log level to print.
+        window: Seconds to wait for other VMs once a first one is ready.
+        forks: Number of hosts ansible works on in parallel.
+    """
+    # the workers handle the interrupts, we only need to stop the running playbook
+    cli.install_interrupt_handler()
+    logger = custom_logging.setup_logger(log_file, log_level, "ansible-batch")
+    while not stop.is_set():
+        try:
+            batch = [requests.get(timeout=1)]
+        except queue.Empty:
+            continue
+        deadline = time.monotonic() + window
+        while time.monotonic() < deadline:
+            try:
+                batch.append(requests.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        results.update(provision_batch(batch, logger=logger, forks=forks))
+
+
+@log
+def request_provisioning(
+    requests: queue.Queue,
+    results: dict,
+    name: str,
+    ip: str,
+    logger: Logger,
+    interrupt,
+    password: str | None = None,
+    windows: bool = False,
+    timeout: int = 3600,
+    port: int = 22,
+) -> None:
+    """
+    Ask the batch provisioner to install the remote dependencies and wait for the result.
+
+    Args:
+        requests: Queue of the batch provisioner.
+        results: Shared dictionary the results are reported in.
+        name: Unique name of the VM.
+        ip: IP address of the target machine.
+        logger: Logger instance for logging.
+        interrupt: Shared value across processes to handle interrupts.
+        password: Password for the target machine (if applicable).
+        windows: Whether the target machine is Windows.
+        timeout: Maximum time to wait for the result in seconds.
+        port: SSH port of the target machine.
+
+    Raises:
+        KeyboardInterrupt: If an interrupt is received while waiting.
+        TimeoutError: If the result did not arrive in time.
+        RuntimeError: If the provisioning failed.
+    """
+    logger.info("Waiting for batch provisioning...")
+    requests.put(
+        {
+            "name": name,
+            "ip": ip,
+            "port": port,
+            "password": password,
+            "windows": windows,
+        }
+    )
+    deadline = time.monotonic() + timeout
+    while name not in results:
+        if interrupt.value:
+            raise KeyboardInterrupt("Interrupted while waiting for provisioning.")
+        if time.monotonic() > deadline:
+            raise TimeoutError("Batch provisioning did not finish in time.")
+        time.sleep(1)
+    error = results.pop(name)
+    if error:
+        raise RuntimeError(error)
+    logger.info("Remote dependencies downloaded by batch provisioning.")
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.request
+from logging import Logger
+
+from .custom_logging import log
+
+# files the playbooks would otherwise download on every VM
+# name is the variable the playbooks use, windows tells if only windows VMs need it
+ARTIFACTS = {
+    "jenkins_debian_key": (
+        "https://pkg.jenkins.io/debian-stable/jenkins.io-2023.key",
+        False,
+    ),
+    "jenkins_redhat_repo": ("https://pkg.jenkins.io/redhat-stable/jenkins.repo", False),
+    "jenkins_redhat_key": (
+        "https://pkg.jenkins.io/redhat-stable/jenkins.io-2023.key",
+        False,
+    ),
+    "java_windows_msi": (
+        "https://download.oracle.com/java/21/latest/jdk-21_windows-x64_bin.msi",
+        True,
+    ),
+    "jenkins_windows_msi": (
+        "https://get.jenkins.io/windows-stable/2.492.1/jenkins.msi",
+        True,
+    ),
+}
+
+# file the ansible extra vars are written to
+ARTIFACTS_VARS_FILE = "./temp/artifacts.json"
+
+
+def artifact_path(url: str, cache_dir: str) -> str:
+    """
+    Get the path an artifact is cached at.
+
+    Args:
+        url: URL of the artifact.
+        cache_dir: Directory of the artifact cache.
+
+    Returns:
+        Path of the cached artifact.
+    """
+    # the url contains the version so a new version is a new cache entry
+    digest = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{digest}-{os.path.basename(url)}")
+
+
+@log
+def fetch_artifact(
+    url: str,
+    cache_dir: str,
+    logger: Logger,
+    max_age: int = 7 * 24 * 3600,
+    max_retries: int = 3,
+    delay: int = 10,
+) -> str:
+    """
+    Download an artifact to the cache if it is not already there.
+
+    Args:
+        url: URL of the artifact.
+        cache_dir: Directory of the artifact cache.
+        logger: Logger instance for logging.
+        max_age: Seconds after which an unversioned ("latest") artifact is downloaded again.
+        max_retries: Maximum number of download attempts.
+        delay: Delay between download attempts in seconds.
+
+    Returns:
+        Path of the cached artifact.
+
+    Raises:
+        Exception: If the download fails after the maximum number of attempts.
+    """
+    path = artifact_path(url, cache_dir)
+    if os.path.exists(path):
+        if "latest" not in url or time.time() - os.path.getmtime(path) < max_age:
+            logger.debug(f"Using cached {url}")
+            return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for attempt in range(1, max_retries + 1):
+        try:
+            logger.info(f"Downloading {url} to the artifact cache...")
+            # download next to the final file and rename it so a partial download is never used
+            with urllib.request.urlopen(url, timeout=60) as response:
+                with open(f"{path}.part", "wb") as file:
+                    shutil.copyfileobj(response, file)
+            os.replace(f"{path}.part", path)
+            return path
+        except Exception as e:
+            if attempt >= max_retries:
+                raise Exception(
+                    f"Failed to download {url} after {max_retries} attempts: {str(e)}"
+                )
+            logger.warning(
+                f"Download attempt {attempt} failed, waiting {delay} seconds..."
+            )
+            time.sleep(delay)
+
+
+@log
+def populate_artifact_cache(
+    cache_dir: str, os_names: list[str], logger: Logger
+) -> dict:
+    """
+    Make sure all artifacts needed by the OS list are cached and point the playbooks to them.
+
+    Args:
+        cache_dir: Directory of the artifact cache.
+        os_names: Operating systems that will be provisioned.
+        logger: Logger instance for logging.
+
+    Returns:
+        Dictionary with the artifact name as key and its local path as value.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    has_windows = any("windows" in os_name.lower() for os_name in os_names)
+    has_linux = any("windows" not in os_name.lower() for os_name in os_names)
+
+    artifacts = {}
+    for name, (url, windows) in ARTIFACTS.items():
+        if (windows and has_windows) or (not windows and has_linux):
+            artifacts[name] = os.path.abspath(
+                fetch_artifact(url, cache_dir, logger=logger)
+            )
+
+    # the playbooks copy the files from the controller when this variable is defined
+    with open(ARTIFACTS_VARS_FILE, "w") as file:
+        json.dump({"artifacts": artifacts}, file, indent=4)
+    logger.debug(f"Artifact cache ready: {artifacts}")
+    return artifacts
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import time
+from logging import Logger
+
+from . import plan
+from .custom_logging import log
+
+# bump when what goes into the key changes so old results are not reused
+CACHE_VERSION = 1
+
+# directories and files that change without changing what is tested
+IGNORED_NAMES = {".git", "__pycache__", ".terraform", ".terraform.lock.hcl"}
+IGNORED_SUFFIXES = (".tfstate", ".tfstate.backup")
+
+
+def hash_tree(path: str) -> str:
+    """
+    Hash the names and contents of all the files in a directory.
+
+    Args:
+        path: Directory or single file to hash.
+
+    Returns:
+        Hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        with open(path, "rb") as file:
+            digest.update(hashlib.file_digest(file, "sha256").digest())
+        return digest.hexdigest()
+
+    for root, dirs, files in os.walk(path):
+        # sorted so the order of the directory listing does not change the hash
+        dirs[:] = sorted(name for name in dirs if name not in IGNORED_NAMES)
+        for name in sorted(files):
+            if name in IGNORED_NAMES or name.endswith(IGNORED_SUFFIXES):
+                continue
+            file_path = os.path.join(root, name)
+            # the path is part of the hash so renaming a file is a change too
+            digest.update(os.path.relpath(file_path, path).encode() + b"\0")
+            with open(file_path, "rb") as file:
+                digest.update(hashlib.file_digest(file, "sha256").digest())
+    return digest.hexdigest()
+
+
+def content_hashes(cfg: dict, terraform_dir: str) -> dict:
+    """
+    Hash everything a deployment depends on, except the OS itself.
+
+    Args:
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing the Terraform templates of the platform.
+
+    Returns:
+        Dictionary with the name of each input as key and its hash as value.
+    """
+    return {
+        # the jenkins and plugin files are in the project root but are hashed on their own to be explicit
+        "project": hash_tree(cfg["project_root"]),
+        "jenkins_file": hash_tree(os.path.join(cfg["project_root"], cfg["jenkins_file"])),
+        "plugin_file": hash_tree(os.path.join(cfg["project_root"], cfg["plugin_file"])),
+        "ansible": hash_tree("./ansible"),
+        "approve_scripts": hash_tree("./modules/approve-scripts.groovy"),
+        "terraform_linux": hash_tree(f"{terraform_dir}/linux"),
+        "terraform_windows": hash_tree(f"{terraform_dir}/windows"),
+    }
+
+
+def result_key(os_name: str, cfg: dict, hashes: dict) -> str:
+    """
+    Get the key of the result of a deployment.
+
+    Args:
+        os_name: Name of the operating system.
+        cfg: Configuration dictionary.
+        hashes: Hashes of the inputs made by content_hashes.
+
+    Returns:
+        Hex digest identifying the deployment.
+    """
+    template = "windows" if plan.os_category(os_name) == "windows" else "linux"
+    inputs = {
+        "version": CACHE_VERSION,
+        "os": os_name,
+        "platform": cfg["platform"],
+        "vm_size": plan.get_vm_size(os_name, cfg),
+        # the template of the other family does not change the result
+        **{
+            name: value
+            for name, value in hashes.items()
+            if not name.startswith("terraform_") or name == f"terraform_{template}"
+        },
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+@log
+def find_cached_results(
+    os_names: list[str], cfg: dict, terraform_dir: str, logger: Logger
+) -> tuple[dict, list[str]]:
+    """
+    Get the key of each deployment and the deployments that already succeeded with the same inputs.
+
+    Args:
+        os_names: Names of the operating systems.
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing the Terraform templates of the platform.
+        logger: Logger instance for logging.
+
+    Returns:
+        Dictionary with the OS name as key and its result key as value, and the OS names with a cached success.
+    """
+    hashes = content_hashes(cfg, terraform_dir)
+    logger.debug(f"Content hashes: {hashes}")
+    results_dir = os.path.join(os.path.expanduser(cfg["cache_dir"]), "results")
+    keys = {os_name: result_key(os_name, cfg, hashes) for os_name in os_names}
+    cached = [
+        os_name
+        for os_name, key in keys.items()
+        if os.path.exists(os.path.join(results_dir, f"{key}.json"))
+    ]
+    return keys, cached
+
+
+@log
+def store_result(cache_dir: str, os_name: str, key: str, logger: Logger) -> None:
+    """
+    Remember that a deployment succeeded so the next runs with the same inputs can skip it.
+
+    Args:
+        cache_dir: Directory AIC stores data reused across runs in.
+        os_name: Name of the operating system.
+        key: Result key made by result_key.
+        logger: Logger instance for logging.
+    """
+    results_dir = os.path.join(os.path.expanduser(cache_dir), "results")
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{key}.json")
+    with open(f"{path}.tmp", "w") as file:
+        json.dump({"os": os_name, "succeeded_at": time.time()}, file, indent=4)
+    os.replace(f"{path}.tmp", path)
+    logger.debug(f"Result of {os_name} cached as {key}.")
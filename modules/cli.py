@@ -1,14 +1,158 @@
+import codecs
+import collections
+import os
+import selectors
 import shutil
 import signal
 import subprocess
 import sys
 import threading
+from collections.abc import Callable
 from logging import Logger
 
 from .custom_logging import log
 
 
-# w help of chatgpt for signal, subprocess, threading
+# interrupt policies of the running subprocesses
+# only the first keyboard interrupt is passed to the subprocess
+PASS_FIRST = "pass_first"
+# all keyboard interrupts are ignored
+IGNORE_ALL = "ignore_all"
+# the subprocess is terminated
+TERMINATE = "terminate"
+
+# subprocesses started by run in this process with their interrupt policy, shared by all threads
+_processes = {}
+# reentrant as the signal handler runs in the main thread which may already hold it
+_processes_lock = threading.RLock()
+# called on keyboard interrupts while no subprocess is running
+_fallback_handler = None
+
+
+def _dispatch_interrupt(signum, frame) -> None:
+    """
+    Apply the interrupt policy of every running subprocess, or call the fallback handler if none is running.
+
+    Args:
+        signum: Signal number.
+        frame: Current stack frame.
+    """
+    if not interrupt_processes() and _fallback_handler:
+        _fallback_handler()
+
+
+def interrupt_processes() -> bool:
+    """
+    Apply the interrupt policy of every subprocess started by run in this process, as if a keyboard interrupt was received.
+
+    Returns:
+        Whether a subprocess was running.
+    """
+    with _processes_lock:
+        processes = list(_processes.items())
+
+    for proc, entry in processes:
+        logger = entry["logger"]
+        if entry["policy"] == IGNORE_ALL:
+            logger.info("Keyboard interrupts ignored.")
+        elif entry["policy"] == PASS_FIRST:
+            if not entry["interrupted"]:
+                logger.info("First Ctrl+C received, passing to subprocess...")
+                entry["interrupted"] = True
+                _signal_group(proc, signal.SIGINT)
+            else:
+                logger.info("Subsequent Ctrl+C ignored.")
+        else:
+            logger.info("Keyboard interrupt received, terminating subprocess...")
+            _signal_group(proc, signal.SIGTERM)
+    return bool(processes)
+
+
+def _signal_group(proc: subprocess.Popen, signum: int) -> None:
+    """
+    Send a signal to a subprocess and its children.
+
+    Args:
+        proc: Subprocess started in its own session by run.
+        signum: Signal to send.
+    """
+    # commands run through a shell, signaling only the shell would not reach the actual command
+    try:
+        os.killpg(proc.pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def install_interrupt_handler(fallback: Callable[[], None] | None = None) -> None:
+    """
+    Install the process wide keyboard interrupt handler, this has to be called from the main thread.
+
+    Args:
+        fallback: Function called on keyboard interrupts while no subprocess is running.
+    """
+    global _fallback_handler
+    _fallback_handler = fallback
+    signal.signal(signal.SIGINT, _dispatch_interrupt)
+
+
+@log
+def _ensure_interrupt_handler(logger: Logger) -> None:
+    """
+    Install the keyboard interrupt handler if it is not already, keeping the current handler as fallback.
+
+    Args:
+        logger: Logger instance for logging.
+    """
+    if signal.getsignal(signal.SIGINT) is _dispatch_interrupt:
+        return
+    # signal handlers can only be set from the main thread
+    if threading.current_thread() is not threading.main_thread():
+        logger.warning(
+            "Interrupt handler not installed, keyboard interrupts will not be forwarded to subprocesses."
+        )
+        return
+    previous = signal.getsignal(signal.SIGINT)
+    if callable(previous):
+        install_interrupt_handler(lambda: previous(signal.SIGINT, None))
+    else:
+        install_interrupt_handler()
+    logger.debug("Signal handler set.")
+
+
+class _OutputBuffer:
+    """
+    Keep the output of a stream, optionally only the last characters of it.
+    """
+
+    def __init__(self, max_size: int | None) -> None:
+        """
+        Initialize the buffer.
+
+        Args:
+            max_size: Maximum number of characters to keep, None to keep everything.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.lines = collections.deque()
+
+    def append(self, line: str) -> None:
+        """
+        Add a line to the buffer, dropping the oldest lines when it is full.
+
+        Args:
+            line: Line to add.
+        """
+        self.lines.append(line)
+        self.size += len(line)
+        while self.max_size is not None and self.size > self.max_size:
+            self.size -= len(self.lines.popleft())
+
+    def __str__(self) -> str:
+        return "".join(self.lines)
+
+
+# w help of chatgpt for signal, subprocess, selectors
+# thread safe, keyboard interrupts are handled by a single process wide handler
 @log
 def run(
     *args,
@@ -18,117 +162,121 @@ def run(
     env: dict | None = None,
     text=True,
     check=True,
+    capture_output: bool = False,
+    max_output: int = 64 * 1024,
+    on_line: Callable[[str, bool], None] | None = None,
     **kwargs,
 ) -> tuple:
     """
     Run a command in a subprocess, with options to handle keyboard interrupts.
 
+    Both pipes are read in a single loop, the output is logged and printed line by line as it arrives.
+
     Args:
         *args: Command and arguments to execute.
         logger: Logger instance for logging messages.
         ignore_interrupts: If True, only the first keyboard interrupt is passed to the subprocess. Defaults to False.
         ignore_all_interrupts: If True, all keyboard interrupts are ignored. Defaults to False.
         env: Environment variables to set for the subprocess. Defaults to None.
-        text: If True, the output will be treated as text. Defaults to True.
+        text: Kept for compatibility, the output is always decoded as text. Defaults to True.
         check: If True, an exception is raised if the subprocess exits with a non-zero status. Defaults to True.
+        capture_output: If True, the whole output is returned, else only the last `max_output` characters of each stream. Defaults to False.
+        max_output: Number of characters kept per stream when `capture_output` is False. Defaults to 64 KiB.
+        on_line: Optional callback called with each line and whether it comes from stderr.
         **kwargs: Additional keyword arguments passed to subprocess.Popen.
 
     Returns:
-        subprocess.CompletedProcess: The completed process, including stdout and stderr.
+        Stdout and stderr of the command.
 
     Raises:
         KeyboardInterrupt: If the command is interrupted by a keyboard signal and `check` is True.
         subprocess.CalledProcessError: If the subprocess exits with a non-zero status and `check` is True.
     """
     if ignore_all_interrupts:
+        policy = IGNORE_ALL
         logger.info("Executing critical command, ignoring all keyboard interrupts...")
     elif ignore_interrupts:
+        policy = PASS_FIRST
         logger.info("Executing a command, only passing the first keyboard interrupt...")
+    else:
+        policy = TERMINATE
 
-    @log
-    def handler(logger):
-        """
-        Handles keyboard interrupts during the execution of a subprocess.
-
-        Args:
-            _: Placeholder for signum.
-            __: Placeholder for frame.
-        """
-        if ignore_all_interrupts:
-            logger.info("Keyboard interrupts ignored.")
-        elif ignore_interrupts:
-            # nonlocal is needed to modify the variable in the outer scope but not in the global scope
-            nonlocal first_interrupt
-            if first_interrupt:
-                logger.info("First Ctrl+C received, passing to subprocess...")
-                first_interrupt = False
-                proc.send_signal(signal.SIGINT)
-            else:
-                logger.info("Subsequent Ctrl+C ignored.")
-        else:
-            logger.info("Keyboard interrupt received, terminating subprocess...")
-            proc.terminate()
-
-    first_interrupt = True
-    old_handler = signal.signal(
-        signal.SIGINT, lambda signum, frame: handler(logger=logger)
-    )
-    logger.debug("Signal handler set.")
+    _ensure_interrupt_handler(logger=logger)
+    proc = None
 
     try:
         proc = subprocess.Popen(
             *args,
             # shell=shell,
-            text=text,
             **kwargs,
             env=env,
             # Use stdout and stderr as the current terminal output
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            # immediately view the output
-            bufsize=1,
-            universal_newlines=True,
             # separate sessions to prevent the command itself from handling the interrupt
             start_new_session=True,
         )
+        with _processes_lock:
+            _processes[proc] = {"policy": policy, "interrupted": False, "logger": logger}
         logger.debug("Subprocess started.")
 
-        stdout_lines = []
-        stderr_lines = []
-
-        @log
-        def log_stream(pipe, log_level, stream, accumulator, logger: Logger):
-            for line in iter(pipe.readline, ""):
-                if line:
-                    logger.log(log_level, line.rstrip())
-                    stream.write(line)
-                    stream.flush()
-                    accumulator.append(line)  # Store the output
-
-            pipe.close()
-
-        # Create threads to concurrently capture stdout and stderr
-        stdout_thread = threading.Thread(
-            target=log_stream,
-            args=(proc.stdout, logger.level, sys.stdout, stdout_lines),
-            kwargs={"logger": logger},
-        )
-        stderr_thread = threading.Thread(
-            target=log_stream,
-            args=(proc.stderr, getattr(logger, "ERROR", 40), sys.stderr, stderr_lines),
-            kwargs={"logger": logger},
-        )
-        stdout_thread.start()
-        stderr_thread.start()
-        logger.debug("Output capture threads started.")
+        max_size = None if capture_output else max_output
+        stdout = _OutputBuffer(max_size)
+        stderr = _OutputBuffer(max_size)
+
+        # one loop reads both pipes as soon as data is available
+        selector = selectors.DefaultSelector()
+        for pipe, is_stderr, log_level, stream, buffer in (
+            (proc.stdout, False, logger.level, sys.stdout, stdout),
+            (proc.stderr, True, getattr(logger, "ERROR", 40), sys.stderr, stderr),
+        ):
+            selector.register(
+                pipe,
+                selectors.EVENT_READ,
+                {
+                    "is_stderr": is_stderr,
+                    "log_level": log_level,
+                    "stream": stream,
+                    "buffer": buffer,
+                    "decoder": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+                    "pending": "",
+                },
+            )
+
+        def handle_line(line: str, data: dict) -> None:
+            # same as universal newlines
+            line = line.replace("\r\n", "\n")
+            logger.log(data["log_level"], line.rstrip())
+            data["stream"].write(line)
+            data["stream"].flush()
+            data["buffer"].append(line)
+            if on_line:
+                on_line(line, data["is_stderr"])
+
+        logger.debug("Reading subprocess output.")
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = key.data
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    # end of the stream, flush what is left without a newline
+                    data["pending"] += data["decoder"].decode(b"", final=True)
+                    if data["pending"]:
+                        handle_line(data["pending"], data)
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                data["pending"] += data["decoder"].decode(chunk)
+                *lines, data["pending"] = data["pending"].split("\n")
+                for line in lines:
+                    handle_line(f"{line}\n", data)
+        selector.close()
 
         proc.wait()
-        stdout_thread.join()
-        stderr_thread.join()
-        logger.debug("Subprocess and output capture threads completed.")
+        logger.debug("Subprocess completed.")
 
-        stdout = "".join(stdout_lines)
-        stderr = "".join(stderr_lines)
+        stdout = str(stdout)
+        stderr = str(stderr)
 
         # Raise exception if the process did not exit successfully
         if check and proc.returncode != 0:
@@ -146,8 +294,10 @@ def run(
 
         return stdout, stderr
     finally:
+        if proc is not None:
+            with _processes_lock:
+                _processes.pop(proc, None)
         if ignore_all_interrupts or ignore_interrupts:
-            signal.signal(signal.SIGINT, old_handler)
             logger.info("Command executed, keyboard interrupts restored.")
 
 
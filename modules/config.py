@@ -1,3 +1,4 @@
+import json
 import os
 from logging import Logger
 
@@ -24,11 +25,6 @@ def load_config(path: str = "aic.yml") -> dict:
 
     required_keys = [
         "platform",
-        "subscription_id",
-        "tenant_id",
-        "appId",
-        "client_secret",
-        "region",
         "vm_size",
         "arm_vm_size",
         "max_threads",
@@ -41,9 +37,50 @@ def load_config(path: str = "aic.yml") -> dict:
         "log_level",
     ]
 
+    # only needed to create the vms on azure
+    azure_keys = [
+        "subscription_id",
+        "tenant_id",
+        "appId",
+        "client_secret",
+        "region",
+    ]
+    if config_dict.get("platform") == "azure":
+        required_keys += azure_keys
+
     for key in required_keys:
         if key not in config_dict:
             raise ValueError(f"Missing required configuration key: {key}")
+    for key in azure_keys:
+        config_dict.setdefault(key, None)
+
+    # optional keys and their default value
+    optional_keys = {
+        "ansible_batch_window": 0,
+        "ansible_forks": 20,
+        "cache_dir": "~/.aic_cache",
+        "artifact_cache": False,
+        "ssh_key_type": "ed25519",
+        "ssh_key_max_age": 30,
+        "max_failures": 0,
+        "canary": False,
+        "shards": {},
+        "local_hosts": {},
+        "top_processes": 0,
+        "process_groups": {},
+        "sweep_sizes": [],
+        "sweep_arm_sizes": [],
+        "sweep_max_duration": 0,
+        "sweep_max_cpu": 100,
+        "sweep_max_ram": 100,
+        "prices": {},
+        "benchmark_iterations": 5,
+        "benchmark_warmup": 0,
+        "compress_logs": True,
+    }
+    for key, default in optional_keys.items():
+        if config_dict.get(key) is None:
+            config_dict[key] = default
 
     if (
         not isinstance(config_dict["max_threads"], int)
@@ -56,16 +93,10 @@ def load_config(path: str = "aic.yml") -> dict:
     ):
         raise ValueError("os must be a list of strings.")
 
-    if not isinstance(config_dict["subscription_id"], str):
-        raise ValueError("subscription_id must be a string.")
-    if not isinstance(config_dict["appId"], str):
-        raise ValueError("appId must be a string.")
-    if not isinstance(config_dict["client_secret"], str):
-        raise ValueError("client_secret must be a string.")
-    if not isinstance(config_dict["tenant_id"], str):
-        raise ValueError("tenant_id must be a string.")
-    if not isinstance(config_dict["region"], str):
-        raise ValueError("region must be a string.")
+    if config_dict["platform"] == "azure":
+        for key in azure_keys:
+            if not isinstance(config_dict[key], str):
+                raise ValueError(f"{key} must be a string.")
     if not isinstance(config_dict["vm_size"], str):
         raise ValueError("vm_size must be a string.")
     if not isinstance(config_dict["arm_vm_size"], str):
@@ -74,8 +105,101 @@ def load_config(path: str = "aic.yml") -> dict:
         raise ValueError("rg_prefix must be a string.")
     if not isinstance(config_dict["log_dir"], str):
         raise ValueError("log_dir must be a string.")
+    if (
+        not isinstance(config_dict["ansible_batch_window"], int)
+        or config_dict["ansible_batch_window"] < 0
+    ):
+        raise ValueError("ansible_batch_window must be a positive integer.")
+    if (
+        not isinstance(config_dict["ansible_forks"], int)
+        or config_dict["ansible_forks"] < 1
+    ):
+        raise ValueError("ansible_forks must be an integer greater than 0.")
+    if not isinstance(config_dict["cache_dir"], str):
+        raise ValueError("cache_dir must be a string.")
+    if not isinstance(config_dict["artifact_cache"], bool):
+        raise ValueError("artifact_cache must be a boolean.")
+    if config_dict["ssh_key_type"] not in ["ed25519", "rsa"]:
+        raise ValueError("ssh_key_type must be ed25519 or rsa.")
+    if (
+        not isinstance(config_dict["ssh_key_max_age"], int)
+        or config_dict["ssh_key_max_age"] < 0
+    ):
+        raise ValueError("ssh_key_max_age must be a positive integer.")
+    if (
+        not isinstance(config_dict["max_failures"], int)
+        or isinstance(config_dict["max_failures"], bool)
+        or config_dict["max_failures"] < 0
+    ):
+        raise ValueError("max_failures must be a positive integer.")
+    if not isinstance(config_dict["canary"], bool):
+        raise ValueError("canary must be a boolean.")
+    if not isinstance(config_dict["compress_logs"], bool):
+        raise ValueError("compress_logs must be a boolean.")
+    if not isinstance(config_dict["shards"], dict) or not all(
+        isinstance(count, int) and not isinstance(count, bool) and count >= 1
+        for count in config_dict["shards"].values()
+    ):
+        raise ValueError(
+            "shards must be a dictionary with the OS as key and an integer greater than 0 as value."
+        )
 
-    supported_platforms = ["azure"]
+    if not isinstance(config_dict["local_hosts"], dict) or not all(
+        isinstance(address, str) for address in config_dict["local_hosts"].values()
+    ):
+        raise ValueError(
+            "local_hosts must be a dictionary with the OS as key and an ip:port string as value."
+        )
+
+    if (
+        not isinstance(config_dict["top_processes"], int)
+        or isinstance(config_dict["top_processes"], bool)
+        or config_dict["top_processes"] < 0
+    ):
+        raise ValueError("top_processes must be a positive integer.")
+    if not isinstance(config_dict["process_groups"], dict) or not all(
+        isinstance(patterns, list) and all(isinstance(item, str) for item in patterns)
+        for patterns in config_dict["process_groups"].values()
+    ):
+        raise ValueError(
+            "process_groups must be a dictionary with the group name as key and a list of process names as value."
+        )
+
+    for key in ["sweep_sizes", "sweep_arm_sizes"]:
+        if not isinstance(config_dict[key], list) or not all(
+            isinstance(item, str) for item in config_dict[key]
+        ):
+            raise ValueError(f"{key} must be a list of strings.")
+    if (
+        not isinstance(config_dict["sweep_max_duration"], int)
+        or isinstance(config_dict["sweep_max_duration"], bool)
+        or config_dict["sweep_max_duration"] < 0
+    ):
+        raise ValueError("sweep_max_duration must be a positive integer.")
+    for key in ["sweep_max_cpu", "sweep_max_ram"]:
+        if (
+            not isinstance(config_dict[key], (int, float))
+            or isinstance(config_dict[key], bool)
+            or not 0 < config_dict[key] <= 100
+        ):
+            raise ValueError(f"{key} must be a percentage between 0 and 100.")
+    if not isinstance(config_dict["prices"], dict) or not all(
+        isinstance(price, (int, float)) and not isinstance(price, bool) and price >= 0
+        for price in config_dict["prices"].values()
+    ):
+        raise ValueError(
+            "prices must be a dictionary with the VM size as key and its price per hour as value."
+        )
+
+    for key, minimum in [("benchmark_iterations", 1), ("benchmark_warmup", 0)]:
+        if (
+            not isinstance(config_dict[key], int)
+            or isinstance(config_dict[key], bool)
+            or config_dict[key] < minimum
+        ):
+            raise ValueError(f"{key} must be an integer of at least {minimum}.")
+
+    supported_platforms = ["azure", "local"]
     if config_dict["platform"] not in supported_platforms:
         raise ValueError(
             f"Unsupported platform: {config_dict['platform']}. Supported platforms are: {', '.join(supported_platforms)}."
@@ -118,6 +242,21 @@ def load_config(path: str = "aic.yml") -> dict:
     for os_item in config_dict["os"]:
         if os_item not in os_list:
             raise ValueError(f"Invalid os: {os_item}")
+    for os_item in config_dict["shards"]:
+        if os_item not in config_dict["os"]:
+            raise ValueError(f"Sharded os is not in the os list: {os_item}")
+
+    if config_dict["platform"] == "local":
+        for os_item in config_dict["os"]:
+            shard_names = [
+                f"{os_item}-shard{index}"
+                for index in range(config_dict["shards"].get(os_item, 1))
+            ]
+            # shards use their own endpoint if they have one, else the one of their os
+            if os_item not in config_dict["local_hosts"] and not all(
+                name in config_dict["local_hosts"] for name in shard_names
+            ):
+                raise ValueError(f"Missing local_hosts entry for os: {os_item}")
 
     log_levels = ["debug", "info", "warning", "error", "critical"]
     if config_dict["log_level"].lower() not in log_levels:
@@ -145,8 +284,12 @@ def setup_terraform_vars(config: dict, logger: Logger) -> None:
         "TF_VAR_region": config["region"],
         "TF_VAR_vm_size": config["vm_size"],
         "TF_VAR_arm_vm_size": config["arm_vm_size"],
-        "TF_VAR_ssh_public_key_path": "../../../temp/id_rsa.pub",
+        "TF_VAR_ssh_public_key_path": "../../../temp/aic_key.pub",
+        # terraform reads complex variables as hcl, which json is valid syntax of
+        "TF_VAR_hosts": json.dumps(config["local_hosts"]),
     }
+    # the azure settings are not set on other platforms
+    env_vars = {key: value for key, value in env_vars.items() if value is not None}
 
     for key, value in env_vars.items():
         logger.debug(f"Setting environment variable {key} = {value}")
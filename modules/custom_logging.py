@@ -1,10 +1,26 @@
 import functools
+import gzip
+import json
 import logging
 import os
+import re
 import sys
 from datetime import datetime
 from logging import Logger
 
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+# start of a record in the log files, the lines that do not match are the rest of a multiline message
+RECORD_PATTERN = re.compile(
+    r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) (DEBUG|INFO|WARNING|ERROR|CRITICAL): "
+)
+
+# lines compressed together, a search only decompresses the chunks that can match
+CHUNK_LINES = 2000
+
+# file in the folder of a finished run listing the chunks of its logs
+INDEX_FILE = "index.json"
+
 
 def log(func):
     """
@@ -29,16 +45,16 @@ def setup_logger(
     log_file: str,
     log_level: str,
     logger_name: str | None = None,
-    secondary_log_file: str | None = None,
 ) -> logging.Logger:
     """
     Set up a logger with specified file and log level.
 
+    Each record is only written to its own file, the files are merged back by time when searching them.
+
     Args:
         log_file: Path to the log file.
         log_level: Logging level (e.g., 'DEBUG', 'INFO').
         logger_name: Optional name for the logger.
-        secondary_log_file: Optional path to a secondary log file.
 
     Returns:
         Configured logger instance.
@@ -57,20 +73,13 @@ def setup_logger(
     # file output
     file_handler = logging.FileHandler(log_file)
     file_handler.setLevel(logging.DEBUG)
-    if secondary_log_file:
-        secondary_file_handler = logging.FileHandler(secondary_log_file)
-        secondary_file_handler.setLevel(logging.DEBUG)
 
-    formatter = logging.Formatter("%(levelname)s: %(message)s")
-    stream_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
-    if secondary_log_file:
-        secondary_file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    # the time orders the records of the different files of a run
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
 
     logger.addHandler(stream_handler)
     logger.addHandler(file_handler)
-    if secondary_log_file:
-        logger.addHandler(secondary_file_handler)
     return logger
 
 
@@ -91,3 +100,215 @@ def create_log_folder(base_dir: str) -> str:
     os.makedirs(log_folder, exist_ok=True)
     print(f"Created log folder: {log_folder}")
     return log_folder
+
+
+def parse_records(lines: list[str]) -> list[tuple[str | None, str | None, str]]:
+    """
+    Group the lines of a log file by record.
+
+    Args:
+        lines: Lines of the log file, with their line break.
+
+    Returns:
+        Time, level and text of each record, the time and level are None for lines written before the first record.
+    """
+    records = []
+    for line in lines:
+        match = RECORD_PATTERN.match(line)
+        if match:
+            records.append((match.group(1), match.group(2), line))
+        elif records:
+            records[-1] = (*records[-1][:2], records[-1][2] + line)
+        else:
+            records.append((None, None, line))
+    return records
+
+
+def archive_run(run_dir: str) -> None:
+    """
+    Compress the log files of a finished run and index them.
+
+    Each file is replaced by a gzip file made of independent members of about CHUNK_LINES lines, it can still be
+    read as a whole with zcat while a search can decompress a single member.
+
+    Args:
+        run_dir: Log folder of the run.
+    """
+    index = {"run": os.path.basename(run_dir), "files": []}
+    for root, _, files in os.walk(run_dir):
+        for name in sorted(files):
+            if not name.endswith(".log"):
+                continue
+            path = os.path.join(root, name)
+            with open(path, errors="replace") as file:
+                records = parse_records(file.readlines())
+
+            chunks = []
+            with open(f"{path}.gz", "wb") as file:
+                start = 0
+                while start < len(records):
+                    # chunks end on a record so a multiline message is never split
+                    end, lines = start, 0
+                    while end < len(records) and (lines < CHUNK_LINES or end == start):
+                        lines += records[end][2].count("\n") or 1
+                        end += 1
+                    chunk = records[start:end]
+                    data = gzip.compress("".join(text for _, _, text in chunk).encode())
+                    times = [time for time, _, _ in chunk if time]
+                    chunks.append(
+                        {
+                            "offset": file.tell(),
+                            "size": len(data),
+                            "start": times[0] if times else None,
+                            "end": times[-1] if times else None,
+                            "levels": {
+                                level: count
+                                for level in LEVELS
+                                if (count := sum(record[1] == level for record in chunk))
+                            },
+                        }
+                    )
+                    file.write(data)
+                    start = end
+            os.remove(path)
+
+            # run level files have no os, the shards and sizes of an os are in its subfolders
+            parts = os.path.relpath(path, run_dir).split(os.sep)
+            index["files"].append(
+                {
+                    "path": os.path.relpath(f"{path}.gz", run_dir),
+                    "os": parts[0] if len(parts) > 1 else None,
+                    "part": "/".join(parts[1:-1]) or None,
+                    "stage": name.removesuffix(".log"),
+                    "chunks": chunks,
+                }
+            )
+
+    with open(os.path.join(run_dir, f"{INDEX_FILE}.tmp"), "w") as file:
+        json.dump(index, file, indent=4)
+    os.replace(os.path.join(run_dir, f"{INDEX_FILE}.tmp"), os.path.join(run_dir, INDEX_FILE))
+
+
+def _index_plain_run(run_dir: str) -> dict:
+    """
+    Index the log files of a run that is still running or did not finish, they are read whole.
+
+    Args:
+        run_dir: Log folder of the run.
+
+    Returns:
+        Index in the format of archive_run, with a single chunk per file and no offset.
+    """
+    index = {"run": os.path.basename(run_dir), "files": []}
+    for root, _, files in os.walk(run_dir):
+        for name in sorted(files):
+            if not name.endswith(".log"):
+                continue
+            parts = os.path.relpath(os.path.join(root, name), run_dir).split(os.sep)
+            index["files"].append(
+                {
+                    "path": os.path.relpath(os.path.join(root, name), run_dir),
+                    "os": parts[0] if len(parts) > 1 else None,
+                    "part": "/".join(parts[1:-1]) or None,
+                    "stage": name.removesuffix(".log"),
+                    # unknown levels, the chunk is always read
+                    "chunks": [{"offset": None, "levels": None}],
+                }
+            )
+    return index
+
+
+def search_logs(
+    base_dir: str,
+    pattern: str | None = None,
+    runs: list[str] | None = None,
+    last: int | None = None,
+    os_name: str | None = None,
+    stage: str | None = None,
+    level: str | None = None,
+    ignore_case: bool = False,
+) -> list[tuple[str, str, str]]:
+    """
+    Search the records of past runs, only the chunks of the files matching the filters are decompressed.
+
+    Args:
+        base_dir: Directory containing the log folders of the runs.
+        pattern: Regular expression the records must contain, None for every record.
+        runs: Names of the runs to search, None for every run.
+        last: Number of most recent runs to search, None for every run.
+        os_name: OS the records must come from.
+        stage: Log file the records must come from (main, terraform, ansible, jenkins, metrics...).
+        level: Minimum level of the records.
+        ignore_case: Whether the pattern is case insensitive.
+
+    Returns:
+        Run, location (OS, shard or size and stage) and text of each record, ordered by run then time.
+    """
+    base_dir = os.path.expanduser(base_dir)
+    if not os.path.isdir(base_dir):
+        return []
+    # the folders are named after their start time so they sort chronologically
+    run_names = sorted(
+        name for name in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, name))
+    )
+    if runs:
+        run_names = [name for name in run_names if name in runs]
+    if last:
+        run_names = run_names[-last:]
+    levels = LEVELS[LEVELS.index(level.upper()) :] if level else None
+    regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0) if pattern else None
+
+    matches = []
+    for run in run_names:
+        run_dir = os.path.join(base_dir, run)
+        index_path = os.path.join(run_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                index = json.load(file)
+        else:
+            index = _index_plain_run(run_dir)
+
+        records = []
+        for entry in index["files"]:
+            if (os_name and entry["os"] != os_name) or (stage and entry["stage"] != stage):
+                continue
+            location = "/".join(
+                part for part in (entry["os"], entry["part"], entry["stage"]) if part
+            )
+            for chunk in entry["chunks"]:
+                if levels and chunk["levels"] is not None and not any(
+                    chunk["levels"].get(name) for name in levels
+                ):
+                    continue
+                records.extend(
+                    (time or "", location, text.rstrip("\n"))
+                    for time, record_level, text in parse_records(
+                        _read_chunk(os.path.join(run_dir, entry["path"]), chunk)
+                    )
+                    if (not levels or record_level in levels)
+                    and (not regex or regex.search(text))
+                )
+        # the records of the different files are interleaved like they were written
+        records.sort(key=lambda record: record[0])
+        matches.extend((run, location, text) for _, location, text in records)
+    return matches
+
+
+def _read_chunk(path: str, chunk: dict) -> list[str]:
+    """
+    Read the lines of a chunk of a log file.
+
+    Args:
+        path: Path of the log file, compressed or not.
+        chunk: Chunk from the index of the run.
+
+    Returns:
+        Lines of the chunk, with their line break.
+    """
+    if chunk["offset"] is None:
+        with open(path, errors="replace") as file:
+            return file.readlines()
+    with open(path, "rb") as file:
+        file.seek(chunk["offset"])
+        data = gzip.decompress(file.read(chunk["size"]))
+    return data.decode(errors="replace").splitlines(keepends=True)
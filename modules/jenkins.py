@@ -1,6 +1,10 @@
+import json
+import ntpath
 import os
+import posixpath
 import shlex
 import time
+import weakref
 from logging import Logger
 
 import paramiko
@@ -8,6 +12,29 @@ import paramiko
 from . import ssh
 from .custom_logging import log
 
+# known Jenkins homes, checked before searching the disk
+JENKINS_HOMES = {
+    "windows": [
+        # home of the service installed by the msi, also used to copy the project files
+        "C:\\Windows\\system32\\config\\systemprofile\\AppData\\Local\\Jenkins\\.jenkins",
+        "C:\\ProgramData\\Jenkins\\.jenkins",
+        "C:\\Program Files\\Jenkins",
+        "C:\\Users\\aic\\.jenkins",
+    ],
+    "linux": ["/var/lib/jenkins"],
+}
+
+# directories searched when Jenkins is not in a known home, with a bounded depth
+JENKINS_SEARCH_ROOTS = [
+    "C:\\Windows\\system32\\config\\systemprofile",
+    "C:\\ProgramData",
+    "C:\\Program Files",
+    "C:\\Users",
+]
+
+# resolved Jenkins home and admin password per ssh connection, entries disappear with the connection
+_credentials = weakref.WeakKeyDictionary()
+
 
 @log
 def run_jenkins_pipeline(
@@ -17,6 +44,10 @@ def run_jenkins_pipeline(
     project_root: str,
     logger: Logger,
     windows: bool = False,
+    upload_job: bool = True,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    build: bool = True,
 ) -> None:
     """
     Run the Jenkins pipeline.
@@ -28,48 +59,245 @@ def run_jenkins_pipeline(
         project_root: Root directory of the project.
         logger: Logger instance for logging.
         windows: Whether the VM is a Windows VM.
+        upload_job: Whether to upload the job config, False if upload_job_config already ran.
+        shard_index: Index of the shard this VM runs, given to the job as the AIC_SHARD_INDEX parameter.
+        shard_count: Number of shards of the OS, given to the job as the AIC_SHARD_COUNT parameter.
+        build: Whether to build the job, False to only create it and build it with build_job.
+    """
+    jenkins_home, jenkins_password = get_jenkins_credentials(
+        client, logger=logger, windows=windows
+    )
+    logger.debug(f"Jenkins home is {jenkins_home}.")
+
+    install_jenkins_plugins(
+        client,
+        jenkins_password,
+        plugin_file,
+        project_root,
+        windows,
+        logger=logger,
+    )
+    logger.debug("Jenkins plugins installed.")
+
+    if upload_job:
+        upload_job_config(
+            client, jenkins_file, project_root, logger=logger, windows=windows
+        )
+
+    # Create and approve the job in one round-trip
+    # See https://www.jenkins.io/doc/book/managing/cli/
+    # we need to approve the job as it's not sandboxed, see groovy script for source
+    logger.info("Creating and approving Jenkins job...")
+    if windows:
+        commands = [
+            f"Get-Content C:\\Users\\aic\\job_config.xml | java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 create-job aic_job",
+            f"Get-Content C:\\Users\\aic\\approve-scripts.groovy | java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080  groovy =",
+        ]
+    else:
+        commands = [
+            # we could also pipe with a cat to make it more like the pwsh command but that's one more dependency and it's less good practice in unix
+            f"java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 create-job aic_job < ~/job_config.xml",
+            f"java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080  groovy = < approve-scripts.groovy",
+        ]
+    ssh.execute_ssh_script(client, commands, logger=logger, windows=windows)
+    logger.debug("Jenkins job created and approved.")
+
+    if build:
+        build_job(
+            client,
+            jenkins_password,
+            logger=logger,
+            shard_index=shard_index,
+            shard_count=shard_count,
+        )
+
+
+@log
+def build_job(
+    client: paramiko.SSHClient,
+    jenkins_password: str,
+    logger: Logger,
+    shard_index: int = 0,
+    shard_count: int = 1,
+) -> None:
+    """
+    Build the job and wait for the build to finish.
+
+    Args:
+        client: SSH client connected to the VM.
+        jenkins_password: Password of the Jenkins admin user.
+        logger: Logger instance for logging.
+        shard_index: Index of the shard this VM runs, given to the job as the AIC_SHARD_INDEX parameter.
+        shard_count: Number of shards of the OS, given to the job as the AIC_SHARD_COUNT parameter.
+
+    Raises:
+        RuntimeError: If the build failed.
+    """
+    logger.info("Triggering Jenkins job...")
+    try:
+        ssh.execute_ssh_command(
+            client,
+            f"java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 build aic_job -f -v -p AIC_SHARD_INDEX={shard_index} -p AIC_SHARD_COUNT={shard_count}",
+            logger=logger,
+        )
+        logger.debug("Jenkins job triggered.")
+    except Exception as e:
+        raise RuntimeError(
+            "Jenkins pipeline failed. This is not an AIC error. Check jenkins.log for more information."
+        ) from e
+
+
+@log
+def get_stage_timings(
+    client: paramiko.SSHClient, logger: Logger, windows: bool = False
+) -> list[dict]:
+    """
+    Get the start and end of each stage of the last build of the job.
+
+    Args:
+        client: SSH client connected to the VM.
+        logger: Logger instance for logging.
+        windows: Whether the VM is a Windows VM.
+
+    Returns:
+        Name, start and end of each stage in start order, the times are seconds since the epoch on the clock of this machine.
     """
+    jenkins_home, jenkins_password = get_jenkins_credentials(
+        client, logger=logger, windows=windows
+    )
+    offset = ssh.get_clock_offset(client, logger=logger, windows=windows)
+
+    # the script is uploaded with the project files, the stages are read from the flow graph of the build
+    if windows:
+        command = f"Get-Content C:\\Users\\aic\\stage-timings.groovy | java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 groovy ="
+    else:
+        command = f"java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 groovy = < stage-timings.groovy"
+    stdout, stderr = ssh.execute_ssh_command(
+        client, command, logger=logger, print_output=False
+    )
+    stages = [
+        {
+            "name": stage["name"],
+            "start": stage["start"] / 1000 - offset,
+            "end": stage["end"] / 1000 - offset,
+        }
+        # the json is the last line, jenkins-cli can print warnings before it
+        for stage in json.loads(stdout.strip().splitlines()[-1])
+    ]
+    logger.debug(f"Stage timings: {stages}")
+    return stages
+
+
+@log
+def get_jenkins_credentials(
+    client: paramiko.SSHClient,
+    logger: Logger,
+    windows: bool = False,
+    search_depth: int = 6,
+) -> tuple[str, str]:
+    """
+    Get the Jenkins home and initial admin password, the result is cached per VM.
+
+    Args:
+        client: SSH client connected to the VM.
+        logger: Logger instance for logging.
+        windows: Whether the VM is a Windows VM.
+        search_depth: Maximum depth of the fallback search when Jenkins is not in a known home.
+
+    Returns:
+        Jenkins home and initial admin password.
+
+    Raises:
+        RuntimeError: If the initial admin password can not be found.
+    """
+    transport = client.get_transport()
+    if transport in _credentials:
+        logger.debug("Using cached Jenkins credentials.")
+        return _credentials[transport]
+
     logger.info("Getting Jenkins initial admin password...")
-    # stderr has to be there even if we don't use it else stdout will contain a tuple
+    # the first line is the path of the password file, the second the password
     if windows:
-        # some windows version will store this in a different path or even multiple times, command to find the file and then get the content w help of chatGPT
+        # some windows version will store this in a different path, a recursive search of C:\ can take minutes so we check the known homes first
+        homes = ",".join(f"'{home}'" for home in JENKINS_HOMES["windows"])
+        roots = ",".join(f"'{root}'" for root in JENKINS_SEARCH_ROOTS)
         stdout, stderr = ssh.execute_ssh_command(
             client,
-            'Get-Content -Path (Get-ChildItem -Path "C:\\" -Recurse -Filter "initialAdminPassword" -ErrorAction SilentlyContinue -Force -File -OutVariable files | Select-Object -First 1 -ExpandProperty FullName)',
+            f"$file = @({homes}) | ForEach-Object {{ Join-Path $_ 'secrets\\initialAdminPassword' }} | Where-Object {{ Test-Path $_ }} | Select-Object -First 1; "
+            f"if (-not $file) {{ $file = Get-ChildItem -Path {roots} -Recurse -Depth {search_depth} -Filter 'initialAdminPassword' -ErrorAction SilentlyContinue -Force -File | Select-Object -First 1 -ExpandProperty FullName }}; "
+            "Write-Output $file; Get-Content -Path $file",
             logger=logger,
             print_output=False,
         )
+        path_module = ntpath
     else:
+        homes = " ".join(JENKINS_HOMES["linux"])
         stdout, stderr = ssh.execute_ssh_command(
             client,
-            "sudo cat /var/lib/jenkins/secrets/initialAdminPassword",
+            f"for home in {homes}; do if sudo test -f $home/secrets/initialAdminPassword; then echo $home/secrets/initialAdminPassword; sudo cat $home/secrets/initialAdminPassword; exit 0; fi; done; "
+            f"file=$(sudo find / -maxdepth {search_depth} -name initialAdminPassword -type f 2>/dev/null | head -n 1); echo $file; sudo cat $file",
             logger=logger,
             print_output=False,
         )
+        path_module = posixpath
 
-    jenkins_password = stdout.strip()
+    lines = stdout.strip().splitlines()
+    if len(lines) < 2:
+        raise RuntimeError("Could not find the Jenkins initial admin password.")
+    password_file, jenkins_password = lines[0].strip(), lines[-1].strip()
+    # the password file is in <home>/secrets
+    jenkins_home = path_module.dirname(path_module.dirname(password_file))
+    _credentials[transport] = (jenkins_home, jenkins_password)
     logger.debug("Jenkins initial admin password obtained.")
+    return jenkins_home, jenkins_password
 
-    install_jenkins_plugins(
-        client,
-        jenkins_password,
-        plugin_file,
-        project_root,
-        windows,
-        logger=logger,
-    )
-    logger.debug("Jenkins plugins installed.")
 
+@log
+def upload_job_config(
+    client: paramiko.SSHClient,
+    jenkins_file: str,
+    project_root: str,
+    logger: Logger,
+    windows: bool = False,
+) -> None:
+    """
+    Upload the Jenkins job configuration to the VM, this does not need Jenkins to be running.
+
+    Args:
+        client: SSH client connected to the VM.
+        jenkins_file: Path to the Jenkins file base on the project root.
+        project_root: Root directory of the project.
+        logger: Logger instance for logging.
+        windows: Whether the VM is a Windows VM.
+    """
     logger.info("Creating Jenkins job...")
     with open(os.path.join(project_root, jenkins_file), "r") as file:
         jenkins_file_content = file.read()
 
     # This xml is based from a pipline made trough the Jenkins UI (exported by adding /config.xml to the job URL)
+    # the shard parameters are always defined so a pipeline can use them whether the OS is sharded or not
     # could also be done in a separate file and then we wouldn't need to escape it as we would scp it but that's more difficult to replace the jenkins_file_content
     job_config = f"""<flow-definition plugin="workflow-job@1498.v33a_0c6f3a_4b_4">
 <description/>
 <keepDependencies>false</keepDependencies>
-<properties/>
+<properties>
+<hudson.model.ParametersDefinitionProperty>
+<parameterDefinitions>
+<hudson.model.StringParameterDefinition>
+<name>AIC_SHARD_INDEX</name>
+<description>Index of the shard this VM runs, from 0 to AIC_SHARD_COUNT - 1</description>
+<defaultValue>0</defaultValue>
+<trim>true</trim>
+</hudson.model.StringParameterDefinition>
+<hudson.model.StringParameterDefinition>
+<name>AIC_SHARD_COUNT</name>
+<description>Number of VMs the tests of this OS are split across</description>
+<defaultValue>1</defaultValue>
+<trim>true</trim>
+</hudson.model.StringParameterDefinition>
+</parameterDefinitions>
+</hudson.model.ParametersDefinitionProperty>
+</properties>
 <definition class="org.jenkinsci.plugins.workflow.cps.CpsFlowDefinition" plugin="workflow-cps@4014.vcd7dc51d8b_30">
 <script>{jenkins_file_content}</script>
 <sandbox>false</sandbox>
@@ -93,52 +321,6 @@ def run_jenkins_pipeline(
         )
     logger.debug("Jenkins job configuration created.")
 
-    # Create and trigger the job
-    # See https://www.jenkins.io/doc/book/managing/cli/
-    if windows:
-        ssh.execute_ssh_command(
-            client,
-            f"Get-Content C:\\Users\\aic\\job_config.xml | java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 create-job aic_job",
-            logger=logger,
-        )
-    else:
-        ssh.execute_ssh_command(
-            client,
-            # we could also pipe with a cat to make it more like the pwsh command but that's one more dependency and it's less good practice in unix
-            f"java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 create-job aic_job < ~/job_config.xml",
-            logger=logger,
-        )
-    logger.debug("Jenkins job created.")
-    # we need to approve the job as it's not sandboxed, see groovy script for source
-
-    logger.info("Approving Jenkins job...")
-    if windows:
-        ssh.execute_ssh_command(
-            client,
-            f"Get-Content C:\\Users\\aic\\approve-scripts.groovy | java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080  groovy =",
-            logger=logger,
-        )
-    else:
-        ssh.execute_ssh_command(
-            client,
-            f"java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080  groovy = < approve-scripts.groovy",
-            logger=logger,
-        )
-    logger.debug("Jenkins job approved.")
-
-    logger.info("Triggering Jenkins job...")
-    try:
-        ssh.execute_ssh_command(
-            client,
-            f"java -jar jenkins-cli.jar -auth admin:{jenkins_password} -s http://localhost:8080 build aic_job -f -v",
-            logger=logger,
-        )
-        logger.debug("Jenkins job triggered.")
-    except Exception as e:
-        raise RuntimeError(
-            "Jenkins pipeline failed. This is not an AIC error. Check jenkins.log for more information."
-        ) from e
-
 
 @log
 def install_jenkins_plugins(
@@ -1,13 +1,568 @@
+import fnmatch
+import json
+import re
+import statistics
 import threading
 import time
 from logging import Logger
 
 import paramiko
-import plotext
 
 from . import ssh
 from .custom_logging import log
 
+# a sample that takes longer than this would be meaningless anyway
+SAMPLE_TIMEOUT = 30
+
+# name of the group of the processes that are neither in a configured group nor in the top ones
+OTHER_GROUP = "other"
+
+# I/O rates of a sample
+IO_KEYS = ["read", "write", "read_iops", "write_iops", "iowait", "rx", "tx"]
+
+# whole disks, the partitions, device mapper and md devices are skipped so nothing is counted twice
+DISK_PATTERN = re.compile(
+    r"^(?!(loop|ram|zram|sr|fd|dm-|md))(?!((sd|vd|xvd|hd)[a-z]+\d+|(nvme\d+n\d+|mmcblk\d+)p\d+)$)"
+)
+
+# lowercase name of the windows counter: key of the rate and factor to get the unit of io_rates
+WINDOWS_IO_COUNTERS = {
+    "disk read bytes/sec": ("read", 1 / 2**20),
+    "disk write bytes/sec": ("write", 1 / 2**20),
+    "disk reads/sec": ("read_iops", 1),
+    "disk writes/sec": ("write_iops", 1),
+    "bytes received/sec": ("rx", 1 / 2**20),
+    "bytes sent/sec": ("tx", 1 / 2**20),
+}
+
+# two-sided 95% critical values of the student t distribution by degrees of freedom (1 to 30), the normal one is used past it
+T_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+
+
+def parse_linux_processes(output: str, clock_ticks: int, page_size: int) -> dict:
+    """
+    Parse the content of /proc/*/stat.
+
+    Args:
+        output: Lines of /proc/*/stat.
+        clock_ticks: Clock ticks per second of the VM.
+        page_size: Page size of the VM in bytes.
+
+    Returns:
+        Dictionary with the pid as key and the name, CPU time in seconds and RSS in bytes as value.
+    """
+    processes = {}
+    for line in output.splitlines():
+        # the name is between parentheses and can contain spaces, the fields after it can not
+        head, _, tail = line.rpartition(")")
+        if not head:
+            continue
+        pid, _, name = head.partition(" (")
+        fields = tail.split()
+        # utime, stime and rss, shifted by the pid and name
+        processes[int(pid)] = (
+            name,
+            (int(fields[11]) + int(fields[12])) / clock_ticks,
+            int(fields[21]) * page_size,
+        )
+    return processes
+
+
+def parse_windows_processes(output: str) -> dict:
+    """
+    Parse the tab separated output of Get-Process.
+
+    Args:
+        output: Lines with the id, name, CPU time in seconds and working set in bytes of each process.
+
+    Returns:
+        Dictionary with the pid as key and the name, CPU time in seconds and RSS in bytes as value.
+    """
+    processes = {}
+    for line in output.splitlines():
+        fields = line.strip().split("\t")
+        if len(fields) != 4:
+            continue
+        pid, name, cpu, rss = fields
+        # the CPU time of protected processes can not be read
+        processes[int(pid)] = (name, float(cpu or 0), int(rss or 0))
+    return processes
+
+
+def parse_linux_io(output: str) -> dict:
+    """
+    Parse the content of /proc/stat, /proc/diskstats and /proc/net/dev.
+
+    Args:
+        output: Content of the three files.
+
+    Returns:
+        Counters since boot: disk bytes and operations, iowait and total CPU ticks, network bytes.
+    """
+    counters = dict.fromkeys(
+        ["read", "write", "reads", "writes", "iowait", "ticks", "rx", "tx"], 0
+    )
+    for line in output.splitlines():
+        fields = line.split()
+        if line.startswith("cpu "):
+            # user nice system idle iowait irq softirq steal, guest is already counted in user
+            counters["iowait"] = int(fields[5])
+            counters["ticks"] = sum(int(field) for field in fields[1:9])
+        elif ":" in line:
+            name, _, values = line.partition(":")
+            values = values.split()
+            # the loopback traffic never leaves the vm
+            if name.strip() != "lo" and len(values) >= 9:
+                counters["rx"] += int(values[0])
+                counters["tx"] += int(values[8])
+        elif len(fields) >= 14 and fields[0].isdigit() and DISK_PATTERN.match(fields[2]):
+            # sectors are always 512 bytes in diskstats whatever the disk uses
+            counters["reads"] += int(fields[3])
+            counters["read"] += int(fields[5]) * 512
+            counters["writes"] += int(fields[7])
+            counters["write"] += int(fields[9]) * 512
+    return counters
+
+
+def io_rates(previous: dict, current: dict, elapsed: float) -> dict:
+    """
+    Compute the I/O rates between two samples of Linux counters.
+
+    Args:
+        previous: Counters of the previous sample, as returned by parse_linux_io.
+        current: Counters of the current sample.
+        elapsed: Seconds between the two samples.
+
+    Returns:
+        Disk read and write in MB/s, read and write IOPS, iowait in percent of the CPU time, network rx and tx in MB/s.
+    """
+    if not elapsed:
+        return dict.fromkeys(IO_KEYS, 0.0)
+    delta = {key: current[key] - previous[key] for key in current}
+    return {
+        "read": round(delta["read"] / 2**20 / elapsed, 3),
+        "write": round(delta["write"] / 2**20 / elapsed, 3),
+        "read_iops": round(delta["reads"] / elapsed, 1),
+        "write_iops": round(delta["writes"] / elapsed, 1),
+        "iowait": round(delta["iowait"] / delta["ticks"] * 100, 2) if delta["ticks"] else 0.0,
+        "rx": round(delta["rx"] / 2**20 / elapsed, 3),
+        "tx": round(delta["tx"] / 2**20 / elapsed, 3),
+    }
+
+
+def parse_windows_io(output: str) -> dict:
+    """
+    Parse the tab separated path and value of the I/O performance counters.
+
+    Args:
+        output: Lines with the path and cooked value of each counter sample.
+
+    Returns:
+        Same rates as io_rates, iowait is None as Windows has no equivalent.
+    """
+    rates = dict.fromkeys(IO_KEYS, 0.0)
+    rates["iowait"] = None
+    for line in output.splitlines():
+        path, _, value = line.strip().rpartition("\t")
+        counter = path.rsplit("\\", 1)[-1].lower()
+        if counter not in WINDOWS_IO_COUNTERS:
+            continue
+        key, scale = WINDOWS_IO_COUNTERS[counter]
+        # the network counters have one instance per interface
+        rates[key] += float(value or 0) * scale
+    return {key: round(value, 3) if value is not None else None for key, value in rates.items()}
+
+
+def group_processes(
+    previous: dict,
+    current: dict,
+    elapsed: float,
+    cpu_count: int,
+    groups: dict,
+    top: int,
+) -> dict:
+    """
+    Compute the usage of each process group between two samples.
+
+    Args:
+        previous: Processes of the previous sample, as returned by the parse functions.
+        current: Processes of the current sample.
+        elapsed: Seconds between the two samples.
+        cpu_count: Number of CPUs of the VM.
+        groups: Dictionary with the group name as key and the process name patterns as value.
+        top: Number of busiest processes not in a group that are kept on their own.
+
+    Returns:
+        Dictionary with the group name as key and its CPU usage (percentage of the whole VM) and RSS in MB as value.
+    """
+    usage = {}
+    for pid, (name, cpu_time, rss) in current.items():
+        # a pid can be reused by a new process between two samples
+        before = previous.get(pid)
+        cpu = cpu_time - before[1] if before and before[0] == name else 0.0
+        group = next(
+            (
+                group
+                for group, patterns in groups.items()
+                if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+            ),
+            name,
+        )
+        total = usage.setdefault(group, [0.0, 0])
+        total[0] += max(cpu, 0.0)
+        total[1] += rss
+
+    # the processes outside the groups are merged by name, only the busiest stay on their own and idle ones never count as busy
+    others = sorted(
+        (name for name in usage if name not in groups),
+        key=lambda name: usage[name][0],
+        reverse=True,
+    )
+    for name in [name for name in others[:top] if not usage[name][0]] + others[top:]:
+        cpu, rss = usage.pop(name)
+        total = usage.setdefault(OTHER_GROUP, [0.0, 0])
+        total[0] += cpu
+        total[1] += rss
+
+    return {
+        group: {
+            "cpu": round(cpu / (elapsed * cpu_count) * 100, 2) if elapsed else 0.0,
+            "rss": round(rss / 2**20, 1),
+        }
+        for group, (cpu, rss) in usage.items()
+    }
+
+
+def display_io_metrics(
+    os_name: str, elapsed: list[float], samples: list[dict], path: str
+) -> None:
+    """
+    Display the disk and network throughput over time and save the I/O rates.
+
+    Args:
+        os_name: Name of the operating system.
+        elapsed: Seconds between the first sample and each sample.
+        samples: I/O rates of each sample.
+        path: Path of the json file to save the series to.
+    """
+    import plotext
+
+    series = {key: [sample[key] for sample in samples] for key in IO_KEYS}
+    with open(path, "w") as file:
+        json.dump({"time": elapsed, **series}, file, indent=4)
+
+    plotext.clear_data()
+    # the limits of the usage charts are not wanted here
+    plotext.ylim(0, max([1.0] + series["read"] + series["write"] + series["rx"] + series["tx"]))
+    for key, label in [
+        ("read", "Disk Read"),
+        ("write", "Disk Write"),
+        ("rx", "Network In"),
+        ("tx", "Network Out"),
+    ]:
+        plotext.plot(elapsed, series[key], label=label)
+    plotext.xlabel("Time (s)")
+    plotext.ylabel("Throughput (MB/s)")
+    plotext.title(f"Disk and Network I/O on {os_name}")
+    plotext.show()
+
+    print(f"{'':<12}{'Avg':>10}{'Peak':>10}")
+    for key, label in [
+        ("read", "Read MB/s"),
+        ("write", "Write MB/s"),
+        ("read_iops", "Read IOPS"),
+        ("write_iops", "Write IOPS"),
+        ("iowait", "IO Wait %"),
+        ("rx", "Net In MB/s"),
+        ("tx", "Net Out MB/s"),
+    ]:
+        values = [value for value in series[key] if value is not None]
+        if values:
+            print(f"{label:<12}{sum(values) / len(values):>10.2f}{max(values):>10.2f}")
+
+
+def process_series(samples: list[dict]) -> dict:
+    """
+    Turn the process samples into one series per group.
+
+    Args:
+        samples: Process usage of each sample.
+
+    Returns:
+        Dictionary with the group name as key and its CPU usage and RSS series as value.
+    """
+    names = sorted({group for sample in samples for group in sample})
+    return {
+        group: {
+            # a group missing from a sample had no process running
+            "cpu": [sample.get(group, {}).get("cpu", 0.0) for sample in samples],
+            "rss": [sample.get(group, {}).get("rss", 0.0) for sample in samples],
+        }
+        for group in names
+    }
+
+
+def display_process_metrics(
+    os_name: str, elapsed: list[float], samples: list[dict], path: str
+) -> None:
+    """
+    Display the usage of each process group over time and save it.
+
+    Args:
+        os_name: Name of the operating system.
+        elapsed: Seconds between the first sample and each sample.
+        samples: Process usage of each sample.
+        path: Path of the json file to save the series to.
+    """
+    import plotext
+
+    series = process_series(samples)
+    with open(path, "w") as file:
+        json.dump({"time": elapsed, "groups": series}, file, indent=4)
+
+    plotext.clear_data()
+    plotext.ylim(0, 100)
+    for group, values in series.items():
+        plotext.plot(elapsed, values["cpu"], label=group)
+    plotext.xlabel("Time (s)")
+    plotext.ylabel("CPU Usage (%)")
+    plotext.title(f"CPU Usage per Process on {os_name}")
+    plotext.show()
+
+    print(f"{'Process':<24}{'Avg CPU':>10}{'Peak CPU':>10}{'Peak RSS':>12}")
+    for group, values in sorted(
+        series.items(), key=lambda item: sum(item[1]["cpu"]), reverse=True
+    ):
+        print(
+            f"{group:<24}{sum(values['cpu']) / len(values['cpu']):>9.1f}%"
+            f"{max(values['cpu']):>9.1f}%{max(values['rss']):>9.0f} MB"
+        )
+
+
+def stage_profiles(os_metrics: dict) -> list[dict]:
+    """
+    Compute the resource usage of each Jenkins stage from the samples taken while it ran.
+
+    Args:
+        os_metrics: Metrics results of an OS.
+
+    Returns:
+        Name, start (seconds after the first sample), duration and average and peak CPU and RAM usage of each stage.
+    """
+    first = os_metrics["time"][0] if os_metrics["time"] else 0
+    profiles = []
+    for stage in os_metrics["stages"]:
+        samples = [
+            index
+            for index, timestamp in enumerate(os_metrics["time"])
+            if stage["start"] <= timestamp <= stage["end"]
+        ]
+        profile = {
+            "name": stage["name"],
+            "start": round(stage["start"] - first, 2),
+            "duration": round(stage["end"] - stage["start"], 2),
+        }
+        for key in ("cpu", "ram"):
+            values = [os_metrics[key][index] for index in samples]
+            # a stage shorter than the sampling interval can have no sample
+            profile[f"{key}_avg"] = round(sum(values) / len(values), 2) if values else None
+            profile[f"{key}_peak"] = max(values, default=None)
+        profiles.append(profile)
+    return profiles
+
+
+def display_stage_comparison(profiles: dict) -> None:
+    """
+    Display the fastest and slowest OS of each Jenkins stage.
+
+    Args:
+        profiles: Dictionary with the OS name as key and its stage profiles as value.
+    """
+    durations = {}
+    for os_name, os_profiles in profiles.items():
+        for profile in os_profiles:
+            durations.setdefault(profile["name"], []).append(
+                (profile["duration"], os_name)
+            )
+
+    width = max(len(name) for name in durations) + 2
+    print(f"{'Stage':<{width}}{'Fastest':<45}{'Slowest':<45}")
+    for name, values in durations.items():
+        fastest, slowest = min(values), max(values)
+        print(
+            f"{name:<{width}}{f'{fastest[1]} ({fastest[0]:.0f}s)':<45}{f'{slowest[1]} ({slowest[0]:.0f}s)':<45}"
+        )
+
+
+def describe(values: list[float]) -> dict:
+    """
+    Compute the statistics of a measure repeated over the benchmark iterations.
+
+    Args:
+        values: Value of each iteration.
+
+    Returns:
+        Number of values, mean, standard deviation, bounds of the 95% confidence interval of the mean, min and max.
+        The deviation and interval are None with less than two values.
+    """
+    mean = statistics.mean(values)
+    stddev = statistics.stdev(values) if len(values) > 1 else None
+    # the t distribution as there are only a few iterations
+    margin = (
+        (T_95[len(values) - 2] if len(values) <= len(T_95) + 1 else 1.96)
+        * stddev
+        / len(values) ** 0.5
+        if stddev is not None
+        else None
+    )
+    return {
+        "n": len(values),
+        "mean": round(mean, 2),
+        "stddev": round(stddev, 2) if stddev is not None else None,
+        "ci_low": round(mean - margin, 2) if margin is not None else None,
+        "ci_high": round(mean + margin, 2) if margin is not None else None,
+        "min": round(min(values), 2),
+        "max": round(max(values), 2),
+    }
+
+
+def iteration_profiles(os_metrics: dict) -> list[dict]:
+    """
+    Split the samples of a benchmark between its iterations.
+
+    Args:
+        os_metrics: Metrics results of an OS run in benchmark mode.
+
+    Returns:
+        Number, warm-up flag, build duration, stage durations, average and peak CPU and RAM usage and
+        resource series (seconds after the start of the build) of each iteration.
+    """
+    profiles = []
+    for iteration in os_metrics["iterations"]:
+        samples = [
+            index
+            for index, timestamp in enumerate(os_metrics["time"])
+            if iteration["start"] <= timestamp <= iteration["end"]
+        ]
+        profile = {
+            "iteration": iteration["iteration"],
+            "warmup": iteration["warmup"],
+            "duration": round(iteration["end"] - iteration["start"], 2),
+            "stages": {
+                stage["name"]: round(stage["end"] - stage["start"], 2)
+                for stage in iteration["stages"]
+            },
+        }
+        for key in ("cpu", "ram"):
+            values = [os_metrics[key][index] for index in samples]
+            profile[f"{key}_avg"] = round(sum(values) / len(values), 2) if values else None
+            profile[f"{key}_peak"] = max(values, default=None)
+        profile["series"] = {
+            "time": [round(os_metrics["time"][index] - iteration["start"], 2) for index in samples],
+            "cpu": [os_metrics["cpu"][index] for index in samples],
+            "ram": [os_metrics["ram"][index] for index in samples],
+            "io": [os_metrics["io"][index] for index in samples],
+        }
+        profiles.append(profile)
+    return profiles
+
+
+def benchmark_summary(profiles: list[dict]) -> dict:
+    """
+    Compute the statistics of the measured iterations of a benchmark, the warm-up ones are left out.
+
+    Args:
+        profiles: Iteration profiles computed by iteration_profiles.
+
+    Returns:
+        Statistics of the build duration, of the average CPU and peak RAM usage and of each stage duration.
+    """
+    measured = [profile for profile in profiles if not profile["warmup"]]
+    summary = {"duration": describe([profile["duration"] for profile in measured])}
+    for key in ("cpu_avg", "ram_peak"):
+        values = [profile[key] for profile in measured if profile[key] is not None]
+        summary[key] = describe(values) if values else None
+    summary["stages"] = {}
+    for name in dict.fromkeys(name for profile in measured for name in profile["stages"]):
+        summary["stages"][name] = describe(
+            [profile["stages"][name] for profile in measured if name in profile["stages"]]
+        )
+    return summary
+
+
+def display_benchmark(profiles: list[dict], summary: dict) -> None:
+    """
+    Display the iterations of the benchmark of an OS and their statistics.
+
+    Args:
+        profiles: Iteration profiles computed by iteration_profiles.
+        summary: Statistics computed by benchmark_summary.
+    """
+    print(f"{'Iteration':<30}{'Duration':>10}{'Avg CPU':>10}{'Peak CPU':>10}{'Avg RAM':>10}{'Peak RAM':>10}")
+    for profile in profiles:
+        usage = "".join(
+            f"{profile[key]:>9.1f}%" if profile[key] is not None else f"{'-':>10}"
+            for key in ("cpu_avg", "cpu_peak", "ram_avg", "ram_peak")
+        )
+        name = f"{profile['iteration']}{' (warm-up)' if profile['warmup'] else ''}"
+        print(f"{name:<30}{profile['duration']:>9.0f}s{usage}")
+
+    print(f"{'Measure':<30}{'Mean':>10}{'Stddev':>10}{'95% CI':>20}")
+    measures = {
+        "Build duration (s)": summary["duration"],
+        "Avg CPU (%)": summary["cpu_avg"],
+        "Peak RAM (%)": summary["ram_peak"],
+    }
+    # a stage can be named like one of the measures
+    measures |= {f"Stage {name} (s)": values for name, values in summary["stages"].items()}
+    for name, values in measures.items():
+        if values is None:
+            continue
+        stddev = f"{values['stddev']:.1f}" if values["stddev"] is not None else "-"
+        interval = (
+            f"{values['ci_low']:.1f} - {values['ci_high']:.1f}"
+            if values["ci_low"] is not None
+            else "-"
+        )
+        print(f"{name:<30}{values['mean']:>10.1f}{stddev:>10}{interval:>20}")
+
+
+def display_benchmark_comparison(summaries: dict) -> None:
+    """
+    Compare the build duration of the OS benchmarked, from the fastest to the slowest.
+
+    Args:
+        summaries: Dictionary with the OS name as key and its statistics computed by benchmark_summary as value.
+    """
+    ranked = sorted(summaries.items(), key=lambda item: item[1]["duration"]["mean"])
+    fastest = ranked[0][1]["duration"]
+    print(f"{'OS':<34}{'Builds':>8}{'Mean':>10}{'Stddev':>10}{'95% CI':>20}{'Relative':>10}  Difference")
+    for os_name, summary in ranked:
+        duration = summary["duration"]
+        stddev = f"{duration['stddev']:.1f}s" if duration["stddev"] is not None else "-"
+        interval = (
+            f"{duration['ci_low']:.1f} - {duration['ci_high']:.1f}s"
+            if duration["ci_low"] is not None
+            else "-"
+        )
+        # overlapping intervals mean the runs do not show a real difference
+        if duration is fastest:
+            difference = "fastest"
+        elif duration["ci_low"] is None or fastest["ci_high"] is None:
+            difference = "unknown, not enough builds"
+        elif duration["ci_low"] > fastest["ci_high"]:
+            difference = "significant"
+        else:
+            difference = "within noise"
+        print(
+            f"{os_name:<34}{duration['n']:>8}{duration['mean']:>9.1f}s{stddev:>10}{interval:>20}"
+            f"{duration['mean'] / fastest['mean'] if fastest['mean'] else 1:>9.2f}x  {difference}"
+        )
+
 
 @log
 def display_and_save_metrics(
@@ -22,25 +577,91 @@ def display_and_save_metrics(
         log_dir: Directory for log files.
         logger: Logger instance for logging.
     """
+    # only the main process plots, this keeps it out of the workers
+    import plotext
+
     plotext.theme("dark")
     plotext.plotsize(plotext.terminal_width(), 20)
+    profiles = {}
+    summaries = {}
     for os_name, result in results.items():
         if result == "succeeded":
-            cpu_usage, ram_usage = metrics_results[os_name]
+            os_metrics = metrics_results[os_name]
+            first = os_metrics["time"][0] if os_metrics["time"] else 0
+            elapsed = [round(timestamp - first, 2) for timestamp in os_metrics["time"]]
 
             plotext.clear_data()
             # for some reason this is considered data so we need to reset it after each data clear
             plotext.ylim(0, 100)
-            plotext.plot(cpu_usage, label="CPU Usage")
-            plotext.plot(ram_usage, label="RAM Usage")
+            plotext.plot(elapsed, os_metrics["cpu"], label="CPU Usage")
+            plotext.plot(elapsed, os_metrics["ram"], label="RAM Usage")
+            iowait = [sample["iowait"] for sample in os_metrics["io"]]
+            # windows has no iowait
+            if None not in iowait:
+                plotext.plot(elapsed, iowait, label="IO Wait")
+            # each jenkins stage starts at a line with its name
+            for stage in os_metrics["stages"]:
+                plotext.vline(max(stage["start"] - first, 0), "gray")
+                plotext.text(
+                    stage["name"], max(stage["start"] - first, 0), 95, color="gray"
+                )
             plotext.xlabel("Time (s)")
             plotext.ylabel("Usage (%)")
             plotext.title(f"Resource Usage on {os_name}")
             plotext.show()
             plotext.save_fig(f"{log_dir}/{os_name}/metrics.result")
+
+            if os_metrics["stages"]:
+                profiles[os_name] = stage_profiles(os_metrics)
+                with open(f"{log_dir}/{os_name}/stages.json", "w") as file:
+                    json.dump(profiles[os_name], file, indent=4)
+                print(
+                    f"{'Stage':<30}{'Start':>8}{'Duration':>10}{'Avg CPU':>10}{'Peak CPU':>10}{'Avg RAM':>10}{'Peak RAM':>10}"
+                )
+                for profile in profiles[os_name]:
+                    usage = "".join(
+                        f"{profile[key]:>9.1f}%" if profile[key] is not None else f"{'-':>10}"
+                        for key in ("cpu_avg", "cpu_peak", "ram_avg", "ram_peak")
+                    )
+                    print(
+                        f"{profile['name']:<30}{profile['start']:>7.0f}s{profile['duration']:>9.0f}s{usage}"
+                    )
+
+            display_io_metrics(
+                os_name, elapsed, os_metrics["io"], f"{log_dir}/{os_name}/io.json"
+            )
+
+            if os_metrics["processes"]:
+                display_process_metrics(
+                    os_name,
+                    elapsed,
+                    os_metrics["processes"],
+                    f"{log_dir}/{os_name}/processes.json",
+                )
+
+            if os_metrics["iterations"]:
+                iterations = iteration_profiles(os_metrics)
+                summaries[os_name] = benchmark_summary(iterations)
+                with open(f"{log_dir}/{os_name}/benchmark.json", "w") as file:
+                    json.dump(
+                        {"summary": summaries[os_name], "iterations": iterations},
+                        file,
+                        indent=4,
+                    )
+                display_benchmark(iterations, summaries[os_name])
             # space between each os
             print("")
 
+    if profiles:
+        with open(f"{log_dir}/stages.json", "w") as file:
+            json.dump(profiles, file, indent=4)
+        display_stage_comparison(profiles)
+
+    if summaries:
+        with open(f"{log_dir}/benchmark.json", "w") as file:
+            json.dump(summaries, file, indent=4)
+        display_benchmark_comparison(summaries)
+
 
 # we use a class just to easily stop the thread, this could be a different file too but it makes more sense create a module per scope/feature in this case
 class MetricsCollector:
@@ -51,6 +672,8 @@ class MetricsCollector:
         logger: Logger,
         interval: int = 1,
         windows: bool = False,
+        top_processes: int = 0,
+        process_groups: dict | None = None,
     ) -> None:
         """
         Initialize the MetricsCollector.
@@ -60,13 +683,25 @@ class MetricsCollector:
             logging: Logger instance for logging.
             interval: Interval between metric collections in seconds.
             windows: Whether the VM is a Windows VM.
+            top_processes: Number of busiest processes sampled on their own.
+            process_groups: Dictionary with the group name as key and the process name patterns as value.
         """
         self.client = client
         self.logger = logger
         self.interval = interval
         self.windows = windows
+        self.top_processes = top_processes
+        self.process_groups = process_groups or {}
+        # seconds since the epoch at the start of each sample, to line the samples up with the jenkins stages
+        self.timestamps = []
         self.cpu_usage = []
         self.ram_usage = []
+        self.process_usage = []
+        self.io_usage = []
+        # clock ticks, page size and number of CPUs, read on the first process sample
+        self._system = None
+        self._previous_processes = None
+        self._previous_io = None
         self._stop_flag = False
         self._thread = None
 
@@ -94,10 +729,17 @@ class MetricsCollector:
             logger: Logger instance for logging.
         """
         while not self._stop_flag:
+            timestamp = time.time()
             cpu = self._get_cpu_sample(logger=logger)
-            self.cpu_usage.append(cpu)
             ram = self._get_ram_sample(logger=logger)
+            io = self._get_io_sample(logger=logger)
+            if self.top_processes or self.process_groups:
+                self.process_usage.append(self._get_process_sample(logger=logger))
+            # only added once the sample is complete so the series have the same length
+            self.timestamps.append(timestamp)
+            self.cpu_usage.append(cpu)
             self.ram_usage.append(ram)
+            self.io_usage.append(io)
             time.sleep(self.interval)
         self.logger.debug("Metrics collection in progress.")
 
@@ -119,6 +761,7 @@ class MetricsCollector:
                 "(Get-Counter '\\Processor(_Total)\\% Processor Time').CounterSamples.CookedValue",
                 logger=logger,
                 print_output=False,
+                timeout=SAMPLE_TIMEOUT,
             )
         else:
             stdout, stderr = ssh.execute_ssh_command(
@@ -126,6 +769,7 @@ class MetricsCollector:
                 "top -bn1 | grep '%Cpu' | sed 's/.*, *\\([0-9.]*\\)%* id.*/\\1/' | awk '{print 100 - $1}'",
                 logger=logger,
                 print_output=False,
+                timeout=SAMPLE_TIMEOUT,
             )
         return float(stdout)
 
@@ -147,6 +791,7 @@ class MetricsCollector:
                 "(Get-Counter '\\Memory\\% Committed Bytes In Use').CounterSamples.CookedValue",
                 logger=logger,
                 print_output=False,
+                timeout=SAMPLE_TIMEOUT,
             )
         else:
             stdout, stderr = ssh.execute_ssh_command(
@@ -154,11 +799,120 @@ class MetricsCollector:
                 "free | grep Mem | awk '{print $3/$2 * 100.0}'",
                 logger=logger,
                 print_output=False,
+                timeout=SAMPLE_TIMEOUT,
             )
         return float(stdout)
 
     @log
-    def get_results(self, logger: Logger) -> tuple[list, list]:
+    def _get_io_sample(self, logger: Logger) -> dict:
+        """
+        Get the disk and network I/O rates since the previous sample.
+
+        Args:
+            logger: Logger instance for logging.
+
+        Returns:
+            Dictionary with the rates, see io_rates.
+        """
+        if self.windows:
+            # Get-Counter computes the rates itself over its own sample interval
+            counters = ",".join(
+                f"'\\{category}\\{counter}'"
+                for category, counter in [
+                    ("PhysicalDisk(_Total)", "Disk Read Bytes/sec"),
+                    ("PhysicalDisk(_Total)", "Disk Write Bytes/sec"),
+                    ("PhysicalDisk(_Total)", "Disk Reads/sec"),
+                    ("PhysicalDisk(_Total)", "Disk Writes/sec"),
+                    ("Network Interface(*)", "Bytes Received/sec"),
+                    ("Network Interface(*)", "Bytes Sent/sec"),
+                ]
+            )
+            stdout, stderr = ssh.execute_ssh_command(
+                self.client,
+                f"(Get-Counter {counters}).CounterSamples | ForEach-Object {{ \"$($_.Path)`t$($_.CookedValue)\" }}",
+                logger=logger,
+                print_output=False,
+                timeout=SAMPLE_TIMEOUT,
+            )
+            return parse_windows_io(stdout)
+
+        stdout, stderr = ssh.execute_ssh_command(
+            self.client,
+            "cat /proc/stat /proc/diskstats /proc/net/dev",
+            logger=logger,
+            print_output=False,
+            timeout=SAMPLE_TIMEOUT,
+        )
+        counters = parse_linux_io(stdout)
+        now = time.monotonic()
+        # the first sample has nothing to compute a rate from
+        previous, previous_time = self._previous_io or (counters, now)
+        self._previous_io = (counters, now)
+        return io_rates(previous, counters, now - previous_time)
+
+    @log
+    def _get_process_sample(self, logger: Logger) -> dict:
+        """
+        Get the CPU usage and RSS of each process group since the previous sample.
+
+        Args:
+            logger: Logger instance for logging.
+
+        Returns:
+            Dictionary with the group name as key and its CPU usage and RSS as value.
+        """
+        if self._system is None:
+            command = (
+                "[Environment]::ProcessorCount"
+                if self.windows
+                else "getconf CLK_TCK; getconf PAGESIZE; nproc"
+            )
+            stdout, stderr = ssh.execute_ssh_command(
+                self.client,
+                command,
+                logger=logger,
+                print_output=False,
+                timeout=SAMPLE_TIMEOUT,
+            )
+            self._system = [int(value) for value in stdout.split()]
+
+        if self.windows:
+            stdout, stderr = ssh.execute_ssh_command(
+                self.client,
+                "Get-Process | ForEach-Object { \"$($_.Id)`t$($_.ProcessName)`t$($_.TotalProcessorTime.TotalSeconds)`t$($_.WorkingSet64)\" }",
+                logger=logger,
+                print_output=False,
+                timeout=SAMPLE_TIMEOUT,
+            )
+            processes = parse_windows_processes(stdout)
+            cpu_count = self._system[0]
+        else:
+            # a single read of every process, the sampler itself shows up as cat, processes ending during the read make it fail
+            stdout, stderr = ssh.execute_ssh_command(
+                self.client,
+                "cat /proc/[0-9]*/stat 2>/dev/null || true",
+                logger=logger,
+                print_output=False,
+                timeout=SAMPLE_TIMEOUT,
+            )
+            clock_ticks, page_size, cpu_count = self._system
+            processes = parse_linux_processes(stdout, clock_ticks, page_size)
+        now = time.monotonic()
+
+        # the first sample only gives the RSS, the CPU usage needs a previous sample
+        previous, previous_time = self._previous_processes or ({}, now)
+        self._previous_processes = (processes, now)
+        return group_processes(
+            previous,
+            processes,
+            now - previous_time,
+            cpu_count,
+            self.process_groups,
+            self.top_processes,
+        )
+
+    @log
+    def get_results(self, logger: Logger) -> dict:
         """
         Get the collected metrics results.
 
@@ -166,11 +920,17 @@ class MetricsCollector:
             logger: Logger instance for logging.
 
         Returns:
-            CPU usage and RAM usage.
+            Dictionary with the time, CPU usage, RAM usage, I/O rates and process usage of the samples.
         """
         self.stop(logger=logger)
         self.logger.debug("Metrics collection stopped.")
-        return self.cpu_usage, self.ram_usage
+        return {
+            "time": self.timestamps,
+            "cpu": self.cpu_usage,
+            "ram": self.ram_usage,
+            "io": self.io_usage,
+            "processes": self.process_usage,
+        }
 
     @log
     def stop(self, logger: Logger) -> None:
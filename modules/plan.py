@@ -0,0 +1,450 @@
+import heapq
+import json
+import os
+
+# rough duration of a whole deployment in seconds, used when nothing better is known
+DEFAULT_DURATIONS = {
+    "windows": 1800,
+    "linux": 900,
+    "arm": 1000,
+}
+
+# pay as you go price per hour in USD of common sizes (linux, west europe), only used for estimations
+PRICES = {
+    "Standard_B2s": 0.0456,
+    "Standard_B2ms": 0.0912,
+    "Standard_B4ms": 0.1824,
+    "Standard_B2s_v2": 0.0832,
+    "Standard_B4s_v2": 0.1664,
+    "Standard_B2ps_v2": 0.0672,
+    "Standard_B4ps_v2": 0.1344,
+    "Standard_D2s_v5": 0.1150,
+    "Standard_D4s_v5": 0.2300,
+    "Standard_D2ps_v5": 0.0924,
+}
+
+# extra price per hour of the windows license for a 2 vCPU size
+WINDOWS_SURCHARGE = 0.0920
+
+# file in the cache directory storing the durations of previous deployments
+HISTORY_FILE = "history.json"
+
+# weight of the last run in the stored average duration
+HISTORY_WEIGHT = 0.5
+
+
+def os_category(os_name: str) -> str:
+    """
+    Get the category of an OS.
+
+    Args:
+        os_name: Name of the operating system.
+
+    Returns:
+        "windows", "arm" or "linux".
+    """
+    if "windows" in os_name.lower():
+        return "windows"
+    if "arm" in os_name.lower():
+        return "arm"
+    return "linux"
+
+
+def get_vm_size(os_name: str, cfg: dict) -> str:
+    """
+    Get the VM size an OS is deployed with.
+
+    Args:
+        os_name: Name of the operating system.
+        cfg: Configuration dictionary.
+
+    Returns:
+        VM size.
+    """
+    return cfg["arm_vm_size"] if os_category(os_name) == "arm" else cfg["vm_size"]
+
+
+def estimate_cost(
+    os_name: str, vm_size: str, duration: float, prices: dict | None = None
+) -> float | None:
+    """
+    Estimate the cost of a deployment.
+
+    Args:
+        os_name: Name of the operating system.
+        vm_size: VM size.
+        duration: Duration of the deployment in seconds.
+        prices: Prices per hour in USD overriding or extending the built-in table.
+
+    Returns:
+        Estimated cost in USD, None if the size is not in the price table.
+    """
+    table = PRICES | (prices or {})
+    if vm_size not in table:
+        return None
+    price = table[vm_size]
+    if os_category(os_name) == "windows":
+        price += WINDOWS_SURCHARGE
+    return price * duration / 3600
+
+
+def load_history(cache_dir: str) -> dict:
+    """
+    Load the durations of previous deployments.
+
+    Args:
+        cache_dir: Directory the history is stored in.
+
+    Returns:
+        Dictionary with the OS name as key and its average stage durations as value.
+    """
+    path = os.path.join(os.path.expanduser(cache_dir), HISTORY_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        # a corrupted history only means we fall back to the default durations
+        return {}
+
+
+def record_history(cache_dir: str, durations: dict) -> None:
+    """
+    Add the stage durations of finished deployments to the history.
+
+    Args:
+        cache_dir: Directory the history is stored in.
+        durations: Dictionary with the OS name as key and its stage timings (including "total") as value.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    history = load_history(cache_dir)
+    for os_name, timings in durations.items():
+        entry = history.setdefault(os_name, {})
+        for stage, duration in timings.items():
+            if not isinstance(duration, (int, float)):
+                continue
+            # moving average so the history follows changes of the project without being too noisy
+            previous = entry.get(stage, duration)
+            entry[stage] = round(
+                HISTORY_WEIGHT * duration + (1 - HISTORY_WEIGHT) * previous, 2
+            )
+
+    path = os.path.join(cache_dir, HISTORY_FILE)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(history, file, indent=4)
+    os.replace(f"{path}.tmp", path)
+
+
+def expected_duration(os_name: str, history: dict) -> float:
+    """
+    Get the expected duration of a deployment.
+
+    Args:
+        os_name: Name of the operating system.
+        history: Durations of previous deployments.
+
+    Returns:
+        Expected duration in seconds.
+    """
+    if "total" in history.get(os_name, {}):
+        return history[os_name]["total"]
+    return DEFAULT_DURATIONS[os_category(os_name)]
+
+
+def order_by_duration(os_names: list[str], history: dict) -> list[str]:
+    """
+    Order the deployments longest first so the slow ones do not start last and stretch the run.
+
+    Args:
+        os_names: Names of the operating systems.
+        history: Durations of previous deployments.
+
+    Returns:
+        Names of the operating systems in the order they should be submitted.
+    """
+    # sorted is stable so equal durations keep the configured order
+    return sorted(
+        os_names, key=lambda os_name: expected_duration(os_name, history), reverse=True
+    )
+
+
+def predict_makespan(os_names: list[str], history: dict, max_threads: int) -> float:
+    """
+    Predict the duration of a run.
+
+    Args:
+        os_names: Names of the operating systems in submission order.
+        history: Durations of previous deployments.
+        max_threads: Number of deployments running at the same time.
+
+    Returns:
+        Predicted duration in seconds.
+    """
+    durations = [(os_name, expected_duration(os_name, history)) for os_name in os_names]
+    starts = simulate_schedule(durations, max_threads)
+    return max((starts[name] + duration for name, duration in durations), default=0)
+
+
+def pick_canary(os_names: list[str], cfg: dict, history: dict) -> str | None:
+    """
+    Pick the OS deployed alone before the others to check the pipeline works at all.
+
+    Args:
+        os_names: Names of the operating systems.
+        cfg: Configuration dictionary.
+        history: Durations of previous deployments.
+
+    Returns:
+        Name of the cheapest Linux OS, None if there is no Linux OS.
+    """
+    linux = [os_name for os_name in os_names if os_category(os_name) != "windows"]
+
+    def cost(os_name: str) -> tuple:
+        duration = expected_duration(os_name, history)
+        price = estimate_cost(
+            os_name, get_vm_size(os_name, cfg), duration, cfg["prices"]
+        )
+        # unknown sizes go last, the duration decides between them
+        return (price if price is not None else float("inf"), duration)
+
+    return min(linux, key=cost, default=None)
+
+
+def get_sweep_sizes(os_name: str, cfg: dict) -> list[str]:
+    """
+    Get the candidate VM sizes an OS is deployed on in sweep mode.
+
+    Args:
+        os_name: Name of the operating system.
+        cfg: Configuration dictionary.
+
+    Returns:
+        Candidate sizes, the configured size alone if there are no candidates for the OS.
+    """
+    sizes = cfg["sweep_arm_sizes"] if os_category(os_name) == "arm" else cfg["sweep_sizes"]
+    return sizes or [get_vm_size(os_name, cfg)]
+
+
+def summarize_sweep(os_name: str, runs: dict, cfg: dict) -> list[dict]:
+    """
+    Summarize the deployments of an OS on each candidate size and check them against the targets.
+
+    Args:
+        os_name: Name of the operating system.
+        runs: Dictionary with the size as key and its error, stage timings and metrics as value.
+        cfg: Configuration dictionary.
+
+    Returns:
+        One dictionary per size with its duration, usage, cost and whether it meets the targets.
+    """
+    vms = cfg["shards"].get(os_name, 1)
+    entries = []
+    for size, run in runs.items():
+        timings, metrics = run["timings"], run["metrics"]
+        cpu = metrics["cpu"] if metrics else []
+        ram = metrics["ram"] if metrics else []
+        cost = estimate_cost(os_name, size, timings.get("total", 0), cfg["prices"])
+        entry = {
+            "vm_size": size,
+            "status": f"failed: {run['error']}" if run["error"] else "succeeded",
+            "duration": timings.get("total"),
+            # the part of the deployment the size has an effect on
+            "build": timings.get("jenkins"),
+            "cpu_avg": round(sum(cpu) / len(cpu), 2) if cpu else None,
+            "cpu_peak": max(cpu, default=None),
+            "ram_avg": round(sum(ram) / len(ram), 2) if ram else None,
+            "ram_peak": max(ram, default=None),
+            "cost": round(cost * vms, 4) if cost is not None else None,
+        }
+        entry["meets_targets"] = (
+            not run["error"]
+            and entry["build"] is not None
+            and (not cfg["sweep_max_duration"] or entry["build"] <= cfg["sweep_max_duration"])
+            # no samples means the build was too short to put any load on the vm
+            and (entry["cpu_avg"] or 0) <= cfg["sweep_max_cpu"]
+            and (entry["ram_peak"] or 0) <= cfg["sweep_max_ram"]
+        )
+        entries.append(entry)
+    return entries
+
+
+def recommend_size(entries: list[dict]) -> str | None:
+    """
+    Pick the size with the cheapest run among the ones meeting the targets.
+
+    Args:
+        entries: Sizes summarized by summarize_sweep.
+
+    Returns:
+        Recommended size, None if no size meets the targets.
+    """
+    candidates = [entry for entry in entries if entry["meets_targets"]]
+    # a faster vm can be cheaper per run than a smaller one, sizes without a price go last
+    best = min(
+        candidates,
+        key=lambda entry: (
+            entry["cost"] if entry["cost"] is not None else float("inf"),
+            entry["build"],
+        ),
+        default=None,
+    )
+    return best["vm_size"] if best else None
+
+
+def print_sweep(sweeps: dict, cfg: dict) -> None:
+    """
+    Print the result of each candidate size and the recommended size of each OS.
+
+    Args:
+        sweeps: Dictionary with the OS name as key and the sizes summarized by summarize_sweep as value.
+        cfg: Configuration dictionary.
+    """
+    targets = [
+        f"build under {cfg['sweep_max_duration'] / 60:.0f}m" if cfg["sweep_max_duration"] else None,
+        f"average CPU under {cfg['sweep_max_cpu']}%" if cfg["sweep_max_cpu"] < 100 else None,
+        f"peak RAM under {cfg['sweep_max_ram']}%" if cfg["sweep_max_ram"] < 100 else None,
+    ]
+    print(f"Targets: {', '.join(target for target in targets if target) or 'none'}")
+    for os_name, entries in sweeps.items():
+        print(f"{os_name}:")
+        print(
+            f"  {'VM size':<22}{'Build':>8}{'Total':>8}{'Avg CPU':>10}{'Peak RAM':>10}{'Cost':>10}  Result"
+        )
+        for entry in entries:
+            if entry["status"] != "succeeded":
+                print(f"  {entry['vm_size']:<22}{entry['status']}")
+                continue
+            cost = f"${entry['cost']:.3f}" if entry["cost"] is not None else "?"
+            usage = "".join(
+                f"{entry[key]:>9.1f}%" if entry[key] is not None else f"{'-':>10}"
+                for key in ("cpu_avg", "ram_peak")
+            )
+            print(
+                f"  {entry['vm_size']:<22}{(entry['build'] or 0) / 60:>7.1f}m{entry['duration'] / 60:>7.1f}m"
+                f"{usage}{cost:>10}  {'meets targets' if entry['meets_targets'] else 'misses targets'}"
+            )
+        recommended = recommend_size(entries)
+        print(
+            f"  Recommended: {recommended}"
+            if recommended
+            else "  Recommended: none, no size meets the targets"
+        )
+
+
+def simulate_schedule(durations: list[tuple[str, float]], max_threads: int) -> dict:
+    """
+    Simulate the deployments being picked up in order by a limited number of workers.
+
+    Args:
+        durations: Name and expected duration of each deployment, in submission order.
+        max_threads: Number of deployments running at the same time.
+
+    Returns:
+        Dictionary with the name as key and the expected start time as value.
+    """
+    # time at which each worker is free again
+    workers = [0.0] * max_threads
+    starts = {}
+    for name, duration in durations:
+        start = heapq.heappop(workers)
+        starts[name] = start
+        heapq.heappush(workers, start + duration)
+    return starts
+
+
+def create_plan(cfg: dict, terraform_dir: str) -> list[dict]:
+    """
+    Resolve what a run would deploy without deploying anything.
+
+    Args:
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing the Terraform templates of the platform.
+
+    Returns:
+        One dictionary per deployment, in submission order (longest expected first).
+    """
+    max_threads = cfg["max_threads"] or os.cpu_count()
+    history = load_history(cfg["cache_dir"])
+    deployments = []
+    for os_name in order_by_duration(cfg["os"], history):
+        category = os_category(os_name)
+        # a sweep deploys the os once per candidate size at the same time
+        sizes = get_sweep_sizes(os_name, cfg) if cfg["sweep"] else [get_vm_size(os_name, cfg)]
+        duration = expected_duration(os_name, history)
+        if cfg["benchmark"]:
+            # the jenkins stage also installs the plugins so this overestimates a bit, half of the deployment without history
+            builds = cfg["benchmark_warmup"] + cfg["benchmark_iterations"]
+            duration += (builds - 1) * history.get(os_name, {}).get(
+                "jenkins", duration / 2
+            )
+        vms = cfg["shards"].get(os_name, 1)
+        costs = [estimate_cost(os_name, size, duration, cfg["prices"]) for size in sizes]
+        deployments.append(
+            {
+                "os": os_name,
+                "template": f"{terraform_dir}/{'windows' if category == 'windows' else 'linux'}",
+                "vm_size": sizes[0] if len(sizes) == 1 else f"{len(sizes)} sizes",
+                "vms": vms * len(sizes),
+                "duration": duration,
+                # every shard runs its own vm for about the same time, local endpoints are free
+                "cost": 0.0
+                if cfg["platform"] == "local"
+                else sum(costs) * vms
+                if None not in costs
+                else None,
+            }
+        )
+
+    starts = simulate_schedule(
+        [(deployment["os"], deployment["duration"]) for deployment in deployments],
+        max_threads,
+    )
+    for deployment in deployments:
+        deployment["start"] = starts[deployment["os"]]
+    return deployments
+
+
+def print_plan(cfg: dict, terraform_dir: str) -> None:
+    """
+    Print what a run would deploy, with the estimated schedule, duration and cost.
+
+    Args:
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing the Terraform templates of the platform.
+    """
+    deployments = create_plan(cfg, terraform_dir)
+    print(f"Platform: {cfg['platform']}" + (f" ({cfg['region']})" if cfg["region"] else ""))
+    print(f"Parallel deployments: {cfg['max_threads'] or os.cpu_count()}")
+    if cfg["canary"]:
+        canary = pick_canary(cfg["os"], cfg, load_history(cfg["cache_dir"]))
+        print(f"Canary: {canary or 'none (no Linux OS)'}")
+    if cfg["max_failures"]:
+        print(f"Stop after {cfg['max_failures']} failed deployment(s)")
+    print(
+        f"{'OS':<34}{'Template':<28}{'VM size':<20}{'Start':>8}{'Duration':>10}{'Cost':>10}"
+    )
+    for deployment in deployments:
+        cost = (
+            f"${deployment['cost']:.2f}" if deployment["cost"] is not None else "?"
+        )
+        name = deployment["os"]
+        if deployment["vms"] > 1:
+            name += f" (x{deployment['vms']})"
+        print(
+            f"{name:<34}{deployment['template']:<28}{deployment['vm_size']:<20}"
+            f"{deployment['start'] / 60:>7.0f}m{deployment['duration'] / 60:>9.0f}m{cost:>10}"
+        )
+
+    makespan = max(
+        (deployment["start"] + deployment["duration"] for deployment in deployments),
+        default=0,
+    )
+    costs = [deployment["cost"] for deployment in deployments]
+    total_cost = sum(cost for cost in costs if cost is not None)
+    print(f"Estimated total time: {makespan / 60:.0f}m")
+    print(
+        f"Estimated total cost: ${total_cost:.2f}"
+        + (" (some sizes are not in the price table)" if None in costs else "")
+    )
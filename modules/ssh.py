@@ -1,34 +1,120 @@
+import concurrent.futures
 import os
+import posixpath
+import re
+import secrets
+import select
 import time
 from logging import Logger
 
 import paramiko
-
-from modules import cli
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
 
 from .custom_logging import log
 
+# private key used to connect to the VMs, the public key has the .pub extension
+KEY_PATH = "./temp/aic_key"
+
+# bytes of output kept per stream of a remote command
+DEFAULT_MAX_OUTPUT = 8 * 1024 * 1024
+
+# larger than the paramiko defaults so more writes can be in flight on high latency links
+SFTP_WINDOW_SIZE = 32 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 256 * 1024
+
+
+def _generate_key(key_type: str) -> tuple[bytes, bytes]:
+    """
+    Generate an SSH key pair in-process.
+
+    Args:
+        key_type: "ed25519" or "rsa".
+
+    Returns:
+        Private key in OpenSSH format and public key in authorized_keys format.
+
+    Raises:
+        ValueError: If the key type is not supported.
+    """
+    if key_type == "ed25519":
+        key = ed25519.Ed25519PrivateKey.generate()
+    elif key_type == "rsa":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    else:
+        raise ValueError(f"Unsupported SSH key type: {key_type}")
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption(),
+    )
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH
+    )
+    return private_key, public_key + b" aic\n"
+
+
+def _write_key(path: str, private_key: bytes, public_key: bytes) -> None:
+    """
+    Write a key pair, the private key is only readable by the user as ssh requires.
+
+    Args:
+        path: Path of the private key, the public key gets the .pub extension.
+        private_key: Private key.
+        public_key: Public key.
+    """
+    # write next to the final files and rename them so a concurrent run never reads a partial key
+    with open(
+        os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb"
+    ) as file:
+        file.write(private_key)
+    with open(f"{path}.pub.tmp", "wb") as file:
+        file.write(public_key)
+    os.replace(f"{path}.pub.tmp", f"{path}.pub")
+    os.replace(f"{path}.tmp", path)
+
 
 @log
-def create_ssh_key(logger: Logger) -> None:
+def create_ssh_key(
+    logger: Logger,
+    key_type: str = "ed25519",
+    cache_dir: str | None = None,
+    max_age: int = 30,
+) -> None:
     """
-    Create a temporary SSH key.
+    Create the SSH key used for the VMs, optionally reusing a cached one.
 
     Args:
         logger: Logger instance for logging.
+        key_type: "ed25519" or "rsa".
+        cache_dir: Directory to reuse the key from across runs, None to generate a new key each run.
+        max_age: Number of days after which the cached key is rotated.
     """
     # remove any previous key
-    if os.path.exists("temp/id_rsa"):
-        os.remove("temp/id_rsa")
-        os.remove("temp/id_rsa.pub")
+    if os.path.exists(KEY_PATH):
+        os.remove(KEY_PATH)
+        os.remove(f"{KEY_PATH}.pub")
         logger.debug("Existing SSH keys removed.")
-    cli.run(
-        "ssh-keygen -t rsa -b 4096 -f ./temp/id_rsa -N '' -q",
-        logger=logger,
-        shell=True,
-        check=True,
-    )
-    logger.debug("New SSH key generated.")
+
+    if cache_dir is None:
+        _write_key(KEY_PATH, *_generate_key(key_type))
+        logger.debug("New SSH key generated.")
+        return
+
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_key = os.path.join(cache_dir, f"id_{key_type}")
+    if (
+        not os.path.exists(cached_key)
+        or time.time() - os.path.getmtime(cached_key) > max_age * 24 * 3600
+    ):
+        _write_key(cached_key, *_generate_key(key_type))
+        logger.debug("New cached SSH key generated.")
+    else:
+        logger.debug("Reusing cached SSH key.")
+
+    with open(cached_key, "rb") as private_key, open(f"{cached_key}.pub", "rb") as public_key:
+        _write_key(KEY_PATH, private_key.read(), public_key.read())
 
 
 @log
@@ -38,7 +124,8 @@ def connect_to_vm(
     max_retries: int = 10,
     delay: int = 10,
     password: str | None = None,
-    key_path: str = "./temp/id_rsa",
+    key_path: str = KEY_PATH,
+    port: int = 22,
 ) -> paramiko.SSHClient:
     """
     Connect to a VM via SSH.
@@ -50,6 +137,7 @@ def connect_to_vm(
         delay: Delay between connection attempts in seconds.
         password: Password for the VM.
         key_path: Path to the SSH key.
+        port: SSH port of the VM.
 
     Returns:
         SSH client connected to the VM.
@@ -64,10 +152,20 @@ def connect_to_vm(
             # automatically add the hostname to the list of known hosts
             ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             if password:
-                ssh.connect(hostname=ip, username="aic", password=password, timeout=10)
+                ssh.connect(
+                    hostname=ip,
+                    port=port,
+                    username="aic",
+                    password=password,
+                    timeout=10,
+                )
             else:
                 ssh.connect(
-                    hostname=ip, username="aic", key_filename=key_path, timeout=10
+                    hostname=ip,
+                    port=port,
+                    username="aic",
+                    key_filename=key_path,
+                    timeout=10,
                 )
             logger.debug(f"SSH connection established to {ip} on attempt {attempt}.")
             return ssh
@@ -85,7 +183,12 @@ def connect_to_vm(
 
 @log
 def execute_ssh_command(
-    client: paramiko.SSHClient, command: str, logger: Logger, print_output: bool = True
+    client: paramiko.SSHClient,
+    command: str,
+    logger: Logger,
+    print_output: bool = True,
+    timeout: float | None = None,
+    max_output: int | None = DEFAULT_MAX_OUTPUT,
 ) -> tuple:
     """
     Execute an SSH command on the VM.
@@ -95,6 +198,8 @@ def execute_ssh_command(
         command: Command to execute.
         logger: Logger instance for logging.
         print_output: Whether to print the command output.
+        timeout: Maximum time the command can run in seconds, None for no limit.
+        max_output: Maximum number of bytes kept per stream (the last ones), None for no limit.
 
     Returns:
         Stdout and stderr of the command.
@@ -102,10 +207,9 @@ def execute_ssh_command(
     Raises:
         Exception: If the command fails.
     """
-    stdin, stdout, stderr = client.exec_command(command)
-    stdout_str = stdout.read().decode().strip()
-    stderr_str = stderr.read().decode().strip()
-    exit_status = stdout.channel.recv_exit_status()
+    exit_status, stdout_str, stderr_str = _run_command(
+        client, command, timeout=timeout, max_output=max_output
+    )
 
     if print_output:
         if stdout_str:
@@ -125,3 +229,301 @@ def execute_ssh_command(
 
     logger.debug(f"Command '{command}' executed successfully.")
     return stdout_str, stderr_str
+
+
+def _run_command(
+    client: paramiko.SSHClient,
+    command: str,
+    timeout: float | None = None,
+    max_output: int | None = DEFAULT_MAX_OUTPUT,
+) -> tuple[int, str, str]:
+    """
+    Run a command over a new exec channel, reading stdout and stderr at the same time.
+
+    Reading a single stream until its end can stall the command when the other stream fills the ssh window.
+
+    Args:
+        client: SSH client connected to the VM.
+        command: Command to execute.
+        timeout: Maximum time the command can run in seconds, None for no limit.
+        max_output: Maximum number of bytes kept per stream (the last ones), None for no limit.
+
+    Returns:
+        Exit status, stdout and stderr of the command.
+
+    Raises:
+        TimeoutError: If the command did not finish in time.
+    """
+    channel = client.get_transport().open_session()
+    channel.exec_command(command)
+    streams = {
+        "stdout": (bytearray(), channel.recv_ready, channel.recv),
+        "stderr": (bytearray(), channel.recv_stderr_ready, channel.recv_stderr),
+    }
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    try:
+        while True:
+            received = False
+            for buffer, ready, recv in streams.values():
+                while ready():
+                    buffer += recv(32768)
+                    received = True
+                    if max_output is not None and len(buffer) > max_output:
+                        del buffer[:-max_output]
+            # the exit status can arrive before the last data so we only stop once both streams are drained
+            if channel.exit_status_ready() and not received:
+                if not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Command '{command}' timed out after {timeout}s.")
+            if not received:
+                # wakes up when stdout has data, the timeout covers stderr only output
+                select.select([channel], [], [], 0.05)
+        exit_status = channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    stdout_str = streams["stdout"][0].decode(errors="replace").strip()
+    stderr_str = streams["stderr"][0].decode(errors="replace").strip()
+    return exit_status, stdout_str, stderr_str
+
+
+def _build_script(commands: list[str], nonce: str, windows: bool) -> str:
+    """
+    Wrap commands in a script printing markers around the output of each command on both streams.
+
+    Args:
+        commands: Commands to execute.
+        nonce: Random string the markers start with.
+        windows: Whether the remote shell is PowerShell.
+
+    Returns:
+        Script to execute.
+    """
+    script = []
+    for index, command in enumerate(commands):
+        begin = f"{nonce} begin {index}"
+        end = f"{nonce} end {index}"
+        # the markers are printed on a new line in case the output does not end with one, the script stops at the first failure
+        if windows:
+            # w help of chatgpt, $? is false when a cmdlet fails and $LASTEXITCODE is set by native commands
+            script.append(
+                f"$global:LASTEXITCODE = 0; Write-Output '{begin}'; [Console]::Error.WriteLine('{begin}')\n"
+                f"{command}\n"
+                "$ok = $?; $rc = if ($LASTEXITCODE) { $LASTEXITCODE } elseif ($ok) { 0 } else { 1 }\n"
+                f"Write-Output ''; Write-Output \"{end} $rc\"; [Console]::Error.WriteLine(''); [Console]::Error.WriteLine('{end}')\n"
+                "if ($rc -ne 0) { exit $rc }"
+            )
+        else:
+            script.append(
+                f"echo '{begin}'; echo '{begin}' >&2\n"
+                f"{{\n{command}\n}}\n"
+                "rc=$?\n"
+                f"printf '\\n%s\\n' \"{end} $rc\"; printf '\\n%s\\n' '{end}' >&2\n"
+                '[ "$rc" -eq 0 ] || exit "$rc"'
+            )
+    return "\n".join(script)
+
+
+@log
+def execute_ssh_script(
+    client: paramiko.SSHClient,
+    commands: list[str],
+    logger: Logger,
+    windows: bool = False,
+    print_output: bool = True,
+    timeout: float | None = None,
+    max_output: int | None = DEFAULT_MAX_OUTPUT,
+) -> list[tuple[int, str, str]]:
+    """
+    Execute multiple commands over a single SSH channel.
+
+    The commands run one after another in the same remote shell, the script stops at the first failing command.
+
+    Args:
+        client: SSH client connected to the VM.
+        commands: Commands to execute.
+        logger: Logger instance for logging.
+        windows: Whether the remote shell is PowerShell.
+        print_output: Whether to print the command output.
+        timeout: Maximum time the whole script can run in seconds, None for no limit.
+        max_output: Maximum number of bytes kept per stream of the whole script (the last ones), None for no limit.
+
+    Returns:
+        Exit status, stdout and stderr of each command that ran.
+
+    Raises:
+        Exception: If a command fails.
+    """
+    nonce = secrets.token_hex(8)
+    exit_status, stdout_str, stderr_str = _run_command(
+        client,
+        _build_script(commands, nonce, windows),
+        timeout=timeout,
+        max_output=max_output,
+    )
+
+    results = []
+    for index, command in enumerate(commands):
+        stdout_match = re.search(
+            rf"{nonce} begin {index}\r?\n(.*?)\r?\n{nonce} end {index} (-?\d+)",
+            stdout_str,
+            re.DOTALL,
+        )
+        if not stdout_match:
+            break
+        stderr_match = re.search(
+            rf"{nonce} begin {index}\r?\n(.*?)\r?\n{nonce} end {index}",
+            stderr_str,
+            re.DOTALL,
+        )
+        command_stdout = stdout_match.group(1).strip()
+        command_stderr = stderr_match.group(1).strip() if stderr_match else ""
+        command_status = int(stdout_match.group(2))
+        results.append((command_status, command_stdout, command_stderr))
+
+        if print_output:
+            if command_stdout:
+                logger.info(f"STDOUT: {command_stdout}")
+            if command_stderr:
+                logger.error(f"STDERR: {command_stderr}")
+        else:
+            if command_stdout:
+                logger.debug(f"STDOUT: {command_stdout}")
+            if command_stderr:
+                logger.debug(f"STDERR: {command_stderr}")
+
+        if command_status != 0:
+            raise Exception(
+                f"Command '{command}' failed with exit status {command_status}: {command_stderr}"
+            )
+
+    if len(results) < len(commands):
+        raise Exception(
+            f"Script stopped before running all commands (exit status {exit_status}): {stderr_str}"
+        )
+
+    logger.debug(f"Script of {len(commands)} commands executed successfully.")
+    return results
+
+
+@log
+def get_clock_offset(
+    client: paramiko.SSHClient, logger: Logger, windows: bool = False
+) -> float:
+    """
+    Measure how far the clock of the VM is from the clock of this machine.
+
+    Args:
+        client: SSH client connected to the VM.
+        logger: Logger instance for logging.
+        windows: Whether the VM is a Windows VM.
+
+    Returns:
+        Seconds to subtract from a time of the VM to get the time on this machine.
+    """
+    command = (
+        "[DateTimeOffset]::UtcNow.ToUnixTimeMilliseconds()"
+        if windows
+        else "date +%s%3N"
+    )
+    before = time.time()
+    stdout, stderr = execute_ssh_command(
+        client, command, logger=logger, print_output=False
+    )
+    after = time.time()
+    # the remote time was read somewhere during the round trip, the middle is the best guess
+    offset = int(stdout) / 1000 - (before + after) / 2
+    logger.debug(f"Clock offset of the VM is {offset:.3f}s (round trip {after - before:.3f}s).")
+    return offset
+
+
+def _open_sftp(client: paramiko.SSHClient) -> paramiko.SFTPClient:
+    """
+    Open an SFTP session with a large window on an existing connection.
+
+    Args:
+        client: SSH client connected to the VM.
+
+    Returns:
+        SFTP client.
+    """
+    return paramiko.SFTPClient.from_transport(
+        client.get_transport(),
+        window_size=SFTP_WINDOW_SIZE,
+        max_packet_size=SFTP_MAX_PACKET_SIZE,
+    )
+
+
+def _makedirs(sftp: paramiko.SFTPClient, remote_dir: str) -> None:
+    """
+    Create a remote directory and its parents if they do not exist.
+
+    Args:
+        sftp: SFTP client.
+        remote_dir: Directory to create, using / as separator.
+    """
+    if remote_dir in ("", "/", "."):
+        return
+    try:
+        sftp.stat(remote_dir)
+    except IOError:
+        _makedirs(sftp, posixpath.dirname(remote_dir))
+        sftp.mkdir(remote_dir)
+
+
+@log
+def upload(
+    client: paramiko.SSHClient,
+    local_path: str,
+    remote_path: str,
+    logger: Logger,
+    max_workers: int = 4,
+) -> None:
+    """
+    Upload a file or the content of a directory over SFTP, several files at a time.
+
+    Args:
+        client: SSH client connected to the VM.
+        local_path: File or directory to upload.
+        remote_path: Destination file or directory, using / as separator (for windows use /C:/...).
+        logger: Logger instance for logging.
+        max_workers: Maximum number of files uploaded at the same time, each over its own SFTP session.
+    """
+    if os.path.isdir(local_path):
+        files = []
+        for root, _, names in os.walk(local_path):
+            relative_root = os.path.relpath(root, local_path)
+            for name in names:
+                remote_file = posixpath.normpath(
+                    posixpath.join(
+                        remote_path, relative_root.replace(os.sep, "/"), name
+                    )
+                )
+                files.append((os.path.join(root, name), remote_file))
+    else:
+        files = [(local_path, remote_path)]
+
+    # create the directories once before uploading the files in parallel
+    sftp = _open_sftp(client)
+    try:
+        for remote_dir in sorted({posixpath.dirname(remote) for _, remote in files}):
+            _makedirs(sftp, remote_dir)
+    finally:
+        sftp.close()
+
+    def upload_files(batch: list[tuple[str, str]]) -> None:
+        # paramiko pipelines the writes of a single file, separate sessions permit multiple files at once
+        sftp = _open_sftp(client)
+        try:
+            for local, remote in batch:
+                sftp.put(local, remote)
+        finally:
+            sftp.close()
+
+    batches = [files[index::max_workers] for index in range(max_workers)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        for future in [executor.submit(upload_files, batch) for batch in batches if batch]:
+            future.result()
+    logger.debug(f"Uploaded {len(files)} files to {remote_path}.")
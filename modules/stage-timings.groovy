@@ -0,0 +1,25 @@
+// prints the name, start and end (milliseconds since the epoch, clock of the vm) of each stage of the last build as json
+import groovy.json.JsonOutput
+import jenkins.model.Jenkins
+import org.jenkinsci.plugins.workflow.actions.LabelAction
+import org.jenkinsci.plugins.workflow.actions.TimingAction
+import org.jenkinsci.plugins.workflow.cps.nodes.StepEndNode
+import org.jenkinsci.plugins.workflow.cps.nodes.StepStartNode
+import org.jenkinsci.plugins.workflow.graphanalysis.DepthFirstScanner
+
+def build = Jenkins.get().getItemByFullName("aic_job").getLastBuild()
+def nodes = new DepthFirstScanner().allNodes(build.getExecution())
+// the end node of a block points to its start node
+def ends = nodes.findAll { it instanceof StepEndNode }.collectEntries { [(it.getStartNode().getId()): it] }
+// the body of a stage is the labelled block of the stage step, parallel branches are labelled too but are not stages
+def stages = nodes.findAll {
+    it instanceof StepStartNode && it.getAction(LabelAction) != null && it.getDescriptor()?.getFunctionName() == "stage"
+}.collect {
+    def end = ends[it.getId()]
+    [
+        name: it.getAction(LabelAction).getDisplayName(),
+        start: TimingAction.getStartTime(it),
+        end: end ? TimingAction.getStartTime(end) : System.currentTimeMillis(),
+    ]
+}
+println JsonOutput.toJson(stages.sort { it.start })
@@ -1,31 +1,106 @@
+import json
 import re
 import subprocess
+import time
 from logging import Logger
 
 from modules import cli
 
 from .custom_logging import log
 
+# the order matters, extension timeouts often also contain generic timeout wording
+FAILURE_PATTERNS = {
+    # the windows ssh extension (or the vm itself) did not finish provisioning in time
+    "timeout": [
+        r"VMExtensionProvisioningTimeout",
+        r"VMExtensionProvisioningError",
+        r"OSProvisioningTimedOut",
+        r"waiting for creation/update of Virtual Machine Extension",
+    ],
+    # azure api hiccups, the request can simply be sent again
+    "transient": [
+        r"TooManyRequests",
+        r"StatusCode=429",
+        r"RetryableError",
+        r"[Tt]hrottl",
+        r"StatusCode=5\d\d",
+        r"InternalServerError",
+        r"connection reset by peer",
+        r"TLS handshake timeout",
+    ],
+}
+
+
+def classify_failure(output: str) -> str:
+    """
+    Classify a failed Terraform apply based on its output.
+
+    Args:
+        output: Combined stdout and stderr of the failed command.
+
+    Returns:
+        "timeout", "transient" or "fatal".
+    """
+    for failure, patterns in FAILURE_PATTERNS.items():
+        if any(re.search(pattern, output) for pattern in patterns):
+            return failure
+    return "fatal"
+
+
+def failed_resources(output: str) -> list[str]:
+    """
+    Get the addresses of the resources Terraform reported errors for.
+
+    Args:
+        output: Combined stdout and stderr of the failed command.
+
+    Returns:
+        Resource addresses without duplicates, in order of appearance.
+    """
+    # terraform diagnostics look like "│   with azurerm_virtual_machine_extension.main,"
+    addresses = re.findall(r"with ([\w\-]+\.[\w\-\.\[\]\"]+),", output)
+    return list(dict.fromkeys(addresses))
+
 
 @log
 def init_and_apply(
-    terraform_dir: str, os_name: str, logger: Logger, env: dict, max_retries: int = 1
+    terraform_dir: str,
+    os_name: str,
+    logger: Logger,
+    env: dict,
+    max_retries: int = 3,
+    backoff: int = 30,
+    retry_counts: dict | None = None,
+    interrupt=None,
+    name: str | None = None,
 ) -> None:
     """
     Initialize and apply Terraform configuration.
 
+    Failed applies are retried on top of the existing state, only the resources that timed out are tainted.
+
     Args:
         terraform_dir: Directory containing Terraform files.
         os_name: Name of the operating system.
         logger: Logger instance for logging.
         env: Environment variables.
         max_retries: Maximum number of retries.
+        backoff: Base delay in seconds between retries, doubled on each retry.
+        retry_counts: Optional dictionary updated with the number of retries per failure class.
+        interrupt: Shared value across processes to handle interrupts, no retry is made once it is set.
+        name: Unique name of the deployment used for the state file, defaults to the OS name.
 
     Raises:
-        Exception: If maximum retries are reached and Terraform apply fails.
+        KeyboardInterrupt: If the apply failed after an interrupt.
+        Exception: If maximum retries are reached or the failure can not be recovered from.
     """
+    if retry_counts is None:
+        retry_counts = {}
+    if name is None:
+        name = os_name
     env["TF_VAR_os"] = os_name
     logger.debug(f"Environment variable TF_VAR_os set to {os_name}")
+    env["TF_VAR_name"] = name
     if "arm" in os_name.lower():
         env["TF_VAR_arm"] = "true"
         logger.debug("Environment variable TF_VAR_arm set to true")
@@ -41,11 +116,12 @@ def init_and_apply(
         env=env,
     )
 
-    for retry in range(1, max_retries + 1):
+    for retry in range(0, max_retries + 1):
         try:
             # use a separate state file for each thread
+            # reading the same state file permits to continue where a previous attempt stopped instead of rebuilding everything
             cli.run(
-                f"terraform apply -state-out={os_name}.tfstate -auto-approve -lock=false",
+                f"terraform apply -state={name}.tfstate -state-out={name}.tfstate -auto-approve -lock=false",
                 shell=True,
                 cwd=terraform_dir,
                 env=env,
@@ -55,18 +131,44 @@ def init_and_apply(
             return
         except subprocess.CalledProcessError as e:
             logger.error(f"Terraform apply failed: {e}")
-            # seems like the timout is ~3min
-            # this should not be an issue when using a non free vm but the free tier vms (which do not comply w windows minimum requirement at all) are so slow it can easily take this long just to install ssh
-            logger.error(
-                "This is likely windows vm taking too long to install ssh which causes azure to timeout"
-            )
-            logger.error(
-                "To prevent this in the future increase the vm size when using windows"
+            # the apply was most likely stopped on purpose, retrying would only delay the destroy
+            if interrupt is not None and interrupt.value:
+                raise KeyboardInterrupt("Terraform apply interrupted.") from e
+            output = f"{e.output}\n{e.stderr}"
+            failure = classify_failure(output)
+            logger.debug(f"Terraform apply failure classified as {failure}.")
+            if failure == "fatal":
+                raise Exception("Terraform apply failed with a non recoverable error.") from e
+            if retry >= max_retries:
+                break
+            retry_counts[failure] = retry_counts.get(failure, 0) + 1
+
+            if failure == "timeout":
+                # seems like the timout is ~3min
+                # this should not be an issue when using a non free vm but the free tier vms (which do not comply w windows minimum requirement at all) are so slow it can easily take this long just to install ssh
+                logger.error(
+                    "This is likely windows vm taking too long to install ssh which causes azure to timeout"
+                )
+                logger.error(
+                    "To prevent this in the future increase the vm size when using windows"
+                )
+                # terraform does not know what has been made as azure can still actually install ssh, tainting only the failed resources prevents conflicts without recreating the rg, network and ip
+                for address in failed_resources(output):
+                    logger.info(f"Tainting {address}")
+                    cli.run(
+                        f"terraform taint -state={name}.tfstate -lock=false {address}",
+                        shell=True,
+                        cwd=terraform_dir,
+                        env=env,
+                        logger=logger,
+                        check=False,
+                    )
+
+            delay = backoff * 2 ** (retry_counts[failure] - 1)
+            logger.info(
+                f"Retrying in {delay} seconds... Attempt {retry + 2} ({failure} failure)"
             )
-            # this is needed as if it timouts terraform does not know what has been made as azure can still actually install ssh and this will create conflict
-            logger.info("Destroying resources")
-            if retry < max_retries:
-                logger.info(f"Retrying... Attempt {retry + 1}")
+            time.sleep(delay)
     raise Exception("Max retries reached. Terraform apply failed.")
 
 
@@ -93,6 +195,7 @@ def get_public_ip(terraform_dir: str, os_name: str, logger: Logger) -> str:
         cwd=terraform_dir,
         check=True,
         text=True,
+        capture_output=True,
     )
     # regex to find an ipv4 w help of ChatGPT
     ip_pattern = r"\b(?:\d{1,3}\.){3}\d{1,3}\b"
@@ -102,6 +205,33 @@ def get_public_ip(terraform_dir: str, os_name: str, logger: Logger) -> str:
     return match.group(0)
 
 
+@log
+def get_ssh_port(terraform_dir: str, os_name: str, logger: Logger) -> int:
+    """
+    Get the SSH port of the deployed VM.
+
+    Args:
+        terraform_dir: Directory containing Terraform files.
+        os_name: Name of the operating system.
+        logger: Logger instance for logging.
+
+    Returns:
+        SSH port, 22 if the template does not output one.
+    """
+    # all outputs as json, asking for a missing output would fail
+    stdout, stderr = cli.run(
+        f"terraform output -state={os_name}.tfstate -json",
+        logger=logger,
+        shell=True,
+        cwd=terraform_dir,
+        check=True,
+        text=True,
+        capture_output=True,
+    )
+    outputs = json.loads(stdout or "{}")
+    return int(outputs.get("ssh_port", {}).get("value", 22))
+
+
 @log
 def destroy(terraform_dir: str, os_name: str, env: dict, logger: Logger) -> None:
     """
@@ -1,17 +1,22 @@
+import concurrent.futures
+import contextlib
+import json
 import multiprocessing
 import os
 import random
 import secrets
 import shutil
-import signal
 import string
+import tarfile
+import time
+from collections.abc import Callable
 from logging import Logger
 
 import paramiko
 
 from modules import cli
 
-from . import ansible, custom_logging, jenkins, metrics, ssh, terraform
+from . import ansible, custom_logging, jenkins, metrics, plan, ssh, terraform
 from .custom_logging import log
 
 
@@ -19,10 +24,89 @@ def handler(logger: Logger):
     raise KeyboardInterrupt("Interrupt signal received. Exiting...")
 
 
+@contextlib.contextmanager
+def stage(timings: dict, name: str):
+    """
+    Record the duration of a deployment stage.
+
+    Args:
+        timings: Dictionary to store the duration in.
+        name: Name of the stage.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[name] = round(time.monotonic() - start, 2)
+
+
+# state of a deployment worker process, set once by init_worker
+_worker = {}
+
+
+def init_worker(
+    cfg: dict,
+    terraform_dir: str,
+    log_dir: str,
+    interrupt: multiprocessing.Value,  # type: ignore
+    provisioner: tuple | None,
+) -> None:
+    """
+    Initialize a deployment worker process, this runs once per worker.
+
+    Args:
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing Terraform files.
+        log_dir: Directory for the log files of the run.
+        interrupt: Shared value across processes to handle interrupts.
+        provisioner: Request queue and results of the batch provisioner, None to provision the VMs on their own.
+    """
+    # interrupts are ignored between deployments, deploy_and_test handles them while a deployment runs
+    cli.install_interrupt_handler()
+    logger = custom_logging.setup_logger(
+        f"{log_dir}/main.log", cfg["log_level"], "main"
+    )
+    _worker.update(
+        {
+            "cfg": cfg,
+            "terraform_dir": terraform_dir,
+            "log_dir": log_dir,
+            "interrupt": interrupt,
+            "provisioner": provisioner,
+            "logger": logger,
+        }
+    )
+    logger.debug(f"Worker {os.getpid()} initialized.")
+
+
+def run_deployment(os_name: str) -> tuple:
+    """
+    Deploy and test an OS in a worker process initialized by init_worker.
+
+    Args:
+        os_name: Name of the operating system.
+
+    Returns:
+        OS name, status, and metrics.
+    """
+    try:
+        return deploy_and_test(
+            os_name,
+            _worker["cfg"],
+            _worker["terraform_dir"],
+            f"{_worker['log_dir']}/{os_name}",
+            logger=_worker["logger"],
+            interrupt=_worker["interrupt"],
+            provisioner=_worker["provisioner"],
+        )
+    finally:
+        cli.install_interrupt_handler()
+
+
 @log
-def deploy_and_test(os_name: str, cfg: dict, terraform_dir: str, log_dir: str, logger: Logger, interrupt: multiprocessing.Value) -> tuple:  # type: ignore
+def deploy_and_test(os_name: str, cfg: dict, terraform_dir: str, log_dir: str, logger: Logger, interrupt: multiprocessing.Value, provisioner: tuple | None = None) -> tuple:  # type: ignore
     """
-    Deploy a VM and run tests on it.
+    Deploy a VM and run tests on it, or one VM per shard when the OS is sharded.
 
     Args:
         os_name: Name of the operating system.
@@ -31,54 +115,45 @@ def deploy_and_test(os_name: str, cfg: dict, terraform_dir: str, log_dir: str, l
         log_dir: Directory for log files.
         logger: Logger instance for logging.
         interrupt: Shared value across processes to handle interrupts.
+        provisioner: Request queue and results of the batch provisioner, None to provision the VM on its own.
 
     Returns:
         OS name, status, and metrics.
     """
     try:
         # reset the interrupt signal
-        signal.signal(signal.SIGINT, lambda signum, frame: handler(logger=logger))
+        cli.install_interrupt_handler(lambda: handler(logger=logger))
         # due to racing condition the main thread can not have the time to cancel all the futures
         if interrupt.value:
             return os_name, "cancelled", None
 
         os.mkdir(log_dir)
+        # workers run multiple deployments so the logger of the worker is kept as is
         logger = custom_logging.setup_logger(
-            f"{log_dir}/main.log", cfg["log_level"], "main"
+            f"{log_dir}/main.log", cfg["log_level"], f"main-{os_name}"
         )
 
-        env = os.environ.copy()
-        logger.debug("Environment variables copied.")
-
-        # for multiple users executing simultaneous runs on the same subscription
-        resource_group_name = f"{cfg['rg_prefix']}-{os_name}-{''.join(random.choices(string.ascii_letters + string.digits, k=32))}"
-        env["TF_VAR_resource_group_name"] = resource_group_name
-        logger.debug(f"Resource group name set to {resource_group_name}")
-
-        if "windows" in os_name.lower():
-            password = generate_azure_password(logger=logger)
-            env["TF_VAR_password"] = password
-            logger.debug("Password generated for Windows VM.")
-            metrics = deploy_vm_and_run_tests(
-                f"{terraform_dir}/windows",
+        if cfg["sweep"]:
+            metrics = sweep_vm_sizes(
                 os_name,
                 cfg,
-                env,
+                terraform_dir,
                 log_dir,
                 logger=logger,
-                password=password,
-                windows=True,
+                interrupt=interrupt,
+                provisioner=provisioner,
             )
         else:
-            metrics = deploy_vm_and_run_tests(
-                f"{terraform_dir}/linux",
+            metrics = deploy_shards(
+                os_name,
                 os_name,
                 cfg,
-                env=env,
-                log_dir=log_dir,
+                terraform_dir,
+                log_dir,
                 logger=logger,
+                interrupt=interrupt,
+                provisioner=provisioner,
             )
-            logger.debug("Linux VM deployment initiated.")
 
         logger.info(f"Deployment and test for {os_name} succeeded.")
         return os_name, "succeeded", metrics
@@ -87,6 +162,413 @@ def deploy_and_test(os_name: str, cfg: dict, terraform_dir: str, log_dir: str, l
         return os_name, f"failed: {e}", None
 
 
+@log
+def deploy_shards(os_name: str, name: str, cfg: dict, terraform_dir: str, log_dir: str, logger: Logger, interrupt: multiprocessing.Value, provisioner: tuple | None = None, vm_size: str | None = None) -> dict:  # type: ignore
+    """
+    Deploy an OS on a single VM, or on one VM per shard when it is sharded.
+
+    Args:
+        os_name: Name of the operating system.
+        name: Unique name of the deployment, the OS name unless sweeping VM sizes.
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing Terraform files.
+        log_dir: Directory for log files.
+        logger: Logger instance for logging.
+        interrupt: Shared value across processes to handle interrupts.
+        provisioner: Request queue and results of the batch provisioner, None to provision the VM on its own.
+        vm_size: VM size to use instead of the configured one.
+
+    Returns:
+        Metrics results.
+
+    Raises:
+        Exception: If a shard failed.
+    """
+    shard_count = cfg["shards"].get(os_name, 1)
+    if shard_count == 1:
+        return deploy_shard(
+            os_name,
+            name,
+            cfg,
+            terraform_dir,
+            log_dir,
+            logger=logger,
+            interrupt=interrupt,
+            provisioner=provisioner,
+            vm_size=vm_size,
+        )
+
+    logger.info(f"Deploying {name} on {shard_count} VMs...")
+    # each shard is a whole deployment with its own state file, inventory and logs
+    with concurrent.futures.ThreadPoolExecutor(shard_count) as executor:
+        futures = []
+        for index in range(shard_count):
+            shard_dir = f"{log_dir}/shard{index}"
+            os.mkdir(shard_dir)
+            futures.append(
+                executor.submit(
+                    deploy_shard,
+                    os_name,
+                    f"{name}-shard{index}",
+                    cfg,
+                    terraform_dir,
+                    shard_dir,
+                    logger=custom_logging.setup_logger(
+                        f"{shard_dir}/main.log",
+                        cfg["log_level"],
+                        f"main-{name}-shard{index}",
+                    ),
+                    interrupt=interrupt,
+                    provisioner=provisioner,
+                    shard=(index, shard_count),
+                    vm_size=vm_size,
+                )
+            )
+        concurrent.futures.wait(futures)
+
+    merge_shard_timings(log_dir, shard_count)
+    errors = [
+        f"shard {index}: {future.exception()}"
+        for index, future in enumerate(futures)
+        if future.exception()
+    ]
+    if errors:
+        raise Exception(", ".join(errors))
+    return merge_shard_metrics([future.result() for future in futures])
+
+
+@log
+def sweep_vm_sizes(os_name: str, cfg: dict, terraform_dir: str, log_dir: str, logger: Logger, interrupt: multiprocessing.Value, provisioner: tuple | None = None) -> dict:  # type: ignore
+    """
+    Deploy an OS on each candidate VM size at the same time and compare them.
+
+    Args:
+        os_name: Name of the operating system.
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing Terraform files.
+        log_dir: Directory for log files.
+        logger: Logger instance for logging.
+        interrupt: Shared value across processes to handle interrupts.
+        provisioner: Request queue and results of the batch provisioner, None to provision the VM on its own.
+
+    Returns:
+        Metrics results of the recommended size (the fastest one if no size meets the targets), with the summary of every size under "sweep".
+
+    Raises:
+        Exception: If the deployment failed on every size.
+    """
+    sizes = plan.get_sweep_sizes(os_name, cfg)
+    logger.info(f"Deploying {os_name} on {len(sizes)} VM sizes: {', '.join(sizes)}...")
+    with concurrent.futures.ThreadPoolExecutor(len(sizes)) as executor:
+        futures = {}
+        for size in sizes:
+            size_dir = f"{log_dir}/{size}"
+            os.mkdir(size_dir)
+            futures[size] = executor.submit(
+                deploy_shards,
+                os_name,
+                f"{os_name}-{size}",
+                cfg,
+                terraform_dir,
+                size_dir,
+                logger=custom_logging.setup_logger(
+                    f"{size_dir}/main.log",
+                    cfg["log_level"],
+                    f"main-{os_name}-{size}",
+                ),
+                interrupt=interrupt,
+                provisioner=provisioner,
+                vm_size=size,
+            )
+        concurrent.futures.wait(futures.values())
+
+    runs = {}
+    for size, future in futures.items():
+        timings_path = f"{log_dir}/{size}/timings.json"
+        timings = {}
+        # a deployment stopped before its first stage has no timings
+        if os.path.exists(timings_path):
+            with open(timings_path) as file:
+                timings = json.load(file)
+        runs[size] = {
+            "error": str(future.exception()) if future.exception() else None,
+            "timings": timings,
+            "metrics": None if future.exception() else future.result(),
+        }
+    entries = plan.summarize_sweep(os_name, runs, cfg)
+    with open(f"{log_dir}/sweep.json", "w") as file:
+        json.dump(entries, file, indent=4)
+
+    succeeded = [entry for entry in entries if entry["status"] == "succeeded"]
+    if not succeeded:
+        raise Exception(
+            ", ".join(f"{size}: {run['error']}" for size, run in runs.items())
+        )
+    shown = plan.recommend_size(entries) or min(
+        succeeded, key=lambda entry: entry["build"] or 0
+    )["vm_size"]
+    logger.info(f"Sweep of {os_name} done, showing the metrics of {shown}.")
+    return runs[shown]["metrics"] | {"sweep": entries, "vm_size": shown}
+
+
+@log
+def deploy_shard(os_name: str, name: str, cfg: dict, terraform_dir: str, log_dir: str, logger: Logger, interrupt: multiprocessing.Value, provisioner: tuple | None = None, shard: tuple[int, int] = (0, 1), vm_size: str | None = None) -> dict:  # type: ignore
+    """
+    Deploy a single VM and run the tests, or its part of them, on it.
+
+    Args:
+        os_name: Name of the operating system.
+        name: Unique name of the deployment, the OS name unless the OS is sharded.
+        cfg: Configuration dictionary.
+        terraform_dir: Directory containing Terraform files.
+        log_dir: Directory for log files.
+        logger: Logger instance for logging.
+        interrupt: Shared value across processes to handle interrupts.
+        provisioner: Request queue and results of the batch provisioner, None to provision the VM on its own.
+        shard: Index of the shard and number of shards.
+        vm_size: VM size to use instead of the configured one.
+
+    Returns:
+        Metrics results.
+    """
+    env = os.environ.copy()
+    logger.debug("Environment variables copied.")
+    if vm_size:
+        # the template picks the variable matching the architecture
+        env["TF_VAR_vm_size"] = env["TF_VAR_arm_vm_size"] = vm_size
+        logger.debug(f"VM size set to {vm_size}.")
+
+    # for multiple users executing simultaneous runs on the same subscription
+    resource_group_name = f"{cfg['rg_prefix']}-{name}-{''.join(random.choices(string.ascii_letters + string.digits, k=32))}"
+    env["TF_VAR_resource_group_name"] = resource_group_name
+    logger.debug(f"Resource group name set to {resource_group_name}")
+
+    if "windows" in os_name.lower():
+        password = generate_azure_password(logger=logger)
+        env["TF_VAR_password"] = password
+        logger.debug("Password generated for Windows VM.")
+        return deploy_vm_and_run_tests(
+            f"{terraform_dir}/windows",
+            os_name,
+            cfg,
+            env,
+            log_dir,
+            logger=logger,
+            password=password,
+            windows=True,
+            interrupt=interrupt,
+            provisioner=provisioner,
+            name=name,
+            shard=shard,
+        )
+    logger.debug("Linux VM deployment initiated.")
+    return deploy_vm_and_run_tests(
+        f"{terraform_dir}/linux",
+        os_name,
+        cfg,
+        env=env,
+        log_dir=log_dir,
+        logger=logger,
+        interrupt=interrupt,
+        provisioner=provisioner,
+        name=name,
+        shard=shard,
+    )
+
+
+def merge_shard_timings(log_dir: str, shard_count: int) -> None:
+    """
+    Write the stage timings of a sharded OS, each stage takes as long as its slowest shard.
+
+    Args:
+        log_dir: Log directory of the OS, containing one directory per shard.
+        shard_count: Number of shards.
+    """
+    timings = {}
+    for index in range(shard_count):
+        path = f"{log_dir}/shard{index}/timings.json"
+        # a shard stopped before its first stage has no timings
+        if not os.path.exists(path):
+            continue
+        with open(path) as file:
+            for stage_name, duration in json.load(file).items():
+                if isinstance(duration, (int, float)):
+                    timings[stage_name] = max(timings.get(stage_name, 0), duration)
+    with open(f"{log_dir}/timings.json", "w") as file:
+        json.dump(timings, file, indent=4)
+
+
+def merge_stages(shard_stages: list[list[dict]]) -> list[dict]:
+    """
+    Merge the Jenkins stages of the shards of an OS.
+
+    Args:
+        shard_stages: Stages of each shard.
+
+    Returns:
+        Stages of the OS in start order.
+    """
+    merged = []
+    # a stage of the OS lasts from its first start to its last end across the shards
+    for stage_name in dict.fromkeys(
+        stage["name"] for stages in shard_stages for stage in stages
+    ):
+        stages = [
+            stage
+            for stages in shard_stages
+            for stage in stages
+            if stage["name"] == stage_name
+        ]
+        merged.append(
+            {
+                "name": stage_name,
+                "start": min(stage["start"] for stage in stages),
+                "end": max(stage["end"] for stage in stages),
+            }
+        )
+    merged.sort(key=lambda stage: stage["start"])
+    return merged
+
+
+def merge_shard_metrics(shard_metrics: list[dict]) -> dict:
+    """
+    Merge the metrics of the shards of an OS, each sample is the average of the shards still running.
+
+    Args:
+        shard_metrics: Metrics results of each shard.
+
+    Returns:
+        Metrics results of the OS.
+    """
+    merged = {
+        "stages": merge_stages([metrics["stages"] for metrics in shard_metrics]),
+        "iterations": [],
+    }
+    # the shards build at the same time, an iteration lasts until its last shard is done
+    for index in range(max(len(metrics["iterations"]) for metrics in shard_metrics)):
+        iterations = [
+            metrics["iterations"][index]
+            for metrics in shard_metrics
+            if index < len(metrics["iterations"])
+        ]
+        merged["iterations"].append(
+            {
+                "iteration": iterations[0]["iteration"],
+                "warmup": iterations[0]["warmup"],
+                "start": min(iteration["start"] for iteration in iterations),
+                "end": max(iteration["end"] for iteration in iterations),
+                "stages": merge_stages([iteration["stages"] for iteration in iterations]),
+            }
+        )
+    for key in ("time", "cpu", "ram", "io", "processes"):
+        series = [metrics[key] for metrics in shard_metrics]
+        length = max((len(samples) for samples in series), default=0)
+        merged[key] = []
+        for i in range(length):
+            running = [samples[i] for samples in series if i < len(samples)]
+            if key == "io":
+                merged[key].append(
+                    {
+                        # iowait is None on windows
+                        rate: round(sum(sample[rate] for sample in running) / len(running), 3)
+                        if running[0][rate] is not None
+                        else None
+                        for rate in running[0]
+                    }
+                )
+                continue
+            if key != "processes":
+                merged[key].append(sum(running) / len(running))
+                continue
+            # a group missing from a shard had no process running on it
+            groups = {group for sample in running for group in sample}
+            merged[key].append(
+                {
+                    group: {
+                        value: round(
+                            sum(sample.get(group, {}).get(value, 0) for sample in running)
+                            / len(running),
+                            2,
+                        )
+                        for value in ("cpu", "rss")
+                    }
+                    for group in groups
+                }
+            )
+    return merged
+
+
+@log
+def run_stages(
+    stages: dict,
+    timings: dict,
+    logger: Logger,
+    results: dict | None = None,
+    max_workers: int = 4,
+    interrupt: multiprocessing.Value = None,  # type: ignore
+    on_cancel: Callable[[], None] | None = None,
+) -> dict:
+    """
+    Run the stages of a deployment, each stage starts as soon as the stages it depends on are done.
+
+    Args:
+        stages: Dictionary with the stage name as key and a tuple of the function to run and the names of the stages it depends on as value.
+        timings: Dictionary to store the duration of each stage in.
+        logger: Logger instance for logging.
+        results: Dictionary filled with the return value of each stage as soon as it is done.
+        max_workers: Maximum number of stages running at the same time.
+        interrupt: Shared value across processes, the deployment is cancelled once it is set.
+        on_cancel: Function called on cancellation to make the running stages stop early.
+
+    Returns:
+        Dictionary with the stage name as key and the return value of its function as value.
+
+    Raises:
+        KeyboardInterrupt: If the deployment is cancelled, after the running stages stopped.
+        ValueError: If the dependencies of the stages can not be resolved.
+        Exception: The first exception raised by a stage, the stages not started yet are skipped.
+    """
+
+    def run_stage(name: str, func: Callable):
+        with stage(timings, name):
+            return func()
+
+    if results is None:
+        results = {}
+    pending = dict(stages)
+    running = {}
+    # waits for the running stages before leaving, even on errors
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        while pending or running:
+            for name, (func, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    del pending[name]
+                    logger.debug(f"Starting stage {name}.")
+                    running[executor.submit(run_stage, name, func)] = name
+            if not running:
+                raise ValueError(
+                    f"Stage dependencies can not be resolved: {', '.join(pending)}"
+                )
+
+            done, _ = concurrent.futures.wait(
+                running,
+                # poll the interrupt so a cancelled deployment is torn down without waiting for the running stages
+                timeout=1 if interrupt is not None else None,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if interrupt is not None and interrupt.value:
+                logger.warning("Deployment cancelled, stopping the running stages...")
+                if on_cancel:
+                    on_cancel()
+                raise KeyboardInterrupt("Deployment cancelled.")
+            for future in done:
+                name = running.pop(future)
+                # raises the exception of the stage, which skips the pending ones
+                results[name] = future.result()
+                logger.debug(f"Stage {name} done.")
+    return results
+
+
 @log
 def deploy_vm_and_run_tests(
     terraform_dir: str,
@@ -97,10 +579,16 @@ def deploy_vm_and_run_tests(
     logger: Logger,
     password: str | None = None,
     windows: bool = False,
-) -> tuple[list, list]:
+    interrupt: multiprocessing.Value = None,  # type: ignore
+    provisioner: tuple | None = None,
+    name: str | None = None,
+    shard: tuple[int, int] = (0, 1),
+) -> dict:
     """
     Deploy a VM and run tests on it.
 
+    Independent stages run at the same time, for example the project files are uploaded while Ansible installs Jenkins.
+
     Args:
         terraform_dir: Directory containing Terraform files.
         os_name: Name of the operating system.
@@ -110,84 +598,244 @@ def deploy_vm_and_run_tests(
         logger: Logger instance for logging.
         password: Password for the VM.
         windows: Whether the VM is a Windows VM.
+        interrupt: Shared value across processes to handle interrupts.
+        provisioner: Request queue and results of the batch provisioner, None to provision the VM on its own.
+        name: Unique name of the deployment used for its state file, inventory and loggers, defaults to the OS name.
+        shard: Index of the shard and number of shards, passed to the Jenkins job.
 
     Returns:
         Metrics results.
     """
-    client = None
+    if name is None:
+        name = os_name
+    # clients are replaced when windows switches to powershell so we keep them all to close them
+    clients = []
     metrics_collector = None
+    stage_timings = []
+    iterations = []
 
     terraform_logger = custom_logging.setup_logger(
-        f"{log_dir}/terraform.log", cfg["log_level"], "terraform", f"{log_dir}/main.log"
+        f"{log_dir}/terraform.log",
+        cfg["log_level"],
+        f"terraform-{name}",
     )
     ansible_logger = custom_logging.setup_logger(
-        f"{log_dir}/ansible.log", cfg["log_level"], "ansible", f"{log_dir}/main.log"
+        f"{log_dir}/ansible.log",
+        cfg["log_level"],
+        f"ansible-{name}",
     )
     jenkins_logger = custom_logging.setup_logger(
-        f"{log_dir}/jenkins.log", cfg["log_level"], "jenkins", f"{log_dir}/main.log"
+        f"{log_dir}/jenkins.log",
+        cfg["log_level"],
+        f"jenkins-{name}",
     )
     metrics_logger = custom_logging.setup_logger(
-        f"{log_dir}/metrics.log", cfg["log_level"], "metrics", f"{log_dir}/main.log"
+        f"{log_dir}/metrics.log",
+        cfg["log_level"],
+        f"metrics-{name}",
     )
 
-    try:
-        logger.info(f"Deploying {os_name} VM")
+    start = time.monotonic()
+    timings = {}
+    terraform_retries = {}
+    timings["terraform_retries"] = terraform_retries
+    archive_path = f"./temp/{name}-project.tar.gz"
+
+    def apply():
+        logger.info(f"Deploying {name} VM")
         terraform.init_and_apply(
             terraform_dir,
             os_name,
+            name=name,
             env=env,
             logger=terraform_logger,
+            retry_counts=terraform_retries,
+            interrupt=interrupt,
         )
         logger.debug("Terraform apply completed.")
 
+    def get_ip() -> str:
         logger.info("Getting the public IP address...")
-        ip = terraform.get_public_ip(terraform_dir, os_name, logger=terraform_logger)
+        ip = terraform.get_public_ip(terraform_dir, name, logger=terraform_logger)
         logger.debug(f"Public IP address obtained: {ip}")
+        return ip
 
+    def get_port() -> int:
+        port = terraform.get_ssh_port(terraform_dir, name, logger=terraform_logger)
+        logger.debug(f"SSH port obtained: {port}")
+        return port
+
+    def connect() -> paramiko.SSHClient:
         logger.info("Connecting to the VM via SSH...")
         # for windows this only serves to wait for ssh to be available
-        client = ssh.connect_to_vm(ip, logger=logger, password=password)
-        logger.debug("SSH connection established.")
-        ansible.download_remote_dependency(
-            os_name, logger=ansible_logger, password=password, windows=windows, ip=ip
+        client = ssh.connect_to_vm(
+            results["ip"], logger=logger, password=password, port=results["port"]
         )
+        clients.append(client)
+        logger.debug("SSH connection established.")
+        return client
+
+    def provision():
+        if provisioner:
+            ansible.request_provisioning(
+                *provisioner,
+                name,
+                results["ip"],
+                logger=ansible_logger,
+                interrupt=interrupt,
+                password=password,
+                windows=windows,
+                port=results["port"],
+            )
+        else:
+            ansible.download_remote_dependency(
+                name,
+                logger=ansible_logger,
+                password=password,
+                windows=windows,
+                ip=results["ip"],
+                port=results["port"],
+            )
         logger.debug("Remote dependencies downloaded.")
 
-        if windows:
-            logger.info("Recreating the ssh connection with powershell as shell...")
-            client.close()
-            client = ssh.connect_to_vm(ip, logger=logger, password=password)
-            logger.debug("SSH connection re-established with PowerShell.")
+    def reconnect() -> paramiko.SSHClient:
+        logger.info("Recreating the ssh connection with powershell as shell...")
+        results["ssh_connect"].close()
+        client = ssh.connect_to_vm(
+            results["ip"], logger=logger, password=password, port=results["port"]
+        )
+        clients.append(client)
+        logger.debug("SSH connection re-established with PowerShell.")
+        return client
+
+    def archive():
+        prepare_project_archive(cfg["project_root"], archive_path, logger=logger)
 
+    def upload():
         logger.info("Copying project files...")
-        copy_project_files(
-            client,
-            ip,
+        upload_project_files(
+            results["shell"],
             cfg["project_root"],
             logger=logger,
-            password=password,
             windows=windows,
+            archive_path=None if windows else archive_path,
         )
+        logger.debug("Project files uploaded.")
+
+    def install():
+        install_project_files(results["shell"], logger=logger, windows=windows)
         logger.debug("Project files copied.")
 
+    def job_config():
+        jenkins.upload_job_config(
+            results["shell"],
+            cfg["jenkins_file"],
+            cfg["project_root"],
+            logger=jenkins_logger,
+            windows=windows,
+        )
+
+    def run_jenkins():
+        nonlocal metrics_collector
         metrics_collector = metrics.MetricsCollector(
-            client, logger=metrics_logger, windows=windows
+            results["shell"],
+            logger=metrics_logger,
+            windows=windows,
+            top_processes=cfg["top_processes"],
+            process_groups=cfg["process_groups"],
         )
         metrics_collector.start(logger=logger)
         logger.debug("Metrics collection started.")
 
         logger.info("Running Jenkins pipeline...")
         jenkins.run_jenkins_pipeline(
-            client,
+            results["shell"],
             cfg["jenkins_file"],
             cfg["plugin_file"],
             cfg["project_root"],
             logger=jenkins_logger,
             windows=windows,
+            upload_job=False,
+            shard_index=shard[0],
+            shard_count=shard[1],
+            build=not cfg["benchmark"],
         )
         logger.debug("Jenkins pipeline executed.")
 
+        nonlocal stage_timings
+        if cfg["benchmark"]:
+            iterations.extend(
+                run_benchmark(
+                    results["shell"],
+                    cfg,
+                    jenkins_logger,
+                    logger=logger,
+                    windows=windows,
+                    shard=shard,
+                )
+            )
+            # the chart shows the stages of the last build
+            stage_timings = iterations[-1]["stages"]
+            return
+        try:
+            stage_timings = jenkins.get_stage_timings(
+                results["shell"], logger=jenkins_logger, windows=windows
+            )
+        except Exception as e:
+            # the metrics are still shown without the stages
+            logger.warning(f"Could not get the timings of the Jenkins stages: {e}")
+
+    def cancel():
+        # terraform gets an interrupt and the remote commands fail once their connection is closed
+        cli.interrupt_processes()
+        if metrics_collector:
+            metrics_collector.stop(logger=metrics_logger)
+        for client in clients:
+            client.close()
+
+    # stage name: (function, stages it depends on)
+    stages = {
+        "terraform_apply": (apply, []),
+        "ip": (get_ip, ["terraform_apply"]),
+        "port": (get_port, ["terraform_apply"]),
+        "ssh_connect": (connect, ["ip", "port"]),
+        "ansible": (provision, ["ssh_connect"]),
+    }
+    if windows:
+        # the project is copied straight into the jenkins workspace created by ansible, over the powershell connection
+        stages |= {
+            "shell": (reconnect, ["ansible"]),
+            "copy_project": (upload, ["shell"]),
+            "install_project": (install, ["copy_project"]),
+        }
+    else:
+        # the archive is made while terraform runs and uploaded while ansible installs jenkins
+        stages |= {
+            "shell": (lambda: results["ssh_connect"], ["ssh_connect"]),
+            "archive_project": (archive, []),
+            "copy_project": (upload, ["shell", "archive_project"]),
+            "install_project": (install, ["copy_project", "ansible"]),
+        }
+    stages |= {
+        # the job config does not need jenkins to be running
+        "job_config": (job_config, ["shell"]),
+        "jenkins": (run_jenkins, ["install_project", "job_config"]),
+    }
+
+    # filled by run_stages, the stage functions only read the results of the stages they depend on
+    results = {}
+    try:
+        run_stages(
+            stages,
+            timings,
+            logger=logger,
+            results=results,
+            interrupt=interrupt,
+            on_cancel=cancel,
+        )
         metrics_results = metrics_collector.get_results(logger=metrics_logger)
+        metrics_results["stages"] = stage_timings
+        metrics_results["iterations"] = iterations
         logger.debug("Metrics results obtained.")
         return metrics_results
     finally:
@@ -195,80 +843,187 @@ def deploy_vm_and_run_tests(
         if metrics_collector:
             metrics_results = metrics_collector.stop(logger=metrics_logger)
             logger.debug("Metrics collection stopped.")
-        terraform.destroy(terraform_dir, os_name, env, logger=terraform_logger)
+        with stage(timings, "terraform_destroy"):
+            terraform.destroy(terraform_dir, name, env, logger=terraform_logger)
         logger.debug("Terraform resources destroyed.")
-        if client:
+        for client in clients:
             client.close()
             logger.debug("SSH connection closed.")
+        timings["total"] = round(time.monotonic() - start, 2)
+        logger.info(f"Stage timings: {timings}")
+        with open(f"{log_dir}/timings.json", "w") as file:
+            json.dump(timings, file, indent=4)
+
+
+@log
+def run_benchmark(client: paramiko.SSHClient, cfg: dict, jenkins_logger: Logger, logger: Logger, windows: bool = False, shard: tuple[int, int] = (0, 1)) -> list[dict]:
+    """
+    Build the job several times on the same VM, the warm-up builds first.
+
+    Args:
+        client: SSH client connected to the VM.
+        cfg: Configuration dictionary.
+        jenkins_logger: Logger instance for the Jenkins commands.
+        logger: Logger instance for logging.
+        windows: Whether the VM is a Windows VM.
+        shard: Index of the shard and number of shards, passed to the Jenkins job.
+
+    Returns:
+        Number, warm-up flag, start, end (seconds since the epoch) and stages of each build.
+
+    Raises:
+        RuntimeError: If a build failed.
+    """
+    _, jenkins_password = jenkins.get_jenkins_credentials(
+        client, logger=jenkins_logger, windows=windows
+    )
+    count = cfg["benchmark_warmup"] + cfg["benchmark_iterations"]
+    iterations = []
+    for index in range(count):
+        warmup = index < cfg["benchmark_warmup"]
+        logger.info(
+            f"Running {'warm-up' if warmup else 'benchmark'} build {index + 1}/{count}..."
+        )
+        # same clock as the metrics samples
+        start = time.time()
+        jenkins.build_job(
+            client,
+            jenkins_password,
+            logger=jenkins_logger,
+            shard_index=shard[0],
+            shard_count=shard[1],
+        )
+        end = time.time()
+        stages = []
+        try:
+            stages = jenkins.get_stage_timings(
+                client, logger=jenkins_logger, windows=windows
+            )
+        except Exception as e:
+            logger.warning(f"Could not get the timings of the Jenkins stages: {e}")
+        iterations.append(
+            {
+                "iteration": index + 1,
+                "warmup": warmup,
+                "start": start,
+                "end": end,
+                "stages": stages,
+            }
+        )
+        logger.debug(f"Build {index + 1} took {end - start:.2f} seconds.")
+    return iterations
 
 
 @log
-def copy_project_files(
+def prepare_project_archive(project_root: str, archive_path: str, logger: Logger) -> None:
+    """
+    Pack the project files in a single archive to upload them in one transfer.
+
+    Args:
+        project_root: Root directory of the project.
+        archive_path: Path of the archive to create.
+        logger: Logger instance for logging.
+    """
+    with tarfile.open(archive_path, "w:gz") as archive:
+        archive.add(project_root, arcname=".")
+    logger.debug(f"Project archive created at {archive_path}.")
+
+
+@log
+def upload_project_files(
     client: paramiko.SSHClient,
-    ip: str,
     project_root: str,
     logger: Logger,
-    password: str | None = None,
     windows: bool = False,
+    archive_path: str | None = None,
 ) -> None:
     """
-    Copy project files to the VM.
+    Upload the project files to the VM over SFTP.
 
     Args:
         client: SSH client connected to the VM.
-        ip: IP address of the VM.
         project_root: Root directory of the project.
         logger: Logger instance for logging.
-        password: Password for the VM.
         windows: Whether the VM a Windows VM.
+        archive_path: Archive of the project files made by prepare_project_archive, required for Linux.
 
     Raises:
         ValueError: If the combination of arguments is not supported.
     """
-    if password and windows:
-        # scp does not support password auth OOTB so we use sshpass to automate the password input
-        # for windows path check out https://stackoverflow.com/questions/10235778/scp-from-linux-to-windows
-        cli.run(
-            f"sshpass -p {password} scp -o StrictHostKeyChecking=no -r {project_root}/* aic@{ip}:C:/Windows/system32/config/systemprofile/AppData/Local/Jenkins/.jenkins/workspace/aic_job",
+    if windows:
+        # windows has no tar on every version so the files are uploaded straight in the jenkins workspace
+        ssh.upload(
+            client,
+            project_root,
+            "/C:/Windows/system32/config/systemprofile/AppData/Local/Jenkins/.jenkins/workspace/aic_job",
+            logger=logger,
+        )
+        ssh.upload(
+            client,
+            "./modules/approve-scripts.groovy",
+            "/C:/Users/aic/approve-scripts.groovy",
             logger=logger,
-            shell=True,
-            check=True,
         )
-        cli.run(
-            f"sshpass -p {password} scp -o StrictHostKeyChecking=no ./modules/approve-scripts.groovy aic@{ip}:/C:/Users/aic ",
+        ssh.upload(
+            client,
+            "./modules/stage-timings.groovy",
+            "/C:/Users/aic/stage-timings.groovy",
             logger=logger,
-            shell=True,
-            check=True,
         )
         logger.debug("Project files copied to VM.")
-    elif not windows:
-        # copy the project files to the VM
-        cli.run(
-            f"scp -o StrictHostKeyChecking=no -i ./temp/id_rsa -r {project_root} aic@{ip}:~/project",
+    elif archive_path:
+        # copy the project archive to the VM and unpack it in ~/project
+        archive_name = os.path.basename(archive_path)
+        # sftp paths are relative to the home directory
+        ssh.upload(client, archive_path, archive_name, logger=logger)
+        ssh.upload(
+            client,
+            "./modules/approve-scripts.groovy",
+            "approve-scripts.groovy",
             logger=logger,
-            shell=True,
-            check=True,
         )
-        ssh.execute_ssh_command(
+        ssh.upload(
             client,
-            "sudo cp -r ~/project/* /var/lib/jenkins/workspace/aic_job",
+            "./modules/stage-timings.groovy",
+            "stage-timings.groovy",
             logger=logger,
         )
-        # regive jenkins ownership of the workspace
         ssh.execute_ssh_command(
-            client, "sudo chown -R jenkins:jenkins /var/lib/jenkins", logger=logger
-        )
-        cli.run(
-            f"scp -o StrictHostKeyChecking=no -i ./temp/id_rsa ./modules/approve-scripts.groovy aic@{ip}:~",
+            client,
+            f"mkdir -p ~/project && tar -xzf ~/{archive_name} -C ~/project && rm ~/{archive_name}",
             logger=logger,
-            shell=True,
-            check=True,
         )
         logger.debug("Project files copied to VM.")
     else:
         raise ValueError("Copy Project: This combination of arguments is not supported")
 
 
+@log
+def install_project_files(
+    client: paramiko.SSHClient, logger: Logger, windows: bool = False
+) -> None:
+    """
+    Move the uploaded project files to the Jenkins workspace, this needs Jenkins to be installed.
+
+    Args:
+        client: SSH client connected to the VM.
+        logger: Logger instance for logging.
+        windows: Whether the VM a Windows VM.
+    """
+    # windows files are uploaded straight in the workspace
+    if windows:
+        return
+    ssh.execute_ssh_script(
+        client,
+        [
+            "sudo cp -r ~/project/* /var/lib/jenkins/workspace/aic_job",
+            # regive jenkins ownership of the workspace
+            "sudo chown -R jenkins:jenkins /var/lib/jenkins",
+        ],
+        logger=logger,
+    )
+
+
 @log
 def cleanup(logger: Logger) -> None:
     """
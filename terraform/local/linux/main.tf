@@ -0,0 +1,15 @@
+# no resources are created, the "vms" are ssh endpoints already running on this machine (containers, a local sshd on another port...)
+# this permits to run the whole orchestration without a cloud account, for example to measure its overhead
+locals {
+  # shards can have their own endpoint, else they share the one of their os
+  address = lookup(var.hosts, var.name, lookup(var.hosts, var.os, ""))
+  parts   = split(":", local.address)
+}
+
+output "public_ip" {
+  value = local.parts[0]
+}
+
+output "ssh_port" {
+  value = length(local.parts) > 1 ? tonumber(local.parts[1]) : 22
+}
@@ -0,0 +1,11 @@
+variable "os" {
+  type = string
+}
+
+variable "name" {
+  type = string
+}
+
+variable "hosts" {
+  type = map(string)
+}